@@ -0,0 +1,117 @@
+import argparse
+import hashlib
+import http.server
+import json
+import tempfile
+import threading
+import time
+import urllib.parse
+
+import collect_data
+from page_cache import PageCache, REPLAY
+
+
+class StubApiHandler(http.server.BaseHTTPRequestHandler):
+    """
+    answers /v1/search like ipfs-search does, with an artificial delay per request
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+        mime = query.get('q', [''])[0].split('/')[-1].strip('"')
+        page = int(query.get('page', ['0'])[0])
+        time.sleep(self.server.latency)
+        hits = [{'hash': f'{mime}-{page}-{i}', 'mimetype': f'video/{mime}', 'size': 1024 * i,
+                 'first-seen': '2022-01-01T00:00:00Z', 'last-seen': '2022-01-01T00:00:00Z', 'score': 1.0}
+                for i in range(self.server.hits)]
+        body = json.dumps({'total': self.server.hits * self.server.page_count, 'page_count': self.server.page_count,
+                           'page_size': self.server.hits, 'hits': hits}).encode('utf-8')
+        etag = f'"{hashlib.md5(body).hexdigest()}"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_server(latency, page_count, hits):
+    """
+    start a local stub of the search api in a background thread
+    :param latency: seconds to wait before answering a request
+    :param page_count: page_count reported to the client
+    :param hits: hits per page
+    :return: server, api url
+    """
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StubApiHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.page_count = page_count
+    server.hits = hits
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}/v1/search'
+
+
+def sequential_crawl(api_url, video_types, last_page):
+    """
+    the pre-crawler loop: one fresh connection per page, one page at a time
+    :return: number of pages fetched
+    """
+    pages = 0
+    for v_type in video_types:
+        for page_number in range(last_page + 1):
+            collect_data.extract_data(collect_data.get_page_data(v_type, page_number, api_url=api_url))
+            pages += 1
+    return pages
+
+
+def concurrent_crawl(api_url, video_types, last_page, **kwargs):
+    crawler = collect_data.new_crawler(api_url, max_page=last_page, **kwargs)
+    pages = 0
+    for _, _, page_data in crawler.crawl(video_types):
+        collect_data.extract_data(page_data)
+        pages += 1
+    return pages
+
+
+def run(name, func, *args, **kwargs):
+    start = time.time()
+    pages = func(*args, **kwargs)
+    duration = time.time() - start
+    print(f'{name:<12} {pages:>5} pages {duration:8.2f} s {pages / duration:8.1f} pages/s')
+    return pages / duration
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--latency', type=float, default=0.05, help="stub server delay per request (s)")
+    parser.add_argument('--pages', type=int, default=20, help="last page fetched per mime type")
+    parser.add_argument('--hits', type=int, default=20, help="hits per page")
+    parser.add_argument('-w', '--workers', type=int, default=16, help="total concurrent requests")
+    parser.add_argument('--per-type', type=int, default=4, help="concurrent requests per mime type")
+    parser.add_argument('--rate', type=float, default=1000.0, help="api calls per second")
+    args = parser.parse_args()
+
+    server, url = start_stub_server(args.latency, args.pages + 1, args.hits)
+    print(f'stub api at {url}, latency {args.latency} s, {len(collect_data.VIDEO_TYPES)} types x {args.pages + 1} pages')
+    base = run('sequential', sequential_crawl, url, collect_data.VIDEO_TYPES, args.pages)
+    fast = run('concurrent', concurrent_crawl, url, collect_data.VIDEO_TYPES, args.pages,
+               max_workers=args.workers, per_type=args.per_type, rate=args.rate, burst=args.workers)
+    print(f'speedup {fast / base:.1f}x')
+    # record once, then replay offline to measure the crawler itself
+    with tempfile.TemporaryDirectory() as cache_dir:
+        concurrent_crawl(url, collect_data.VIDEO_TYPES, args.pages, cache=PageCache(cache_dir),
+                         max_workers=args.workers, per_type=args.per_type, rate=args.rate, burst=args.workers)
+        run('replay', concurrent_crawl, url, collect_data.VIDEO_TYPES, args.pages,
+            cache=PageCache(cache_dir, mode=REPLAY), max_workers=args.workers, per_type=args.per_type)
+    server.shutdown()
@@ -0,0 +1,129 @@
+import argparse
+import os
+import sqlite3
+import sys
+
+# sqlite limits the number of host parameters per statement
+BATCH_SIZE = 500
+
+
+class CidIndex:
+    """
+    persistent set of every CID seen so far, backed by sqlite
+
+    The plain text list (all_video_cid.txt) stays the append-only record other
+    tools read, the index remembers how far it has imported that file and catches
+    up with anything appended to it since.
+    """
+
+    def __init__(self, path, legacy_path=None):
+        """
+        :param path: sqlite database file
+        :param legacy_path: all_video_cid.txt to import and keep in sync, None to skip
+        """
+        self.path = path
+        self.legacy_path = legacy_path
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS seen (cid TEXT PRIMARY KEY, first_seen TEXT) WITHOUT ROWID')
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        self.db.commit()
+        if legacy_path is not None:
+            self.sync_legacy()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM seen').fetchone()[0]
+
+    def __contains__(self, cid):
+        return self.db.execute('SELECT 1 FROM seen WHERE cid = ?', (cid,)).fetchone() is not None
+
+    def sync_legacy(self):
+        """
+        import lines appended to the legacy text list since the last sync
+        :return: number of lines imported
+        """
+        if not os.path.isfile(self.legacy_path):
+            return 0
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'legacy_offset'").fetchone()
+        offset = int(row[0]) if row else 0
+        if os.path.getsize(self.legacy_path) < offset:
+            # case file was truncated or replaced, import from the start
+            offset = 0
+        imported = 0
+        with open(self.legacy_path, 'rb') as fin, self.db:
+            fin.seek(offset)
+            batch = []
+            for line in fin:
+                if not line.endswith(b'\n'):
+                    # partial line still being written, pick it up next time
+                    break
+                offset += len(line)
+                cid = line.decode('utf-8').strip()
+                if cid:
+                    batch.append((cid, None))
+                if len(batch) >= BATCH_SIZE:
+                    self.db.executemany('INSERT OR IGNORE INTO seen VALUES (?, ?)', batch)
+                    imported += len(batch)
+                    batch = []
+            self.db.executemany('INSERT OR IGNORE INTO seen VALUES (?, ?)', batch)
+            imported += len(batch)
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('legacy_offset', ?)", (str(offset),))
+        return imported
+
+    def filter_new(self, cids):
+        """
+        keep the CIDs the index has not seen yet, order is preserved
+        :param cids: iterable of cid
+        :return: list of unseen cid
+        """
+        cids = list(cids)
+        seen = set()
+        for start in range(0, len(cids), BATCH_SIZE):
+            batch = cids[start:start + BATCH_SIZE]
+            query = f'SELECT cid FROM seen WHERE cid IN ({",".join("?" * len(batch))})'
+            seen.update(row[0] for row in self.db.execute(query, batch))
+        return [cid for cid in cids if cid not in seen]
+
+    def add(self, cids, first_seen=None):
+        """
+        durably record CIDs as seen, also appended to the legacy text list
+        :param cids: list of cid
+        :param first_seen: label of the crawl that found them, e.g. 2022-02-19-01
+        :return: None
+        """
+        if self.legacy_path is not None:
+            # pick up lines other tools appended before moving the offset past them
+            self.sync_legacy()
+        with self.db:
+            self.db.executemany('INSERT OR IGNORE INTO seen VALUES (?, ?)', [(cid, first_seen) for cid in cids])
+            if self.legacy_path is not None:
+                with open(self.legacy_path, 'a') as fout:
+                    for cid in cids:
+                        fout.write(cid + '\n')
+                self.db.execute("INSERT OR REPLACE INTO meta VALUES ('legacy_offset', ?)",
+                                (str(os.path.getsize(self.legacy_path)),))
+
+
+if __name__ == '__main__':
+    # query the index, e.g. python cid_index.py data/all_video_cid.sqlite bafy... or cids on stdin
+    parser = argparse.ArgumentParser()
+    parser.add_argument('index', type=str, help="sqlite index file")
+    parser.add_argument('cids', type=str, nargs='*', help="cids to look up, read from stdin if empty")
+    args = parser.parse_args()
+    with CidIndex(args.index) as index:
+        cids = args.cids or ([] if sys.stdin.isatty() else [line.strip() for line in sys.stdin if line.strip()])
+        if not cids:
+            print(f'{len(index)} cids indexed')
+        fresh = set(index.filter_new(cids))
+        for cid in cids:
+            print(f'{cid} {"new" if cid in fresh else "seen"}')
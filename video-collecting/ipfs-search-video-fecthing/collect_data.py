@@ -1,30 +1,62 @@
+import argparse
 import datetime
-import json
 import os.path
-import pathlib
 
 import requests
 
+from cid_index import CidIndex
+from crawler import Checkpoint, Crawler, MAX_RESUMES, PageError, RETRY_STATUS
+from extract_client import ExtractClient
+from hit_log import HitWriter
+from page_cache import PageCache, RECORD, REPLAY
 
-def get_page_data(video_type, page_number):
+API_URL = 'https://api.ipfs-search.com/v1/search'
+VIDEO_TYPES = ['mp4', 'webm', 'ogg', 'quicktime', 'mpeg', 'x-msvideo', 'x-ms-wmv']
+
+
+def get_page_data(video_type, page_number, session=None, api_url=API_URL, cache=None):
     """
     abstract json data from query
     :param video_type: video mime type e.g. video/mp4, video/quicktime
     :param page_number: page number for api to call
-    :return: data of the page in json
+    :param session: requests session to reuse pooled connections, None for a one-off request
+    :param api_url: search endpoint
+    :param cache: PageCache recording the pages, None to always ask the api
+    :return: data of the page in json, raise on http or decoding error
     """
     headers = {
         'accept': 'application/json',
     }
-    url = f'https://api.ipfs-search.com/v1/search?q=metadata.Content-Type%3A%22video%2F{video_type}' \
-          f'%22&type=file&page={page_number}'
-    r = requests.get(url, headers=headers)
-    try:
-        data = r.json()
-        return data
-    except Exception as e:
-        print(e)
-    return {}
+    entry = None
+    if cache is not None:
+        entry = cache.load(video_type, page_number)
+        if entry is not None and cache.fresh(entry):
+            return entry['data']
+        if cache.mode == REPLAY:
+            raise PageError(f'{video_type} page {page_number} not recorded', retry=False)
+        if entry is not None:
+            # revalidate the expired page instead of downloading it again
+            headers.update(cache.validators(entry))
+    params = {
+        'q': f'metadata.Content-Type:"video/{video_type}"',
+        'type': 'file',
+        'page': page_number,
+    }
+    r = (session or requests).get(api_url, headers=headers, params=params, timeout=60)
+    if r.status_code in RETRY_STATUS:
+        retry_after = r.headers.get('Retry-After')
+        raise PageError(f'status {r.status_code}',
+                        retry_after=float(retry_after) if retry_after and retry_after.isdigit() else None)
+    if 400 <= r.status_code < 500:
+        raise PageError(f'status {r.status_code}', retry=False)
+    if r.status_code == 304 and entry is not None:
+        cache.store(video_type, page_number, entry['data'], r, previous=entry)
+        return entry['data']
+    r.raise_for_status()
+    data = r.json()
+    if cache is not None:
+        cache.store(video_type, page_number, data, r)
+    return data
 
 
 def extract_data(page_data):
@@ -35,7 +67,7 @@ def extract_data(page_data):
     """
     extracted_data = {}
     # loop through all cid in this page
-    for file in page_data['hits']:
+    for file in page_data.get('hits') or []:
         cid = file['hash']
         # first_seen = file['first-seen']
         # score = file['score']
@@ -48,83 +80,125 @@ def extract_data(page_data):
     return extracted_data
 
 
-def main(dir_prefix):
-    video_types = ['mp4', 'webm', 'ogg', 'quicktime', 'mpeg', 'x-msvideo', 'x-ms-wmv']
-    now = datetime.datetime.now()
+def new_crawler(api_url=API_URL, cache=None, **kwargs):
+    """
+    create a crawler paging through the ipfs-search api
+    :param api_url: search endpoint
+    :param cache: PageCache to record or replay pages
+    :param kwargs: Crawler tuning options, i.e. max_workers, per_type, rate
+    :return: Crawler
+    """
+    return Crawler(lambda session, v_type, page: get_page_data(v_type, page, session=session, api_url=api_url,
+                                                               cache=cache),
+                   cached=cache.lookup if cache is not None else None, **kwargs)
+
+
+def main(dir_prefix, crawler=None, compress=False, dispatcher=None, max_resumes=MAX_RESUMES):
+    video_types = VIDEO_TYPES
+    os.makedirs(dir_prefix, exist_ok=True)
+    # resume an interrupted crawl under the hour it started, else start a new one
+    checkpoint = Checkpoint(os.path.join(dir_prefix, 'crawl_checkpoint.jsonl'),
+                            datetime.datetime.now().strftime("%Y-%m-%d-%H"), max_resumes=max_resumes)
+    if checkpoint.given_up:
+        print(f'crawl resumed {max_resumes} times, giving up on pages {checkpoint.given_up}')
+    now = datetime.datetime.strptime(checkpoint.label, "%Y-%m-%d-%H")
     current_day = now.strftime("%Y-%m-%d")
-    # fresh file cid
-    fresh_file_cids = []
+    # number of fresh file cid
+    fresh_count = 0
 
     # save data config
     folder_name = now.strftime("%Y-%m-%d")
-    file_name = f'{now.strftime("%Y-%m-%d-%H")}.json'
+    file_name = f'{now.strftime("%Y-%m-%d-%H")}'
     folder_path = os.path.join(dir_prefix, folder_name)
+    cid_path = os.path.join(folder_path, f'{file_name}_cid.txt')
 
     # create dir if not exist
     os.makedirs(folder_path, exist_ok=True)
-    all_files = {}
+    # only cids are kept in memory, hit records are streamed to <hour>.jsonl as pages arrive
+    all_files = checkpoint.cids
+    if checkpoint.resumed:
+        print(f'resuming crawl {checkpoint.label} with {len(all_files)} files collected')
 
-    # load daily global fresh file
+    # load the index of every cid seen so far, all_video_cid.txt is kept in sync with it
     global_path = os.path.join(dir_prefix, f'all_video_cid.txt')
-    all_daily_fresh_file = pathlib.Path(global_path)
-    all_daily_cids = []
-    if all_daily_fresh_file.is_file():
-        # case we have global files
-        with open(all_daily_fresh_file, 'r') as fin:
-            for line in fin:
-                all_daily_cids.append(line.replace("\n", ""))
-    # collecting data
-    for v_type in video_types:
-        initial_data = get_page_data(v_type, page_number=0)
-        total_page_number = initial_data['page_count']
-        all_files.update(extract_data(initial_data))
-        # due to ipfs-search api limit, only allowed 100 paging
-        total_page_number = 100
-        # start page number 1
-        page_number = 1
-        while page_number <= total_page_number:
-            print(f'{v_type} {page_number}')
-            page_data = get_page_data(v_type, page_number)
-            page_number += 1
-            all_files.update(extract_data(page_data))
-    # filter and store fresh file
-    for key, value in all_files.items():
-        if key not in all_daily_cids:
-            # case of true fresh file
-            fresh_file_cids.append(key)
-    # save record
-    file_name = f'{now.strftime("%Y-%m-%d-%H")}_cid.txt'
-    path = os.path.join(dir_prefix, folder_name, file_name)
-    if len(fresh_file_cids) > 0:
-        # save record
-        file_name_json = f'{now.strftime("%Y-%m-%d-%H")}.json'
-        file_path = os.path.join(dir_prefix, folder_name, file_name_json)
-        with open(file_path, 'w') as fout:
-            json.dump(all_files, fout)
-        # store file
-        with open(path, 'w') as fout:
-            for cid in fresh_file_cids:
-                fout.write(cid + '\n')
-        # update all daily fresh file cid
-        with open(all_daily_fresh_file, 'a') as fout:
-            for cid in fresh_file_cids:
-                fout.write(cid + '\n')
-    else:
-        exit(0)
+    index_path = os.path.join(dir_prefix, 'all_video_cid.sqlite')
+    seen_index = CidIndex(index_path, legacy_path=global_path)
+    hit_writer = HitWriter(os.path.join(folder_path, file_name), index_path, compress=compress)
+    # collecting data, pages of all types are fetched concurrently
+    if crawler is None:
+        crawler = new_crawler()
+    for v_type, page_number, page_data in crawler.crawl(video_types, checkpoint=checkpoint):
+        print(f'{v_type} {page_number}')
+        if page_data is None:
+            # case all retries failed, skip the page, a resumed crawl tries it again unless no retry can help
+            if (v_type, page_number) not in crawler.unretryable:
+                checkpoint.record_failed(v_type, page_number)
+            crawler.mark_page(v_type, page_number, False)
+            continue
+        page_files = extract_data(page_data)
+        fresh_file_cids = seen_index.filter_new(page_files.keys())
+        hit_writer.write_page(page_files)
+        if fresh_file_cids:
+            # store fresh file cid as soon as they are found
+            with open(cid_path, 'a') as fout:
+                for cid in fresh_file_cids:
+                    fout.write(cid + '\n')
+            seen_index.add(fresh_file_cids, first_seen=file_name)
+            fresh_count += len(fresh_file_cids)
+            # start measurement right away instead of after the crawl
+            if dispatcher is not None:
+                for cid in fresh_file_cids:
+                    dispatcher.send(cid, page_files[cid].get('mimetype') or 'video')
+                dispatcher.flush()
+        all_files.update(dict.fromkeys(page_files))
+        checkpoint.record_page(v_type, page_number, page_files,
+                               crawler.last_page(page_data) if page_number == 0 else None)
+        # incremental mode, a page with only known cids counts towards stopping the type
+        if crawler.mark_page(v_type, page_number, len(fresh_file_cids) == 0):
+            print(f'{v_type} stopped, no fresh cid in {crawler.stop_after} pages in a row')
+            checkpoint.record_stop(v_type)
+    hit_writer.close()
+    seen_index.close()
+    if dispatcher is not None:
+        dispatcher.close()
+        print(f'{dispatcher.delivered} cid sent to extract server, {len(dispatcher.pending)} undelivered')
+    print(f'crawl stats {dict(crawler.stats)}, {hit_writer.written} new or changed hits, {fresh_count} fresh cid')
+    if not checkpoint.finish():
+        print(f'{len(checkpoint.retry_pages())} pages failed, run again to resume crawl {checkpoint.label} '
+              f'from {checkpoint.path}')
 
 
 if __name__ == '__main__':
     # start parser
-    # parser = argparse.ArgumentParser()
-    # parser.add_argument('-n', '--new', type=int, help="if specified new collecting, value represents collecting period "
-    #                                                   "(days)")
-    # args = parser.parse_args()
-    # if args.new:
-    #     duration = args.new
-    #     if duration < 1:
-    #         print("Error, duration cannot be less than 1 days")
-    #         exit(1)
-    # else:
-    #     duration = 0
-    prefix = './data'
-    main(prefix)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-o', '--output', type=str, default='./data', help="output directory")
+    parser.add_argument('--api', type=str, default=API_URL, help="ipfs-search api url")
+    parser.add_argument('-w', '--workers', type=int, default=16, help="total concurrent requests")
+    parser.add_argument('--per-type', type=int, default=4, help="concurrent requests per mime type")
+    parser.add_argument('--rate', type=float, default=10.0, help="api calls per second")
+    parser.add_argument('--burst', type=int, default=10, help="burst size of the rate limiter")
+    parser.add_argument('--retries', type=int, default=5, help="retries per failed page")
+    parser.add_argument('-z', '--compress', action='store_true', help="gzip the hourly hit records")
+    parser.add_argument('--dispatch', type=str, help="send fresh cid to the extract server at HOST:PORT")
+    parser.add_argument('--cache', type=str, help="record api pages into this directory")
+    parser.add_argument('--cache-ttl', type=float, default=600, help="seconds a recorded page is reused")
+    parser.add_argument('--offline', action='store_true', help="replay recorded pages only, needs --cache")
+    parser.add_argument('--max-resumes', type=int, default=MAX_RESUMES,
+                        help="runs resuming a crawl with failed pages before they are given up on")
+    parser.add_argument('--stop-after', type=int, default=0,
+                        help="incremental mode, stop paging a type after this many pages without fresh cid")
+    args = parser.parse_args()
+    prefix = args.output
+    cache = None
+    if args.cache:
+        cache = PageCache(args.cache, ttl=args.cache_ttl, mode=REPLAY if args.offline else RECORD)
+    elif args.offline:
+        parser.error('--offline needs --cache')
+    dispatcher = None
+    if args.dispatch:
+        host, port = args.dispatch.rsplit(':', 1)
+        os.makedirs(prefix, exist_ok=True)
+        dispatcher = ExtractClient(host, int(port), journal=os.path.join(prefix, 'undelivered_cid.jsonl'))
+    main(prefix, new_crawler(args.api, cache=cache, max_workers=args.workers, per_type=args.per_type, rate=args.rate,
+                             burst=args.burst, retries=args.retries, stop_after=args.stop_after),
+         compress=args.compress, dispatcher=dispatcher, max_resumes=args.max_resumes)
@@ -0,0 +1,386 @@
+import collections
+import concurrent.futures
+import json
+import os
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# ipfs-search api only allows paging up to page 100
+MAX_PAGE = 100
+# status codes worth another try, everything else fails the page right away
+RETRY_STATUS = {429, 500, 502, 503, 504}
+# runs resuming the same crawl before its failed pages are given up on
+MAX_RESUMES = 3
+
+
+class TokenBucket:
+    """
+    thread safe token bucket, every api call takes one token
+    """
+
+    def __init__(self, rate, capacity):
+        """
+        :param rate: tokens refilled per second
+        :param capacity: maximum burst size
+        """
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.last = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        block until a token is available
+        :return: None
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now >= self.paused_until:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                    self.last = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+                else:
+                    wait = self.paused_until - now
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """
+        stop handing out tokens for a while, e.g. when the api answers 429
+        :param seconds: pause duration
+        :return: None
+        """
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+            self.last = self.paused_until
+
+
+class PageError(Exception):
+    def __init__(self, message, retry_after=None, retry=True):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.retry = retry
+
+
+def new_session(pool_size):
+    """
+    create a keep-alive session whose connection pool fits all workers
+    :param pool_size: max number of pooled connections
+    :return: requests.Session
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class Checkpoint:
+    """
+    append-only log of the pages a crawl has finished, so a crashed run can resume
+
+    The first line holds the crawl label (the hour it started), then one line per
+    finished page with its cids, one line per page whose retries all failed, and one
+    line per mime type that stopped early. Failed pages are not finished, a resumed
+    crawl fetches them again. Every resume appends the label again with its count, once
+    max_resumes runs resumed the crawl its failed pages are given up on and a new crawl
+    starts under the new label.
+    """
+
+    def __init__(self, path, label, max_resumes=MAX_RESUMES):
+        """
+        :param path: checkpoint file
+        :param label: label of a new crawl, replaced by the stored one when resuming
+        :param max_resumes: runs resuming the crawl before it is dropped
+        """
+        self.path = path
+        self.label = label
+        self.resumes = 0
+        # (type, page) failed in the dropped crawl
+        self.given_up = []
+        self.done = collections.defaultdict(set)
+        self.last_page = {}
+        self.stopped = set()
+        # (type, page) failed and not finished since
+        self.failed = set()
+        # dict as an insertion ordered set
+        self.cids = {}
+        self.resumed = os.path.isfile(path)
+        if self.resumed:
+            self.load()
+            if self.resumes >= max_resumes:
+                self.given_up = self.retry_pages()
+                self.reset(label)
+        if self.resumed:
+            self.resumes += 1
+            self.fout = open(path, 'a')
+            self.write({'label': self.label, 'resumes': self.resumes})
+        else:
+            self.fout = open(path, 'w')
+            self.write({'label': label})
+
+    def load(self):
+        with open(self.path, 'r') as fin:
+            for line in fin:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # case of a line cut short by the crash
+                    continue
+                if 'label' in record:
+                    self.label = record['label']
+                    self.resumes = record.get('resumes', 0)
+                elif record.get('stopped'):
+                    self.stopped.add(record['type'])
+                elif record.get('failed'):
+                    self.failed.add((record['type'], record['page']))
+                else:
+                    self.failed.discard((record['type'], record['page']))
+                    self.done[record['type']].add(record['page'])
+                    if record.get('last_page') is not None:
+                        self.last_page[record['type']] = record['last_page']
+                    self.cids.update(dict.fromkeys(record['cids']))
+
+    def reset(self, label):
+        """
+        forget the stored crawl, a new one starts under label
+        :param label: label of the new crawl
+        :return: None
+        """
+        self.label = label
+        self.resumes = 0
+        self.done.clear()
+        self.last_page.clear()
+        self.stopped.clear()
+        self.failed.clear()
+        self.cids.clear()
+        self.resumed = False
+
+    def write(self, record):
+        self.fout.write(json.dumps(record) + '\n')
+        self.fout.flush()
+
+    def record_page(self, video_type, page_number, cids, last_page=None):
+        """
+        :param video_type: video mime type
+        :param page_number: finished page
+        :param cids: cids found on the page
+        :param last_page: last page of the type, known from page 0
+        :return: None
+        """
+        self.failed.discard((video_type, page_number))
+        self.write({'type': video_type, 'page': page_number, 'last_page': last_page, 'cids': list(cids)})
+
+    def record_failed(self, video_type, page_number):
+        """
+        :param video_type: video mime type
+        :param page_number: page whose retries all failed, e.g. rate limited, not one that cannot succeed
+        :return: None
+        """
+        self.failed.add((video_type, page_number))
+        self.write({'type': video_type, 'page': page_number, 'failed': True})
+
+    def record_stop(self, video_type):
+        self.stopped.add(video_type)
+        self.write({'type': video_type, 'stopped': True})
+
+    def retry_pages(self):
+        """
+        :return: sorted (type, page) of the failed pages a resumed crawl would fetch again
+        """
+        return sorted(page for page in self.failed if page[0] not in self.stopped)
+
+    def finish(self):
+        """
+        crawl over, drop the checkpoint unless pages failed, then it is kept to resume from
+        :return: True if the checkpoint was dropped
+        """
+        self.fout.close()
+        if self.retry_pages():
+            return False
+        os.remove(self.path)
+        return True
+
+
+class Crawler:
+    """
+    concurrent pager over the ipfs-search api
+
+    fetch(session, video_type, page_number) must return the page json or raise.
+    cached(video_type, page_number), if given, is asked first and may return the
+    page json without spending a token.
+    Page 0 of every mime type is fetched first, its page_count decides how many
+    more pages are queued.
+    """
+
+    def __init__(self, fetch, max_workers=16, per_type=4, rate=10.0, burst=10, retries=5, backoff=0.5,
+                 max_page=MAX_PAGE, stop_after=0, cached=None):
+        """
+        :param fetch: callable doing a single page request
+        :param max_workers: total concurrent requests
+        :param per_type: concurrent requests per mime type
+        :param rate: api calls per second (token bucket rate)
+        :param burst: token bucket capacity
+        :param retries: extra attempts for a failed page
+        :param backoff: base of the exponential backoff in seconds
+        :param max_page: last page to fetch
+        :param stop_after: stop paging a type after this many stale pages in a row, 0 to page everything
+        :param cached: callable returning a cached page or None
+        """
+        self.fetch = fetch
+        self.max_workers = max_workers
+        self.per_type = per_type
+        self.bucket = TokenBucket(rate, burst)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_page = max_page
+        self.stop_after = stop_after
+        self.cached = cached
+        self.session = new_session(max_workers)
+        self.stats = collections.Counter()
+        # (type, page) failed with an error no retry can fix, e.g. a 404
+        self.unretryable = set()
+        self.pending = {}
+        self.stopped = set()
+        # per type: stale flag of finished pages not yet folded into the run, next page to fold, stale run
+        self.page_stale = collections.defaultdict(dict)
+        self.next_page = collections.Counter()
+        self.stale_run = collections.Counter()
+
+    def fetch_page(self, video_type, page_number):
+        """
+        fetch one page with throttling and retry
+        :param video_type: video mime type
+        :param page_number: page number
+        :return: page json, None if all attempts failed or the error was not worth a retry
+        """
+        if self.cached is not None:
+            data = self.cached(video_type, page_number)
+            if data is not None:
+                self.stats['cached'] += 1
+                return data
+        for attempt in range(self.retries + 1):
+            self.bucket.acquire()
+            try:
+                data = self.fetch(self.session, video_type, page_number)
+                self.stats['pages'] += 1
+                return data
+            except (requests.RequestException, ValueError, PageError) as e:
+                retry_after = getattr(e, 'retry_after', None)
+                if retry_after:
+                    self.stats['throttled'] += 1
+                    self.bucket.pause(retry_after)
+                if not getattr(e, 'retry', True):
+                    print(f'{video_type} {page_number} failed for good: {e}')
+                    self.unretryable.add((video_type, page_number))
+                    break
+                if attempt == self.retries:
+                    print(f'{video_type} {page_number} failed: {e}')
+                    break
+                self.stats['retries'] += 1
+                delay = retry_after or self.backoff * 2 ** attempt
+                time.sleep(delay + random.uniform(0, self.backoff))
+        self.stats['failed'] += 1
+        return None
+
+    def last_page(self, first_page):
+        """
+        last page number worth fetching given page 0 of a type
+        :param first_page: json of page 0
+        :return: page number
+        """
+        page_count = (first_page or {}).get('page_count')
+        if page_count is None:
+            return self.max_page
+        return min(int(page_count) - 1, self.max_page)
+
+    def stop_type(self, video_type):
+        """
+        queue no more pages of a type, pages already in flight still complete
+        :param video_type: video mime type
+        :return: None
+        """
+        self.stopped.add(video_type)
+        if video_type in self.pending:
+            self.stats['skipped'] += len(self.pending[video_type])
+            self.pending[video_type].clear()
+
+    def mark_page(self, video_type, page_number, stale):
+        """
+        report whether a page held fresh CIDs, pages are folded in page order
+        :param video_type: video mime type
+        :param page_number: finished page
+        :param stale: True if the page had no fresh CIDs
+        :return: True if the type was stopped by this page
+        """
+        states = self.page_stale[video_type]
+        states[page_number] = stale
+        while self.next_page[video_type] in states:
+            if states.pop(self.next_page[video_type]):
+                self.stale_run[video_type] += 1
+            else:
+                self.stale_run[video_type] = 0
+            self.next_page[video_type] += 1
+        if self.stop_after and self.stale_run[video_type] >= self.stop_after and video_type not in self.stopped:
+            self.stop_type(video_type)
+            return True
+        return False
+
+    def crawl(self, video_types, checkpoint=None):
+        """
+        crawl all pages of all mime types
+        :param video_types: list of video mime types
+        :param checkpoint: Checkpoint of an interrupted crawl, its finished pages are skipped
+        :return: generator of (video_type, page_number, page json or None) in completion order
+        """
+        done = checkpoint.done if checkpoint is not None else {}
+        self.pending = {}
+        for v_type in video_types:
+            if checkpoint is not None and v_type in checkpoint.stopped:
+                self.stopped.add(v_type)
+                continue
+            pages = done.get(v_type, set())
+            for page_number in pages:
+                # finished before the crash, fresh or not is unknown so it breaks the stale run
+                self.mark_page(v_type, page_number, False)
+            if 0 in pages and v_type in checkpoint.last_page:
+                queue = range(1, checkpoint.last_page[v_type] + 1)
+            else:
+                queue = [0]
+            self.pending[v_type] = collections.deque(p for p in queue if p not in pages)
+        pending = self.pending
+        running = collections.Counter()
+        in_flight = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+
+            def fill():
+                for v_type, pages in pending.items():
+                    while pages and running[v_type] < self.per_type and len(in_flight) < self.max_workers:
+                        page_number = pages.popleft()
+                        future = pool.submit(self.fetch_page, v_type, page_number)
+                        in_flight[future] = (v_type, page_number)
+                        running[v_type] += 1
+
+            fill()
+            while in_flight:
+                done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    v_type, page_number = in_flight.pop(future)
+                    running[v_type] -= 1
+                    page_data = future.result()
+                    if page_number == 0 and v_type not in self.stopped:
+                        pages = set(checkpoint.done.get(v_type, ())) if checkpoint is not None else set()
+                        pending[v_type].extend(p for p in range(1, self.last_page(page_data) + 1)
+                                               if p not in pages)
+                    yield v_type, page_number, page_data
+                fill()
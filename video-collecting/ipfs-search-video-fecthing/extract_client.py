@@ -0,0 +1,160 @@
+import argparse
+import json
+import os
+import select
+import socket
+import struct
+import time
+
+HOST = '127.0.0.1'
+PORT = 29998
+
+
+def frame(message):
+    """
+    msgio frame, 4-byte big-endian length then the message, as read by msgio.NewReader in server.go
+    :param message: bytes
+    :return: framed bytes
+    """
+    return struct.pack('>I', len(message)) + message
+
+
+class ExtractClient:
+    """
+    send wanted CIDs to the extract server over one persistent connection
+
+    CIDs are buffered and written in batches. The frames of a batch that fails are
+    resent after reconnecting, and CIDs still undelivered on close are kept in the journal file
+    and resent by the next client opened on it.
+    """
+
+    def __init__(self, host=HOST, port=PORT, batch_size=64, retries=5, backoff=0.5, journal=None):
+        """
+        :param host: extract server host
+        :param port: extract server port
+        :param batch_size: frames buffered before a write
+        :param retries: reconnect attempts per batch
+        :param backoff: base of the exponential backoff in seconds
+        :param journal: file keeping undelivered cids between runs, None to drop them
+        """
+        self.address = (host, port)
+        self.batch_size = batch_size
+        self.retries = retries
+        self.backoff = backoff
+        self.journal = journal
+        self.sock = None
+        self.pending = []
+        self.delivered = 0
+        if journal is not None and os.path.isfile(journal):
+            with open(journal, 'r') as fin:
+                for line in fin:
+                    line = line.strip()
+                    if line:
+                        self.pending.append(json.loads(line))
+            if self.pending:
+                print(f'resending {len(self.pending)} undelivered cid')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def connect(self):
+        self.sock = socket.create_connection(self.address, timeout=30)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def disconnect(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def alive(self):
+        """
+        the server never writes back, so a readable socket means it was closed or reset
+        :return: True if the connection looks usable
+        """
+        if self.sock is None:
+            return False
+        readable, _, _ = select.select([self.sock], [], [], 0)
+        if not readable:
+            return True
+        try:
+            return self.sock.recv(1, socket.MSG_PEEK) != b''
+        except OSError:
+            return False
+
+    def send(self, cid, file_type='video'):
+        """
+        queue a cid, written once the batch is full
+        :param cid: cid to measure
+        :param file_type: file type reported to the server
+        :return: None
+        """
+        self.pending.append({'cid': cid, 'type': file_type})
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        write all queued frames, reconnecting with backoff on failure
+
+        Frames are dropped from pending once fully written, a reconnect resends only the
+        frames the old connection did not take, a frame cut halfway is resent whole.
+        :return: True if everything queued was delivered
+        """
+        for attempt in range(self.retries + 1):
+            if not self.pending:
+                return True
+            frames = [frame(json.dumps(message).encode('utf-8')) for message in self.pending]
+            payload = memoryview(b''.join(frames))
+            offset = 0
+            try:
+                if not self.alive():
+                    self.disconnect()
+                    self.connect()
+                while frames:
+                    offset += self.sock.send(payload[offset:])
+                    while frames and len(frames[0]) <= offset:
+                        offset -= len(frames[0])
+                        payload = payload[len(frames.pop(0)):]
+                        self.pending.pop(0)
+                        self.delivered += 1
+                return True
+            except OSError as e:
+                print(f'extract server {self.address[0]}:{self.address[1]} error {e}')
+                self.disconnect()
+                if attempt < self.retries:
+                    time.sleep(self.backoff * 2 ** attempt)
+        return not self.pending
+
+    def close(self):
+        """
+        flush and close, cids that could not be delivered go to the journal
+        :return: None
+        """
+        self.flush()
+        self.disconnect()
+        if self.journal is None:
+            return
+        if self.pending:
+            with open(self.journal, 'w') as fout:
+                for message in self.pending:
+                    fout.write(json.dumps(message) + '\n')
+        elif os.path.isfile(self.journal):
+            os.remove(self.journal)
+
+
+if __name__ == '__main__':
+    # same as ./ipfs-search-video-fetch -i FILE_PATH
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--input', type=str, help="file with one cid per line", required=True)
+    parser.add_argument('--host', type=str, default=HOST, help="extract server host")
+    parser.add_argument('-p', '--port', type=int, default=PORT, help="extract server port")
+    args = parser.parse_args()
+    with ExtractClient(args.host, args.port) as client, open(args.input, 'r') as fin:
+        for line in fin:
+            line = line.strip()
+            if line:
+                client.send(line)
+    print(f'{client.delivered} cid delivered, {len(client.pending)} undelivered')
@@ -0,0 +1,123 @@
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import re
+import sqlite3
+
+# fields that change with the query rather than with the file, ignored when deciding a hit changed
+IGNORED_FIELDS = ('score',)
+HOUR_FILE = re.compile(r'^(\d{4}-\d{2}-\d{2}-\d{2})\.(jsonl\.gz|jsonl|json)$')
+
+
+def hit_digest(hit):
+    """
+    fingerprint of a hit record
+    :param hit: hit json from ipfs-search
+    :return: hex digest
+    """
+    data = {key: value for key, value in hit.items() if key not in IGNORED_FIELDS}
+    return hashlib.blake2b(json.dumps(data, sort_keys=True).encode('utf-8'), digest_size=16).hexdigest()
+
+
+class HitWriter:
+    """
+    append the hits of one crawl hour as JSON Lines, skipping records already written unchanged by earlier hours
+    """
+
+    def __init__(self, path, digest_db, compress=False):
+        """
+        :param path: output file without extension, e.g. data/2022-02-19/2022-02-19-01
+        :param digest_db: sqlite file remembering the last written digest of every cid
+        :param compress: gzip the output
+        """
+        self.path = f'{path}.jsonl.gz' if compress else f'{path}.jsonl'
+        self.db = sqlite3.connect(digest_db, timeout=60)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS hit_digest (cid TEXT PRIMARY KEY, digest TEXT) WITHOUT ROWID')
+        self.db.commit()
+        # gzip in append mode adds a new member per open, readers see one stream
+        self.fout = gzip.open(self.path, 'at') if compress else open(self.path, 'a')
+        self.written = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.fout.close()
+        self.db.close()
+
+    def write_page(self, hits):
+        """
+        append new or changed hits of a page
+        :param hits: dict {cid : hit}
+        :return: number of records written
+        """
+        digests = {cid: hit_digest(hit) for cid, hit in hits.items()}
+        if not digests:
+            return 0
+        cids = list(digests.keys())
+        known = dict(self.db.execute(
+            f'SELECT cid, digest FROM hit_digest WHERE cid IN ({",".join("?" * len(cids))})', cids))
+        changed = [cid for cid in cids if known.get(cid) != digests[cid]]
+        for cid in changed:
+            self.fout.write(json.dumps(hits[cid]) + '\n')
+        self.fout.flush()
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO hit_digest VALUES (?, ?)',
+                                [(cid, digests[cid]) for cid in changed])
+        self.written += len(changed)
+        return len(changed)
+
+
+def iter_hours(dir_prefix):
+    """
+    list the hourly hit files under the data directory, oldest first
+    :param dir_prefix: data directory of collect_data
+    :return: generator of (hour label, path)
+    """
+    for day in sorted(os.listdir(dir_prefix)):
+        day_path = os.path.join(dir_prefix, day)
+        if not os.path.isdir(day_path):
+            continue
+        for name in sorted(os.listdir(day_path)):
+            match = HOUR_FILE.match(name)
+            if match:
+                yield match.group(1), os.path.join(day_path, name)
+
+
+def iter_hits(dir_prefix, start=None, end=None):
+    """
+    lazily iterate the hit records of all hours, also reads the old one-dict-per-hour json dumps
+    :param dir_prefix: data directory of collect_data
+    :param start: first hour label to include, e.g. 2022-02-19-00
+    :param end: last hour label to include
+    :return: generator of (hour label, hit)
+    """
+    for label, path in iter_hours(dir_prefix):
+        if (start is not None and label < start) or (end is not None and label > end):
+            continue
+        if path.endswith('.json'):
+            with open(path, 'r') as fin:
+                for hit in json.load(fin).values():
+                    yield label, hit
+            continue
+        with (gzip.open(path, 'rt') if path.endswith('.gz') else open(path, 'r')) as fin:
+            for line in fin:
+                if line.strip():
+                    yield label, json.loads(line)
+
+
+if __name__ == '__main__':
+    # dump hit records as JSON Lines, e.g. python hit_log.py data --start 2022-02-19-00 | jq .hash
+    parser = argparse.ArgumentParser()
+    parser.add_argument('directory', type=str, help="data directory of collect_data")
+    parser.add_argument('--start', type=str, help="first hour, e.g. 2022-02-19-00")
+    parser.add_argument('--end', type=str, help="last hour, e.g. 2022-02-19-23")
+    args = parser.parse_args()
+    for _, record in iter_hits(args.directory, args.start, args.end):
+        print(json.dumps(record))
@@ -0,0 +1,94 @@
+import json
+import os
+import time
+
+RECORD = 'record'
+REPLAY = 'replay'
+
+
+class PageCache:
+    """
+    on-disk cache of api pages, one json file per mime type and page
+
+    In record mode a page younger than the ttl is served from disk, an older one is
+    revalidated with If-None-Match/If-Modified-Since when the server gave an ETag or
+    Last-Modified, and fetched again otherwise. Replay mode never touches the network.
+    """
+
+    def __init__(self, directory, ttl=600, mode=RECORD):
+        """
+        :param directory: cache directory
+        :param ttl: seconds a recorded page is served without asking the server
+        :param mode: RECORD or REPLAY
+        """
+        self.directory = directory
+        self.ttl = ttl
+        self.mode = mode
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, video_type, page_number):
+        return os.path.join(self.directory, video_type, f'{page_number}.json')
+
+    def load(self, video_type, page_number):
+        """
+        :param video_type: video mime type
+        :param page_number: page number
+        :return: cache entry dict, None if not recorded
+        """
+        try:
+            with open(self.path(video_type, page_number), 'r') as fin:
+                return json.load(fin)
+        except (OSError, ValueError):
+            return None
+
+    def fresh(self, entry):
+        return self.mode == REPLAY or time.time() - entry['fetched'] < self.ttl
+
+    def lookup(self, video_type, page_number):
+        """
+        page served without a request
+        :param video_type: video mime type
+        :param page_number: page number
+        :return: page json, None if missing or expired
+        """
+        entry = self.load(video_type, page_number)
+        if entry is not None and self.fresh(entry):
+            return entry['data']
+        return None
+
+    def validators(self, entry):
+        """
+        conditional request headers for a stale entry
+        :param entry: cache entry
+        :return: dict of headers
+        """
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def store(self, video_type, page_number, data, response=None, previous=None):
+        """
+        record a page, written to a temp file first so readers never see half an entry
+        :param video_type: video mime type
+        :param page_number: page number
+        :param data: page json
+        :param response: http response the page came from, for its validators
+        :param previous: entry revalidated by a 304, its validators are kept if the response has none
+        :return: None
+        """
+        entry = {'fetched': time.time(), 'data': data, 'etag': None, 'last_modified': None}
+        if previous is not None:
+            entry['etag'] = previous.get('etag')
+            entry['last_modified'] = previous.get('last_modified')
+        if response is not None:
+            entry['etag'] = response.headers.get('ETag') or entry['etag']
+            entry['last_modified'] = response.headers.get('Last-Modified') or entry['last_modified']
+        path = self.path(video_type, page_number)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.{id(entry)}.tmp'
+        with open(tmp_path, 'w') as fout:
+            json.dump(entry, fout)
+        os.replace(tmp_path, path)
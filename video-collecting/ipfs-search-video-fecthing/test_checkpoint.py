@@ -0,0 +1,69 @@
+import contextlib
+import datetime
+import io
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import collect_data
+from crawler import Crawler, PageError
+
+
+def fetch_failing(page, retry):
+    """
+    :return: fetch of a 2 page crawl whose given page of video/mp4 always fails
+    """
+    def fetch(session, video_type, page_number):
+        if (video_type, page_number) == ('mp4', page):
+            raise PageError('status 404' if not retry else 'status 503', retry=retry)
+        return {'page_count': 2, 'hits': [{'hash': f'{video_type}-{page_number}'}]}
+    return fetch
+
+
+class Hour(datetime.datetime):
+    hour = '2026-10-18-10'
+
+    @classmethod
+    def now(cls, tz=None):
+        return cls.strptime(cls.hour, '%Y-%m-%d-%H')
+
+
+class CheckpointTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'crawl_checkpoint.jsonl')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def run_crawl(self, hour, fetch, max_resumes=2):
+        """
+        :return: label of the checkpoint kept by the crawl, None if it was dropped
+        """
+        Hour.hour = hour
+        with mock.patch.object(collect_data.datetime, 'datetime', Hour), contextlib.redirect_stdout(io.StringIO()):
+            collect_data.main(self.tmp.name, Crawler(fetch, retries=0, backoff=0, rate=1000, burst=1000),
+                              max_resumes=max_resumes)
+        if not os.path.isfile(self.path):
+            return None
+        with open(self.path, 'r') as fin:
+            return json.loads(fin.readline())['label']
+
+    def test_unretryable_page_not_resumed(self):
+        self.assertIsNone(self.run_crawl('2026-10-18-10', fetch_failing(1, retry=False)))
+
+    def test_failing_page_given_up(self):
+        fetch = fetch_failing(1, retry=True)
+        self.assertEqual(self.run_crawl('2026-10-18-10', fetch), '2026-10-18-10')
+        # resumed under the hour it started
+        for hour in ('2026-10-18-11', '2026-10-18-12'):
+            self.assertEqual(self.run_crawl(hour, fetch), '2026-10-18-10')
+        # out of resumes, the page is given up on and the new hour is crawled
+        self.assertEqual(self.run_crawl('2026-10-18-13', fetch), '2026-10-18-13')
+        self.assertTrue(os.path.isfile(os.path.join(self.tmp.name, '2026-10-18', '2026-10-18-13.jsonl')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,445 @@
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import sqlite3
+import sys
+import time
+
+import numpy as np
+
+import summary_json
+
+PERCENTILES = (50, 90, 95, 99)
+# rtt in ms the cdf is evaluated at
+RTT_GRID = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+ROLES = ('provider', 'actual')
+# bumped when the arrays of a snapshot change
+SNAPSHOT_VERSION = 2
+UNKNOWN_TYPE = 'unknown'
+# result store record.py keeps in the output root, as result_store.open_store
+STORE = 'results.sqlite'
+
+
+def to_number(value, minimum=0.0):
+    """
+    summaries keep the numbers the way record.py parsed them, strings included
+    :return: float, nan when missing, i.e. below minimum like num_blocks -1 or download_time 0
+    """
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return np.nan
+    return value if value >= minimum else np.nan
+
+
+def to_hop(value):
+    """
+    :return: int hop count, -1 when missing
+    """
+    return -1 if value is None else int(value)
+
+
+class Summaries:
+    """
+    every Stats summary as flat numpy arrays
+
+    stats arrays have one row per cid, address arrays one row per multiaddr with the
+    row of its cid in addr_cid and a peer number in addr_peer, distribution arrays one
+    row per (cid, hop) of ipfs_hop_distribution. Missing numbers are nan, missing hops -1.
+    """
+
+    STATS = {'mime': np.int32, 'ipfs_hop': np.int16, 'ipfs_hop_min': np.int16, 'num_blocks': np.float64,
+             'content_size': np.float64, 'resolve_time': np.float64, 'download_time': np.float64}
+    ADDRESS = {'addr_cid': np.int64, 'addr_peer': np.int64, 'addr_role': np.int8, 'addr_rtt': np.float64,
+               'addr_ip_hop': np.float64}
+    DISTRIBUTION = {'dist_cid': np.int64, 'dist_hop': np.int16, 'dist_count': np.int64}
+
+    def __init__(self, arrays, mime_types):
+        """
+        :param arrays: dic {name : array} of the STATS, ADDRESS and DISTRIBUTION arrays
+        :param mime_types: file type of each mime code
+        """
+        self.arrays = arrays
+        self.mime_types = list(mime_types)
+        for name, value in arrays.items():
+            setattr(self, name, value)
+
+    def __len__(self):
+        return len(self.ipfs_hop)
+
+    @classmethod
+    def build(cls, summaries):
+        """
+        :param summaries: iterable of summary dicts, as in cid_summary.json
+        :return: Summaries
+        """
+        columns = {name: [] for name in {**cls.STATS, **cls.ADDRESS, **cls.DISTRIBUTION}}
+        codes = {}
+        peer = 0
+        for row, summary in enumerate(summaries):
+            columns['mime'].append(codes.setdefault(summary.get('mime_type') or UNKNOWN_TYPE, len(codes)))
+            columns['ipfs_hop'].append(to_hop(summary.get('ipfs_hop')))
+            columns['ipfs_hop_min'].append(to_hop(summary.get('ipfs_hop_min')))
+            columns['num_blocks'].append(to_number(summary.get('num_blocks')))
+            columns['content_size'].append(to_number(summary.get('content_size'), 1))
+            columns['resolve_time'].append(to_number(summary.get('resolve_time'), 1e-9))
+            columns['download_time'].append(to_number(summary.get('download_time'), 1e-9))
+            for role, key in enumerate(('providers', 'actual_provider')):
+                for addresses in (summary.get(key) or {}).values():
+                    for address in addresses:
+                        columns['addr_cid'].append(row)
+                        columns['addr_peer'].append(peer)
+                        columns['addr_role'].append(role)
+                        columns['addr_rtt'].append(to_number(address.get('rtt')))
+                        columns['addr_ip_hop'].append(to_number(address.get('ip_hop')))
+                    peer += 1
+            for hop, count in (summary.get('ipfs_hop_distribution') or {}).items():
+                columns['dist_cid'].append(row)
+                columns['dist_hop'].append(int(hop))
+                columns['dist_count'].append(count)
+        dtypes = {**cls.STATS, **cls.ADDRESS, **cls.DISTRIBUTION}
+        return cls({name: np.array(values, dtype=dtypes[name]) for name, values in columns.items()}, codes)
+
+    @classmethod
+    def concatenate(cls, parts):
+        """
+        :param parts: Summaries list, e.g. one per source
+        :return: Summaries of all parts, rows and mime codes renumbered
+        """
+        mime_types = list(dict.fromkeys(mime for part in parts for mime in part.mime_types))
+        arrays = {name: [] for name in {**cls.STATS, **cls.ADDRESS, **cls.DISTRIBUTION}}
+        rows = peers = 0
+        for part in parts:
+            recode = np.array([mime_types.index(mime) for mime in part.mime_types] or [0], dtype=np.int32)
+            for name, value in part.arrays.items():
+                if name == 'mime':
+                    value = recode[value]
+                elif name in ('addr_cid', 'dist_cid'):
+                    value = value + rows
+                elif name == 'addr_peer':
+                    value = value + peers
+                arrays[name].append(value)
+            rows += len(part)
+            peers += int(part.addr_peer.max()) + 1 if len(part.addr_peer) else 0
+        return cls({name: np.concatenate(values) for name, values in arrays.items()}, mime_types)
+
+    def save(self, path, mtime, files):
+        """
+        write the arrays as a npz snapshot tagged with the mtime and the files of the source
+        """
+        tmp = f'{path}.{os.getpid()}.tmp.npz'
+        np.savez(tmp, version=SNAPSHOT_VERSION, mtime=mtime, files=files,
+                 mime_types=np.array(self.mime_types, dtype=str), **self.arrays)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path, mtime, files):
+        """
+        :return: Summaries of the snapshot, None when missing, stale, of other files or of another version
+        """
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                if (int(data['version']) != SNAPSHOT_VERSION or float(data['mtime']) != mtime or
+                        str(data['files']) != files):
+                    return None
+                names = {**cls.STATS, **cls.ADDRESS, **cls.DISTRIBUTION}
+                return cls({name: data[name] for name in names}, data['mime_types'].tolist())
+        except (OSError, KeyError, ValueError):
+            return None
+
+
+def read_store(path):
+    """
+    :param path: results.sqlite of result_store.py
+    :return: generator of summary dicts, providers only carry rtt and ip_hop
+    """
+    db = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    try:
+        columns = [row[1] for row in db.execute('PRAGMA table_info(stats)')]
+        mime = 'mime_type' if 'mime_type' in columns else 'NULL'
+        addresses = {}
+        for cid, role, peer, rtt, ip_hop in db.execute('SELECT cid, role, peer, rtt, ip_hop FROM address '
+                                                       'ORDER BY cid, role, peer, position'):
+            key = 'providers' if role == 'provider' else 'actual_provider'
+            addresses.setdefault(cid, {'providers': {}, 'actual_provider': {}})[key].setdefault(peer, []).append(
+                {'rtt': rtt, 'ip_hop': ip_hop})
+        for row in db.execute(f'SELECT cid, ipfs_hop, ipfs_hop_min, ipfs_hop_distribution, num_blocks, content_size, '
+                              f'resolve_time, download_time, {mime} FROM stats'):
+            summary = dict(zip(('cid', 'ipfs_hop', 'ipfs_hop_min', 'ipfs_hop_distribution', 'num_blocks',
+                                'content_size', 'resolve_time', 'download_time', 'mime_type'), row))
+            summary['ipfs_hop_distribution'] = json.loads(summary['ipfs_hop_distribution'] or '{}')
+            summary.update(addresses.pop(row[0], {}))
+            yield summary
+    finally:
+        db.close()
+
+
+def store_cids(path):
+    """
+    :param path: results.sqlite of result_store.py
+    :return: set of the cids in the store
+    """
+    db = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    try:
+        return {row[0] for row in db.execute('SELECT cid FROM stats')}
+    finally:
+        db.close()
+
+
+def summary_files(directory):
+    """
+    :return: generator of the <cid>/<cid>_summary.json paths under directory
+    """
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                path = os.path.join(entry.path, f'{entry.name}_summary.json')
+                if os.path.exists(path):
+                    yield path
+
+
+def read_directory(paths):
+    """
+    :param paths: cid_summary.json paths
+    :return: generator of summary dicts
+    """
+    for path in paths:
+        try:
+            with open(path, 'rb') as fin:
+                yield summary_json.loads(fin.read())
+        except ValueError as e:
+            print(f'Skipping {path} {e}', file=sys.stderr)
+
+
+def sources(source):
+    """
+    a directory is read through its results.sqlite, the summary files only for the cids missing from it
+    :return: (result store or None, cid_summary.json paths read besides it)
+    """
+    if not os.path.isdir(source):
+        return source, []
+    paths = list(summary_files(source))
+    store = os.path.join(source, STORE)
+    if not os.path.exists(store):
+        return None, paths
+    stored = store_cids(store)
+    return store, [path for path in paths if os.path.basename(os.path.dirname(path)) not in stored]
+
+
+def source_mtime(store, paths):
+    """
+    :return: newest mtime of the files the summaries are read from
+    """
+    mtimes = [os.stat(path).st_mtime for path in paths]
+    if store is not None:
+        # committed transactions may only be in the write ahead log, readers leave an empty one behind
+        mtimes.append(os.stat(store).st_mtime)
+        if os.path.exists(f'{store}-wal') and os.stat(f'{store}-wal').st_size:
+            mtimes.append(os.stat(f'{store}-wal').st_mtime)
+    return max(mtimes or [0.0])
+
+
+def source_files(store, paths):
+    """
+    a deleted file leaves the newest mtime as it was, the snapshot keeps the list of files it was built from
+    :return: digest of the files the summaries are read from
+    """
+    digest = hashlib.sha1()
+    for path in ([store] if store is not None else []) + sorted(paths):
+        digest.update(path.encode('utf-8') + b'\n')
+    return f'{len(paths) + (store is not None)} {digest.hexdigest()}'
+
+
+def snapshot_path(source):
+    if os.path.isdir(source):
+        return os.path.join(source, 'summaries.npz')
+    return f'{source}.npz'
+
+
+def load(source, refresh=False):
+    """
+    load the summaries of a result store or of a directory of cid directories,
+    through a snapshot next to the source rebuilt whenever the source changed
+    :param source: results.sqlite or output directory
+    :param refresh: rebuild the snapshot anyway
+    :return: Summaries
+    """
+    store, paths = sources(source)
+    mtime = source_mtime(store, paths)
+    files = source_files(store, paths)
+    snapshot = snapshot_path(source)
+    summaries = None if refresh else Summaries.load(snapshot, mtime, files)
+    if summaries is not None:
+        return summaries
+    start = time.monotonic()
+    rows = read_directory(paths)
+    if store is not None:
+        rows = itertools.chain(read_store(store), rows)
+    summaries = Summaries.build(rows)
+    print(f'Loaded {len(summaries)} summaries from {source} in {time.monotonic() - start:.1f}s', file=sys.stderr)
+    try:
+        summaries.save(snapshot, mtime, files)
+    except OSError as e:
+        print(f'Snapshot not saved {e}', file=sys.stderr)
+    return summaries
+
+
+def group_percentiles(values, groups, num_groups, percentiles=PERCENTILES):
+    """
+    percentiles of values per group in one sort, nan values left out
+    :return: (count per group, array [group, percentile]) with nan rows for empty groups
+    """
+    valid = ~np.isnan(values)
+    values, groups = values[valid], groups[valid]
+    order = np.lexsort((values, groups))
+    values, groups = values[order], groups[order]
+    counts = np.bincount(groups, minlength=num_groups)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    result = np.full((num_groups, len(percentiles)), np.nan)
+    nonempty = counts > 0
+    # linear interpolation between the closest ranks, as np.percentile
+    positions = (counts[nonempty, None] - 1) * (np.array(percentiles) / 100.0)
+    low = np.floor(positions).astype(np.int64)
+    high = np.ceil(positions).astype(np.int64)
+    base = starts[nonempty, None]
+    result[nonempty] = values[base + low] + (values[base + high] - values[base + low]) * (positions - low)
+    return counts, result
+
+
+def percentiles_by_type(summaries, fields=('resolve_time', 'download_time'), percentiles=PERCENTILES):
+    """
+    :return: dic {field : {mime type : {"count", "p50", ...}}}, all types under "all"
+    """
+    report = {}
+    num_types = len(summaries.mime_types)
+    for field in fields:
+        values = getattr(summaries, field)
+        counts, table = group_percentiles(values, summaries.mime.astype(np.int64), num_types, percentiles)
+        all_counts, all_table = group_percentiles(values, np.zeros(len(values), dtype=np.int64), 1, percentiles)
+        report[field] = {}
+        for mime, count, row in zip(summaries.mime_types + ['all'], np.append(counts, all_counts),
+                                    np.vstack((table, all_table))):
+            if count:
+                report[field][mime] = {'count': int(count), **{f'p{p}': float(v) for p, v in zip(percentiles, row)}}
+    return report
+
+
+def peer_rtts(summaries):
+    """
+    :return: (best rtt of each peer, role of each peer) over the peers with at least one address
+    """
+    if not len(summaries.addr_peer):
+        return np.array([]), np.array([], dtype=np.int8)
+    # addresses of a peer are contiguous
+    starts = np.flatnonzero(np.diff(summaries.addr_peer, prepend=-1))
+    return np.fmin.reduceat(summaries.addr_rtt, starts), summaries.addr_role[starts]
+
+
+def rtt_cdf(summaries, grid=RTT_GRID, percentiles=PERCENTILES):
+    """
+    cdf of the best rtt of the dht providers and of the actual providers, peers without rtt left out
+    :return: dic {role : {"count", "percentiles" : {p : ms}, "cdf" : {ms : fraction}}}
+    """
+    rtts, roles = peer_rtts(summaries)
+    report = {}
+    for code, role in enumerate(ROLES):
+        values = np.sort(rtts[(roles == code) & ~np.isnan(rtts)])
+        if not len(values):
+            report[role] = {'count': 0}
+            continue
+        fractions = np.searchsorted(values, grid, side='right') / len(values)
+        report[role] = {'count': len(values),
+                        'percentiles': {f'p{p}': float(v) for p, v in zip(percentiles, np.percentile(values,
+                                                                                                   percentiles))},
+                        'cdf': {str(ms): float(f) for ms, f in zip(grid, fractions)}}
+    return report
+
+
+def hop_histograms(summaries):
+    """
+    :return: dic of {hop : cids} for ipfs_hop and ipfs_hop_min, {hop : queries} for the distribution,
+             and {ip hops : addresses} of the traceroutes
+    """
+
+    def histogram(values, weights=None):
+        valid = values >= 0
+        counts = np.bincount(values[valid].astype(np.int64), weights=None if weights is None else weights[valid])
+        return {str(hop): int(count) for hop, count in enumerate(counts) if count}
+
+    ip_hops = summaries.addr_ip_hop[~np.isnan(summaries.addr_ip_hop)]
+    return {'ipfs_hop': histogram(summaries.ipfs_hop), 'ipfs_hop_min': histogram(summaries.ipfs_hop_min),
+            'ipfs_hop_distribution': histogram(summaries.dist_hop, summaries.dist_count),
+            'ip_hop': histogram(ip_hops)}
+
+
+def size_vs_download(summaries, bins_per_decade=1):
+    """
+    relationship of content size and download time over the cids with both
+    :return: dic with the log-log fit download_time = 10^intercept * size^slope, the correlation
+             and the median time and throughput per size bin
+    """
+    size, seconds = summaries.content_size, summaries.download_time
+    valid = ~np.isnan(size) & ~np.isnan(seconds)
+    size, seconds = size[valid], seconds[valid]
+    if len(size) < 2:
+        return {'count': int(len(size))}
+    log_size, log_seconds = np.log10(size), np.log10(seconds)
+    slope, intercept = np.polyfit(log_size, log_seconds, 1)
+    throughput = size / seconds
+    bins = np.floor(log_size * bins_per_decade).astype(np.int64)
+    bins -= bins.min()
+    counts, medians = group_percentiles(seconds, bins, bins.max() + 1, (50,))
+    _, throughput_medians = group_percentiles(throughput, bins, bins.max() + 1, (50,))
+    low = np.floor(log_size.min() * bins_per_decade)
+    report = {'count': int(len(size)), 'slope': float(slope), 'intercept': float(intercept),
+              'correlation': float(np.corrcoef(log_size, log_seconds)[0, 1]),
+              'throughput': {f'p{p}': float(v) for p, v in zip(PERCENTILES, np.percentile(throughput, PERCENTILES))},
+              'bins': []}
+    for index in np.flatnonzero(counts):
+        report['bins'].append({'size_from': float(10 ** ((low + index) / bins_per_decade)),
+                               'size_to': float(10 ** ((low + index + 1) / bins_per_decade)),
+                               'count': int(counts[index]), 'download_time_p50': float(medians[index, 0]),
+                               'throughput_p50': float(throughput_medians[index, 0])})
+    return report
+
+
+REPORTS = {'percentiles': percentiles_by_type, 'rtt': rtt_cdf, 'hops': hop_histograms, 'size': size_vs_download}
+
+
+def print_report(report, indent=''):
+    for key, value in report.items():
+        if isinstance(value, dict):
+            print(f'{indent}{key}')
+            print_report(value, indent + '  ')
+        elif isinstance(value, list):
+            print(f'{indent}{key}')
+            for item in value:
+                print(f'{indent}  ' + ' '.join(f'{k}={v:.4g}' if isinstance(v, float) else f'{k}={v}'
+                                               for k, v in item.items()))
+        else:
+            print(f'{indent}{key} {value:.4g}' if isinstance(value, float) else f'{indent}{key} {value}')
+
+
+if __name__ == '__main__':
+    # e.g. python3 analyse.py /out/videos/results.sqlite -r percentiles rtt
+    parser = argparse.ArgumentParser()
+    parser.add_argument('source', type=str, nargs='+',
+                        help="result database or directory of <cid>/<cid>_summary.json, read through its "
+                             "results.sqlite if any")
+    parser.add_argument('-r', '--report', type=str, nargs='*', choices=list(REPORTS), help="reports, all by default")
+    parser.add_argument('--refresh', action='store_true', help="rebuild the snapshots")
+    parser.add_argument('--json', action='store_true', help="print the reports as one json object")
+    args = parser.parse_args()
+    start = time.monotonic()
+    summaries = Summaries.concatenate([load(source, args.refresh) for source in args.source])
+    reports = {name: REPORTS[name](summaries) for name in args.report or REPORTS}
+    if args.json:
+        print(json.dumps(reports, indent=2))
+    else:
+        print(f'{len(summaries)} cids')
+        for name, report in reports.items():
+            print(name)
+            print_report(report, '  ')
+    print(f'Done in {time.monotonic() - start:.1f}s', file=sys.stderr)
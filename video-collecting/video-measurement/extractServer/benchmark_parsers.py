@@ -0,0 +1,226 @@
+import argparse
+import gc
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import record
+import synthetic_logs
+from daemon_index import DaemonLogIndex
+
+CID = 'QmSynthetic'
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+# a run this much slower or bigger than its baseline is a regression, timings are noisier than memory
+TIME_TOLERANCE = 0.5
+MEMORY_TOLERANCE = 0.2
+
+
+class Case:
+    """
+    one parser at one scale, setup writes its fixtures once, run parses them
+    """
+
+    def __init__(self, name, size, setup, run):
+        """
+        :param name: parser name
+        :param size: scale, log lines, query nodes or parsed items
+        :param setup: callable(directory) returning the argument of run
+        :param run: callable(argument)
+        """
+        self.name = name
+        self.size = size
+        self.setup = setup
+        self.run = run
+
+    @property
+    def key(self):
+        return f'{self.name}/{self.size}'
+
+
+def daemon_case(num_lines):
+    def setup(directory):
+        log_path = os.path.join(directory, 'daemon.txt')
+        with open(log_path, 'w') as fout:
+            fout.writelines(synthetic_logs.daemon_lines(num_lines))
+        # a cid measured halfway through the log
+        cids = synthetic_logs.cids_of(0, 100)
+        return log_path, cids[len(cids) // 2]
+
+    def run(argument):
+        # what main does for a cid, from an empty index
+        log_path, cid = argument
+        index_path = f'{log_path}.index.sqlite'
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(index_path + suffix):
+                os.remove(index_path + suffix)
+        index = DaemonLogIndex(log_path, index_path)
+        index.update()
+        index.find_providers(cid)
+        dict(index.block_providers(cid))
+        index.close()
+
+    return Case('daemon_index', num_lines, setup, run)
+
+
+def hops_case(num_queries):
+    def setup(directory):
+        return synthetic_logs.write_fixtures(directory, CID, num_queries=num_queries)
+
+    def run(result_host_dic):
+        record.analyse_ipfs_hops(CID, result_host_dic)
+
+    return Case('analyse_ipfs_hops', num_queries, setup, run)
+
+
+def visual_case(num_queries, top_k):
+    """
+    :param top_k: VISUAL_TOP_K of the export, 0 for the whole lookup
+    """
+
+    def setup(directory):
+        return synthetic_logs.write_fixtures(directory, CID, num_queries=num_queries)
+
+    def run(result_host_dic):
+        record.VISUAL_TOP_K = top_k
+        record.analyse_ipfs_hops(CID, result_host_dic, visual=True)
+
+    return Case(f'visual_export_top{top_k}' if top_k else 'visual_export', num_queries, setup, run)
+
+
+def file_case(name, parse, count):
+    """
+    :param parse: record.py function reading one small file of CID, run count times
+    """
+
+    def setup(directory):
+        synthetic_logs.write_fixtures(directory, CID, num_queries=10)
+
+    def run(_):
+        for _ in range(count):
+            parse(CID)
+
+    return Case(name, count, setup, run)
+
+
+def multiaddr_case(count):
+    def setup(_):
+        return synthetic_logs.multiaddrs(count)
+
+    def run(addrs):
+        for addr in addrs:
+            record.parse_multiaddr(addr)
+
+    return Case('parse_multiaddr', count, setup, run)
+
+
+def measure(case, rounds, memory):
+    """
+    :return: dic {"seconds" : best of rounds, "peak" : bytes allocated at most, None without memory}
+    """
+    directory = tempfile.mkdtemp(prefix='benchmark_parsers_')
+    try:
+        record.SAVE_DIR = directory
+        argument = case.setup(directory)
+        best = None
+        for _ in range(rounds):
+            gc.collect()
+            start = time.perf_counter()
+            case.run(argument)
+            duration = time.perf_counter() - start
+            best = duration if best is None else min(best, duration)
+        peak = None
+        if memory:
+            gc.collect()
+            tracemalloc.start()
+            case.run(argument)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        return {'seconds': best, 'peak': peak}
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def regressions(results, baseline, time_tolerance=TIME_TOLERANCE, memory_tolerance=MEMORY_TOLERANCE):
+    """
+    :param results: dic {case key : measure result}
+    :param baseline: dic {case key : measure result} saved earlier
+    :return: messages of the cases slower or bigger than their baseline allows, or without a baseline
+    """
+    messages = []
+    for key, result in results.items():
+        base = baseline.get(key)
+        if base is None:
+            messages.append(f'{key} has no baseline, run with --save first')
+            continue
+        if result['seconds'] > base['seconds'] * (1 + time_tolerance):
+            messages.append(f'{key} took {result["seconds"]:.3f}s, baseline {base["seconds"]:.3f}s')
+        if result['peak'] is not None and base.get('peak') and result['peak'] > base['peak'] * (1 + memory_tolerance):
+            messages.append(f'{key} peaked at {result["peak"] / 2 ** 20:.1f} MiB, '
+                            f'baseline {base["peak"] / 2 ** 20:.1f} MiB')
+    return messages
+
+
+def machine():
+    return f'{platform.node()} {platform.machine()} python {platform.python_version()}'
+
+
+if __name__ == '__main__':
+    # e.g. python3 benchmark_parsers.py --save once, then python3 benchmark_parsers.py fails on a regression
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lines', type=int, nargs='+', default=[1000, 100000, 1000000],
+                        help="daemon log lines, up to 10000000")
+    parser.add_argument('--queries', type=int, nargs='+', default=[10, 1000, 10000],
+                        help="query nodes of the findprovs trace, up to 50000")
+    parser.add_argument('--visual-top-k', type=int, default=40, help="queries per level of the sampled export")
+    parser.add_argument('--files', type=int, default=1000, help="storage and latency files parsed per run")
+    parser.add_argument('--multiaddrs', type=int, default=100000, help="multiaddrs parsed per run")
+    parser.add_argument('--only', type=str, nargs='*', help="parser names to run, all by default")
+    parser.add_argument('--rounds', type=int, default=3, help="timed runs per case, the best counts")
+    parser.add_argument('--no-memory', action='store_true', help="skip the traced run measuring peak memory")
+    parser.add_argument('--baseline', type=str, default=BASELINE, help="baseline file")
+    parser.add_argument('--save', action='store_true', help="store the results as the new baseline")
+    parser.add_argument('--time-tolerance', type=float, default=TIME_TOLERANCE)
+    parser.add_argument('--memory-tolerance', type=float, default=MEMORY_TOLERANCE)
+    args = parser.parse_args()
+
+    cases = ([daemon_case(lines) for lines in args.lines] + [hops_case(queries) for queries in args.queries] +
+             [visual_case(queries, 0) for queries in args.queries] +
+             [visual_case(queries, args.visual_top_k) for queries in args.queries] +
+             [file_case('analyse_storage', record.analyse_storage, args.files),
+              file_case('analyse_latency_gateway', record.analyse_latency_gateway, args.files),
+              multiaddr_case(args.multiaddrs)])
+    if args.only:
+        cases = [case for case in cases if case.name in args.only]
+    if not args.save and not os.path.exists(args.baseline):
+        # case nothing to compare with, a check that cannot fail is no check
+        parser.error(f'no baseline {args.baseline}, take one with --save on this machine first')
+    baseline = {'machine': machine(), 'results': {}}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as fin:
+            baseline = json.load(fin)
+        if baseline.get('machine') != machine():
+            print(f'Baseline was taken on {baseline.get("machine")}, this is {machine()}', file=sys.stderr)
+
+    results = {}
+    for case in cases:
+        results[case.key] = result = measure(case, args.rounds, not args.no_memory)
+        base = baseline['results'].get(case.key)
+        change = f'  {result["seconds"] / base["seconds"] - 1:+.0%} vs baseline' if base else ''
+        peak = '' if result['peak'] is None else f'{result["peak"] / 2 ** 20:9.1f} MiB'
+        print(f'{case.name:<24} {case.size:>9}  {result["seconds"]:9.3f} s {peak}{change}', flush=True)
+
+    if args.save:
+        baseline = {'machine': machine(), 'results': {**baseline['results'], **results}}
+        with open(args.baseline, 'w') as fout:
+            json.dump(baseline, fout, indent=2)
+        print(f'Saved baseline {args.baseline}')
+        sys.exit(0)
+    failed = regressions(results, baseline['results'], args.time_tolerance, args.memory_tolerance)
+    for message in failed:
+        print(f'REGRESSION {message}', file=sys.stderr)
+    sys.exit(1 if failed else 0)
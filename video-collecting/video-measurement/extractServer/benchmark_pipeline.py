@@ -0,0 +1,123 @@
+import argparse
+import concurrent.futures
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import fake_ipfs
+import result_store
+
+RECORD = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'record.py')
+
+
+def measure(cid, out_dir, daemon_log, env, mime_type='video/mp4'):
+    """
+    one record.py run as server.go starts it
+    :return: dic {"cid", "exitcode", "seconds", "cpu", "maxrss"}, cpu in seconds and maxrss in KiB
+    """
+    save_dir = os.path.join(out_dir, cid)
+    os.makedirs(save_dir, exist_ok=True)
+    start = time.monotonic()
+    process = subprocess.Popen([sys.executable, '-u', RECORD, '-c', cid, '-f', daemon_log, '-d', save_dir,
+                                '-t', mime_type], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    # wait4 reports the resource use of this child alone
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return {'cid': cid, 'exitcode': process.returncode, 'seconds': time.monotonic() - start,
+            'cpu': usage.ru_utime + usage.ru_stime, 'maxrss': usage.ru_maxrss}
+
+
+def run(scenario, concurrency, directory, sink='discard', bandwidth=0, latency=0.0):
+    """
+    measure every cid of the scenario against a fresh fake daemon, concurrency runs at once
+    :param scenario: FakeIpfs fields
+    :param directory: empty directory for the daemon log, the caches and the cid directories
+    :param sink: GATEWAY_SINK of the runs
+    :param bandwidth: gateway bytes/s of a cold fetch, 0 for unlimited
+    :param latency: gateway seconds before a cold fetch starts
+    :return: (run results, FakeIpfs after the runs, seconds for all of them)
+    """
+    daemon_log = os.path.join(directory, 'daemon.txt')
+    out_dir = os.path.join(directory, 'videos')
+    os.makedirs(out_dir)
+    open(daemon_log, 'w').close()
+    ipfs = fake_ipfs.FakeIpfs(**scenario, daemon_log=daemon_log, bandwidth=bandwidth, latency=latency)
+    server, url = fake_ipfs.start_fake_ipfs(ipfs)
+    env = dict(os.environ, IPFS_API_URL=url, IPFS_GATEWAY_URL=url, GATEWAY_SINK=sink, RESULT_STORE='on')
+    env.pop('RECORD_WORKER', None)
+    try:
+        start = time.monotonic()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+            results = list(pool.map(lambda cid: measure(cid, out_dir, daemon_log, env), scenario['traces']))
+        return results, ipfs, time.monotonic() - start
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def stage_latency(ipfs):
+    """
+    :return: dic {rpc command or gateway : seconds of each answered call}, as the fake daemon saw them
+    """
+    stages = {}
+    for cmd, _, _, seconds in ipfs.timings:
+        stages.setdefault(cmd, []).append(seconds)
+    return stages
+
+
+def report(concurrency, results, ipfs, seconds, store_path):
+    done = sum(1 for result in results if result['exitcode'] == 0)
+    stored = 0
+    if os.path.exists(store_path):
+        with result_store.ResultStore(store_path) as store:
+            stored = len(store.cids())
+    run_seconds = np.array([result['seconds'] for result in results])
+    cpu = np.array([result['cpu'] for result in results])
+    rss = np.array([result['maxrss'] for result in results]) / 1024
+    print(f'concurrency {concurrency}: {len(results)} cids in {seconds:.1f}s, {done} exited 0, {stored} stored, '
+          f'{len(results) / seconds * 3600:.0f} cids/hour')
+    print(f'  record.py  p50 {np.percentile(run_seconds, 50):7.2f}s  p95 {np.percentile(run_seconds, 95):7.2f}s  '
+          f'cpu p50 {np.percentile(cpu, 50):.2f}s  total {cpu.sum():.1f}s  '
+          f'({cpu.sum() / seconds:.2f} cores)  max rss p50 {np.percentile(rss, 50):.0f} MiB max {rss.max():.0f} MiB')
+    for stage, durations in sorted(stage_latency(ipfs).items()):
+        durations = np.array(durations)
+        print(f'  {stage:<14} calls {len(durations):6d}  p50 {np.percentile(durations, 50):7.3f}s  '
+              f'p95 {np.percentile(durations, 95):7.3f}s  total {durations.sum():8.1f}s')
+
+
+if __name__ == '__main__':
+    # e.g. python3 benchmark_pipeline.py --cids 48 --concurrency 1 4 12 --bandwidth 20000000
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cids', type=int, default=24, help="cids measured per concurrency level")
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 12],
+                        help="record.py runs at once, server.go starts up to 16")
+    parser.add_argument('--size', type=int, default=16 * 2 ** 20, help="bytes of each cid")
+    parser.add_argument('--blocks', type=int, default=64, help="blocks of each cid")
+    parser.add_argument('--queries', type=int, default=200, help="queried peers of each findprovs lookup")
+    parser.add_argument('--providers', type=int, default=5, help="providers of each cid")
+    parser.add_argument('--lookup-time', type=float, default=1.0, help="seconds of each findprovs lookup")
+    parser.add_argument('--bandwidth', type=int, default=50 * 2 ** 20,
+                        help="gateway bytes/s of a cold fetch, 0 for unlimited")
+    parser.add_argument('--latency', type=float, default=0.2, help="gateway seconds before a cold fetch starts")
+    parser.add_argument('--sink', type=str, default='discard', choices=['file', 'hash', 'discard'],
+                        help="GATEWAY_SINK of the runs")
+    parser.add_argument('--keep', action='store_true', help="keep the output directories")
+    args = parser.parse_args()
+
+    scenario = fake_ipfs.synthetic_scenario(args.cids, args.size, args.blocks, args.queries, args.providers,
+                                            args.lookup_time)
+    for concurrency in args.concurrency:
+        directory = tempfile.mkdtemp(prefix=f'benchmark_pipeline_{concurrency}_')
+        try:
+            results, ipfs, seconds = run(scenario, concurrency, directory, args.sink, args.bandwidth, args.latency)
+            report(concurrency, results, ipfs, seconds, os.path.join(directory, 'videos', 'results.sqlite'))
+        finally:
+            if args.keep:
+                print(f'  output in {directory}')
+            else:
+                shutil.rmtree(directory, ignore_errors=True)
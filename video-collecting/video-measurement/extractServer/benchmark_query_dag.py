@@ -0,0 +1,178 @@
+import argparse
+import random
+import time
+
+from query_dag import Query, Response, Provider, QueryDag, hop_summary, parse_provid_line
+
+
+def synthetic_trace(num_queries, alpha=10, k=20, known=0.5, providers=20, seed=0):
+    """
+    findprovs -v lines of a kademlia style lookup
+    :param num_queries: number of queried peers
+    :param alpha: peers queried from the dht bucket
+    :param k: peers named in every answer
+    :param known: share of the named peers that were already named before
+    :param providers: queries answering with a provider
+    :param seed: random seed
+    :return: lines, result_host_dic {provider : peer that returned it}
+    """
+    rng = random.Random(seed)
+    peer_count = 0
+
+    def new_peer():
+        nonlocal peer_count
+        peer_count += 1
+        return f'12D3KooW{peer_count:010d}'
+
+    named = []
+    pending = [new_peer() for _ in range(alpha)]
+    lines = []
+    result_host_dic = {}
+    queried = 0
+    query_index = {}
+    provider_at = set(rng.sample(range(num_queries), min(providers, num_queries)))
+    while pending and queried < num_queries:
+        # a few queries in flight, answers come back in a different order
+        batch = [pending.pop(0) for _ in range(min(alpha, len(pending), num_queries - queried))]
+        for peer in batch:
+            lines.append(f'00:00:{queried:06d}: * querying {peer}\n')
+            query_index[peer] = queried
+            queried += 1
+        rng.shuffle(batch)
+        for peer in batch:
+            answer = []
+            for _ in range(k):
+                if named and rng.random() < known:
+                    answer.append(rng.choice(named))
+                else:
+                    fresh = new_peer()
+                    named.append(fresh)
+                    pending.append(fresh)
+                    answer.append(fresh)
+            lines.append(f'00:00:{queried:06d}: * {peer} says use {"".join(a + " " for a in answer)}\n')
+            if query_index[peer] in provider_at:
+                provider = new_peer()
+                result_host_dic[provider] = peer
+                lines.append(f'00:00:{queried:06d}: provider: {provider}\n')
+                lines.append('\t/ip4/8.8.8.8/tcp/4001\n')
+    return lines, result_host_dic
+
+
+def legacy_hops(lines, result_host_dic):
+    """
+    the pre-QueryDag analyse_ipfs_hops: recursive walks from every root for each line
+    :return: max hop
+    """
+
+    def add_parent(query_target, q):
+        for response in query_target.answer:
+            if q.id == response.id:
+                if q not in query_target.child:
+                    query_target.child.append(q)
+                if q.parent is None:
+                    q.parent = [query_target]
+                else:
+                    q.parent.append(query_target)
+        for i in query_target.child:
+            add_parent(i, q)
+
+    def find_query(query_target, id):
+        if query_target.id == id:
+            return query_target
+        for i in query_target.child:
+            answer = find_query(i, id)
+            if answer is not None:
+                return answer
+        return None
+
+    def find_depth(node):
+        node = node.parent
+        if node is not None and len(node) > 0:
+            return 1 + find_depth(node[0])
+        return 1
+
+    root_query = []
+    all_query = []
+    all_response = []
+    uid = 0
+    for line in lines:
+        entry = parse_provid_line(line)
+        if entry is None:
+            continue
+        kind, ts, peer, answers = entry
+        if kind == 'querying':
+            q = Query(peer, ts, uid)
+            uid += 1
+            for i in root_query:
+                add_parent(i, q)
+            if q.parent is None:
+                root_query.append(q)
+            all_query.append(q)
+        elif kind == 'says':
+            q = None
+            for query in root_query:
+                q = find_query(query, peer)
+                if q is not None:
+                    break
+            for answer in answers:
+                response = None
+                for r in all_response:
+                    if r.id == answer:
+                        response = r
+                        break
+                if response is None:
+                    response = Response(answer, ts, uid)
+                    all_response.append(response)
+                    uid += 1
+                response.parent.append(q)
+                q.answer.append(response)
+        else:
+            Provider(peer, ts, uid)
+            uid += 1
+    hosts = set(result_host_dic.values())
+    return max((find_depth(q) for q in all_query if q.id in hosts), default=-1)
+
+
+def dag_hops(lines, result_host_dic):
+    dag = QueryDag()
+    for line in lines:
+        dag.feed(line)
+    _, max_hop = hop_summary(dag.hops(result_host_dic.values()))
+    return max_hop
+
+
+def run(name, func, lines, result_host_dic):
+    start = time.time()
+    try:
+        max_hop = func(lines, result_host_dic)
+    except RecursionError:
+        print(f'{name:<8} recursion limit')
+        return None
+    duration = time.time() - start
+    print(f'{name:<8} max hop {max_hop:3d} {duration:9.3f} s')
+    return duration
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 500, 1000, 2000, 10000, 50000],
+                        help="queries per synthetic trace")
+    parser.add_argument('-k', type=int, default=20, help="peers named in every answer")
+    parser.add_argument('--known', type=float, default=0.5, help="share of already named peers in answers")
+    parser.add_argument('--budget', type=float, default=30.0,
+                        help="stop running the legacy walk on larger traces once a run takes longer (s)")
+    args = parser.parse_args()
+
+    # the legacy walk follows the first parent it reaches depth first, so its max hop
+    # can be larger than the shortest path the dag reports
+    legacy = True
+    for size in args.sizes:
+        lines, result_host_dic = synthetic_trace(size, k=args.k, known=args.known)
+        print(f'trace {size} queries, {len(lines)} lines')
+        base = None
+        if legacy:
+            base = run('legacy', legacy_hops, lines, result_host_dic)
+            legacy = base is not None and base < args.budget
+        fast = run('dag', dag_hops, lines, result_host_dic)
+        if base and fast:
+            print(f'speedup {base / fast:.1f}x')
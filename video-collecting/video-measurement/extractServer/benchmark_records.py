@@ -0,0 +1,143 @@
+import argparse
+import copy
+import gc
+import json
+import time
+import tracemalloc
+from json import JSONEncoder
+
+import query_dag
+import summary_json
+from benchmark_query_dag import synthetic_trace
+from record import Address, Stats
+
+
+def dict_backed(cls):
+    """
+    :return: twin of a __slots__ record keeping its attributes in a __dict__, as before
+    """
+    return type(cls.__name__, (), {'__init__': cls.__init__})
+
+
+LegacyAddress = dict_backed(Address)
+LegacyStats = dict_backed(Stats)
+
+
+class LegacyStatsEncoder(JSONEncoder):
+    """
+    the former StatsEncoder, deep copies the peer dicts and replaces them in the __dict__ of the Stats
+    """
+
+    def default(self, o):
+        json_string = o.__dict__
+        providers = json_string['providers']
+        actual_providers = json_string['actual_provider']
+        if providers is not None and actual_providers is not None:
+            providers_new = copy.deepcopy(providers)
+            actual_providers_new = copy.deepcopy(actual_providers)
+            for key in providers.keys():
+                providers_new[key] = [ob.__dict__ for ob in providers[key]]
+            for key in actual_providers.keys():
+                actual_providers_new[key] = [ob.__dict__ for ob in actual_providers[key]]
+            json_string['providers'] = providers_new
+            json_string['actual_provider'] = actual_providers_new
+        return json_string
+
+
+def synthetic_stats(num_peers, addresses_per_peer, stats_cls=Stats, address_cls=Address):
+    """
+    Stats of a cid with num_peers providers, a tenth of them actual providers
+    :return: Stats
+    """
+    peers = {}
+    for peer in range(num_peers):
+        addresses = []
+        for index in range(addresses_per_peer):
+            address = address_cls(f'10.{peer // 256 % 256}.{peer % 256}.{index}', 'ip4', '4001', 'tcp')
+            address.rtt = 10.0 + index
+            address.ip_hop = '12'
+            addresses.append(address)
+        peers[f'12D3KooW{peer:010d}'] = addresses
+    actual = dict(list(peers.items())[:max(1, num_peers // 10)])
+    return stats_cls('QmSynthetic', 4, peers, '1024', '268435456', 0.8, '12.5', actual, 2,
+                     {1: 3, 2: 5, 3: 2, 4: 1}, 'video/mp4')
+
+
+def allocated(build):
+    """
+    :return: (result of build, bytes still allocated by it)
+    """
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, size
+
+
+def timed(func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+
+def feed_dag(lines):
+    dag = query_dag.QueryDag()
+    for line in lines:
+        dag.feed(line)
+    return dag
+
+
+def dag_memory(lines):
+    """
+    :return: (bytes of a QueryDag with the slot records, bytes with dict backed ones)
+    """
+    _, slots = allocated(lambda: feed_dag(lines))
+    records = (query_dag.Query, query_dag.Response, query_dag.Provider)
+    query_dag.Query, query_dag.Response, query_dag.Provider = (dict_backed(cls) for cls in records)
+    try:
+        _, legacy = allocated(lambda: feed_dag(lines))
+    finally:
+        query_dag.Query, query_dag.Response, query_dag.Provider = records
+    return slots, legacy
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 50000],
+                        help="queries per synthetic trace")
+    parser.add_argument('--peers', type=int, nargs='+', default=[20, 200, 2000], help="providers per Stats")
+    parser.add_argument('--addresses', type=int, default=8, help="addresses per provider")
+    parser.add_argument('--repeat', type=int, default=20, help="serializations per measurement")
+    args = parser.parse_args()
+
+    print('memory')
+    for size in args.sizes:
+        lines, _ = synthetic_trace(size)
+        slots, legacy = dag_memory(lines)
+        print(f'dag {size:>7} queries  dict {legacy / 2 ** 20:8.1f} MiB  slots {slots / 2 ** 20:8.1f} MiB  '
+              f'saved {1 - slots / legacy:.0%}')
+    for peers in args.peers:
+        _, legacy = allocated(lambda: synthetic_stats(peers, args.addresses, LegacyStats, LegacyAddress))
+        _, slots = allocated(lambda: synthetic_stats(peers, args.addresses))
+        print(f'stats {peers:>5} peers  dict {legacy / 2 ** 20:8.2f} MiB  slots {slots / 2 ** 20:8.2f} MiB  '
+              f'saved {1 - slots / legacy:.0%}')
+
+    backends = ['json'] + (['orjson'] if summary_json.orjson is not None else [])
+    print('serialization, ms per summary')
+    for peers in args.peers:
+        legacy_stats = synthetic_stats(peers, args.addresses, LegacyStats, LegacyAddress)
+        stats = synthetic_stats(peers, args.addresses)
+        # the same summary either way
+        expected = json.loads(json.dumps(copy.copy(legacy_stats), cls=LegacyStatsEncoder))
+        assert expected == json.loads(summary_json.dumps(stats)), 'summaries differ'
+        # what postprocess_file did for the store: encode a copy and decode it again
+        results = {'legacy store': timed(lambda: json.loads(json.dumps(copy.copy(legacy_stats),
+                                                                       cls=LegacyStatsEncoder)), args.repeat),
+                   'to_dict': timed(stats.to_dict, args.repeat),
+                   'legacy dump': timed(lambda: json.dumps(copy.copy(legacy_stats), cls=LegacyStatsEncoder),
+                                        args.repeat)}
+        for backend in backends:
+            results[f'{backend} dump'] = timed(lambda: summary_json.dumps(stats, backend), args.repeat)
+        print(f'{peers:>5} peers  ' + '  '.join(f'{name} {seconds * 1000:.2f}' for name, seconds in results.items()))
@@ -0,0 +1,201 @@
+import argparse
+import logging
+import os
+import sqlite3
+import time
+from collections.abc import Mapping
+
+
+def parse_block_line(line):
+    """
+    parse a bitswap.go block receive line
+    :param line: log line
+    :return: (block cid, provider peerID) or None
+    """
+    if "bitswap.go" not in line or "Block" not in line or "from" not in line:
+        return None
+    index = line.find("Block")
+    line = line.replace("\n", "")
+    line = line[index:]
+    line = line.split(' ')
+    # Block bafkreicp3z76wlf2bx3zmwbjzgqpsdvkb4coxuruj4fyq5w7gpvo2tfiuq
+    # recived from 12D3KooWGBWx9gyUFTVQcKMTenQMSyE2ad9m7c9fpjS4NMjoDien
+    return line[1].split('\n')[0], line[-1]
+
+
+def parse_routing_line(line):
+    """
+    parse a routing.go findprovs result line, "cid %s provider %s provides %s",oriKey, p, prov.ID
+    :param line: log line
+    :return: (cid, host peerID, provider peerID) or None
+    """
+    if "routing.go" not in line:
+        return None
+    index = line.find("cid")
+    line = line.replace("\n", "")
+    line = line[index:]
+    line = line.split(" ")
+    if len(line) < 6:
+        return None
+    return line[1], line[3], line[5]
+
+
+class DaemonLogIndex:
+    """
+    persistent index of the bitswap and routing entries of the shared ipfs daemon log
+
+    Every update() reads only what was appended to the log since the previous one,
+    so concurrent record.py runs share the parsing work instead of each rescanning
+    the whole log.
+    """
+
+    def __init__(self, log_path, index_path=None):
+        """
+        :param log_path: daemon log file
+        :param index_path: sqlite index file, defaults to <log_path>.index.sqlite
+        """
+        self.log_path = log_path
+        self.index_path = index_path or f'{log_path}.index.sqlite'
+        self.db = sqlite3.connect(self.index_path, timeout=300, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS block (block_cid TEXT, provider TEXT, offset INTEGER)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS block_cid_index ON block (block_cid, offset)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS routing (cid TEXT, host TEXT, provider TEXT, offset INTEGER)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS routing_cid_index ON routing (cid, offset)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS position (id INTEGER PRIMARY KEY, inode INTEGER, offset INTEGER)')
+
+    def close(self):
+        self.db.close()
+
+    def update(self):
+        """
+        index the lines appended to the log since the last update
+        :return: number of entries added
+        """
+        try:
+            stat = os.stat(self.log_path)
+        except FileNotFoundError:
+            return 0
+        added = 0
+        # one writer at a time, the others wait and then find nothing left to read
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            row = self.db.execute('SELECT inode, offset FROM position WHERE id = 0').fetchone()
+            inode, offset = row if row else (stat.st_ino, 0)
+            if inode != stat.st_ino or stat.st_size < offset:
+                # case log was rotated or truncated, offsets are no longer valid
+                logging.info(f'Daemon log {self.log_path} replaced, rebuilding index')
+                self.db.execute('DELETE FROM block')
+                self.db.execute('DELETE FROM routing')
+                offset = 0
+            blocks = []
+            routings = []
+            with open(self.log_path, 'rb') as stdin:
+                stdin.seek(offset)
+                for raw in stdin:
+                    if not raw.endswith(b'\n'):
+                        # line still being written by the daemon
+                        break
+                    line = raw.decode('utf-8', errors='replace')
+                    entry = parse_block_line(line)
+                    if entry is not None:
+                        blocks.append((entry[0], entry[1], offset))
+                    else:
+                        entry = parse_routing_line(line)
+                        if entry is not None:
+                            routings.append((entry[0], entry[1], entry[2], offset))
+                    offset += len(raw)
+            self.db.executemany('INSERT INTO block VALUES (?, ?, ?)', blocks)
+            self.db.executemany('INSERT INTO routing VALUES (?, ?, ?, ?)', routings)
+            self.db.execute('INSERT OR REPLACE INTO position VALUES (0, ?, ?)', (stat.st_ino, offset))
+            self.db.execute('COMMIT')
+            added = len(blocks) + len(routings)
+        except BaseException:
+            self.db.execute('ROLLBACK')
+            raise
+        return added
+
+    def follow(self, interval=1.0):
+        """
+        keep the index up to date with the growing log, never returns
+        :param interval: seconds between polls
+        :return: None
+        """
+        while True:
+            if self.update() == 0:
+                time.sleep(interval)
+
+    def find_providers(self, cid):
+        """
+        findprovs results logged for a cid
+        :param cid: root cid
+        :return: dic {provider_peerID : who provides (peerID)}
+        """
+        result_host_dic = {}
+        for host, provider in self.db.execute('SELECT host, provider FROM routing WHERE cid = ? ORDER BY offset',
+                                              (cid,)):
+            result_host_dic[provider] = host
+        return result_host_dic
+
+    def block_providers(self, cid):
+        """
+        block -> provider entries logged from the first time the root block of cid was received
+        :param cid: root cid
+        :return: read-only mapping {block_cid : providerID}
+        """
+        row = self.db.execute('SELECT MIN(offset) FROM block WHERE block_cid = ?', (cid,)).fetchone()
+        return BlockProviders(self, row[0])
+
+
+class BlockProviders(Mapping):
+    """
+    lazy {block_cid : providerID} view, the latest entry at or after start_offset wins
+    """
+
+    def __init__(self, index, start_offset):
+        self.index = index
+        self.start_offset = start_offset
+
+    def __getitem__(self, block_cid):
+        row = None
+        if self.start_offset is not None:
+            row = self.index.db.execute('SELECT provider FROM block WHERE block_cid = ? AND offset >= ? '
+                                        'ORDER BY offset DESC LIMIT 1', (block_cid, self.start_offset)).fetchone()
+        if row is None:
+            raise KeyError(block_cid)
+        return row[0]
+
+    def __iter__(self):
+        if self.start_offset is None:
+            return iter(())
+        rows = self.index.db.execute('SELECT DISTINCT block_cid FROM block WHERE offset >= ?', (self.start_offset,))
+        return (row[0] for row in rows)
+
+    def __len__(self):
+        if self.start_offset is None:
+            return 0
+        return self.index.db.execute('SELECT COUNT(DISTINCT block_cid) FROM block WHERE offset >= ?',
+                                     (self.start_offset,)).fetchone()[0]
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+if __name__ == '__main__':
+    # keep the index warm next to the daemon, e.g. python3 daemon_index.py -f /log-output/daemon.txt --follow
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-f', '--file', type=str, help="daemon file log name", required=True)
+    parser.add_argument('-i', '--index', type=str, help="index file, default <file>.index.sqlite")
+    parser.add_argument('--follow', action='store_true', help="keep indexing as the log grows")
+    parser.add_argument('-c', '--cid', type=str, help="print the entries of a cid")
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s', level=logging.INFO,
+                        datefmt='%Y-%m-%d %H:%M:%S')
+    index = DaemonLogIndex(args.file, args.index)
+    logging.info(f'Indexed {index.update()} new entries')
+    if args.cid:
+        print(index.find_providers(args.cid))
+        print(index.block_providers(args.cid))
+    if args.follow:
+        index.follow()
@@ -0,0 +1,179 @@
+import argparse
+import json
+import os
+
+
+class Bucket:
+    __slots__ = ('id', 'peers')
+
+    def __init__(self, id):
+        self.id = id
+        self.peers = []
+
+
+def read_dht_buckets(path):
+    """
+    Parse the routing table of cid_dht.txt
+    :param path: stats dht output file
+    :return: Bucket list
+    """
+    dht_bucket = []
+    with open(path, 'r') as stdin:
+        bucket_id = 0
+        current_bucket = None
+        for line in stdin.readlines():
+            if "Bucket" in line:
+                line = line.replace(" ", "")
+                index = line.find("Bucket")
+                try:
+                    # deal with 2 digit id
+                    bucket_id = int(line[index + 6:index + 8])
+                except Exception:
+                    # case of 1 digit id
+                    bucket_id = int(line[index + 6:index + 7])
+                current_bucket = Bucket(bucket_id)
+                dht_bucket.append(current_bucket)
+                continue
+            elif "Peer" in line or "DHT" in line:
+                continue
+            else:
+                # bucket reading
+                line = line.split(" ")
+                # case we have @ at the output
+                if line[2] == "@":
+                    # print(line[3])
+                    current_bucket.peers.append(line[3])
+                else:
+                    # print(line[4])
+                    if line[4] != "":
+                        current_bucket.peers.append(line[4])
+    return dht_bucket
+
+
+def bucket_index(dht_bucket):
+    """
+    :param dht_bucket: Bucket list of the routing table, a peer in two buckets belongs to the first
+    :return: dic {peerID : 'Bucket <id>'}
+    """
+    bucket_of = {}
+    for bucket in dht_bucket:
+        for peer in bucket.peers:
+            bucket_of.setdefault(peer, f'Bucket {bucket.id}')
+    return bucket_of
+
+
+def earlier_parents(q):
+    """
+    :return: parents of q one hop closer to the dht bucket, the others are in the level of q or below it
+    """
+    return [parent for parent in q.parent or () if parent.depth < q.depth]
+
+
+def shortest_paths(queries):
+    """
+    :param queries: Query list
+    :return: uids of the queries and of one shortest chain of queries leading to each of them
+    """
+    kept = set()
+    for q in queries:
+        while q is not None and q.uid not in kept:
+            kept.add(q.uid)
+            parents = earlier_parents(q)
+            q = parents[0] if parents else None
+    return kept
+
+
+def sample(dag, levels, hosts, top_k):
+    """
+    down-sample the lookup to at most top_k queries per level, on top of the paths to the provider hosts
+
+    A level keeps a shortest path to every host first, even past top_k, then the queries with
+    the largest fan-out among those with a kept parent, so the tree stays connected.
+    :param levels: dag.levels()
+    :param hosts: peerIDs that returned a provider
+    :return: uids of the kept queries
+    """
+    hosts = set(hosts)
+    kept = shortest_paths(q for q in dag.all_query if q.id in hosts)
+    for level in levels:
+        room = top_k - sum(1 for q in level if q.uid in kept)
+        if room <= 0:
+            continue
+        candidates = [q for q in level if q.uid not in kept and
+                      (q.parent is None or any(parent.uid in kept for parent in earlier_parents(q)))]
+        candidates.sort(key=lambda q: len(q.child), reverse=True)
+        kept.update(q.uid for q in candidates[:room])
+    return kept
+
+
+def level_nodes(level, bucket_of, kept=None):
+    """
+    tangled tree nodes of one level, a peer queried twice in a level is one node with the parents of both,
+    parents are those of the previous level as the tree draws no links inside a level
+    :param kept: uids of the sampled queries, None for all of them
+    :return: list of dic {"id", "parents"}, no parents for a root query of a peer in no bucket
+    """
+    nodes = {}  # {peerID : {parentID : None}}
+    for q in level:
+        if kept is not None and q.uid not in kept:
+            continue
+        parents = nodes.setdefault(q.id, {})
+        if q.parent is None:
+            if q.id in bucket_of:
+                parents[bucket_of[q.id]] = None
+        else:
+            parents.update((parent.id, None) for parent in earlier_parents(q) if kept is None or parent.uid in kept)
+    return [{'id': peer, 'parents': list(parents)} if parents else {'id': peer} for peer, parents in nodes.items()]
+
+
+def write_tangled_tree(path, dag, result_host_dic, dht_bucket, top_k=0):
+    """
+    write the lookup as tangled tree levels: dht buckets, one level per hop, then the providers
+
+    Levels are written one at a time, only the level being written is held as json nodes.
+    :param path: output file, e.g. <cid>_visual.json
+    :param dag: QueryDag of the lookup
+    :param result_host_dic: dic {provider : peer that responded with it}
+    :param dht_bucket: Bucket list of the routing table
+    :param top_k: queries kept per level, 0 for all of them
+    :return: (nodes written, queries dropped by the sampling)
+    """
+    bucket_of = bucket_index(dht_bucket)
+    levels = dag.levels()
+    kept = sample(dag, levels, result_host_dic.values(), top_k) if top_k else None
+    written = 0
+    dropped = 0
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w') as fout:
+        fout.write('[' + json.dumps([{'id': f'Bucket {bucket.id}'} for bucket in dht_bucket]))
+        for level in levels:
+            nodes = level_nodes(level, bucket_of, kept)
+            written += len(nodes)
+            dropped += len(level) - sum(1 for q in level if kept is None or q.uid in kept)
+            fout.write(',\n' + json.dumps(nodes))
+        providers = []
+        for index, provider in enumerate(dag.all_provider):
+            host = result_host_dic.get(provider.id)
+            providers.append({'id': f'Provider {index}', 'parents': [host]} if host else {'id': f'Provider {index}'})
+        fout.write(',\n' + json.dumps(providers) + ']\n')
+    # the page reading it never sees half a file
+    os.replace(tmp, path)
+    return written, dropped
+
+
+if __name__ == '__main__':
+    # e.g. python3 dag_export.py -d /out/videos/<cid> -c <cid> --top-k 40
+    from query_dag import QueryDag
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--directory', type=str, required=True, help="output directory of the cid")
+    parser.add_argument('-c', '--cid', type=str, required=True, help="cid")
+    parser.add_argument('-o', '--output', type=str, help="output file, <directory>/<cid>_visual.json by default")
+    parser.add_argument('--top-k', type=int, default=0, help="queries kept per level, 0 for all of them")
+    args = parser.parse_args()
+    dag = QueryDag.load(os.path.join(args.directory, f'{args.cid}_provid.txt'))
+    # providers with no known host are written without a parent
+    written, dropped = write_tangled_tree(args.output or os.path.join(args.directory, f'{args.cid}_visual.json'),
+                                          dag, {}, read_dht_buckets(os.path.join(args.directory, f'{args.cid}_dht.txt')),
+                                          args.top_k)
+    print(f'{written} nodes written, {dropped} queries dropped')
@@ -0,0 +1,90 @@
+import argparse
+import concurrent.futures
+import json
+import logging
+import time
+
+import ipfs_rpc
+
+# cids per block rm call
+BATCH_SIZE = 256
+VERIFY_WORKERS = 16
+
+
+def local_dag(rpc, cid, timeout):
+    """
+    :return: cids of the blocks of the dag of cid held locally, root first
+    """
+    cids = [cid]
+    try:
+        for ref in rpc.refs(cid, recursive=True, unique=True, offline=True, timeout=timeout):
+            if ref.get('Ref'):
+                cids.append(ref['Ref'])
+    except ipfs_rpc.RpcTimeout:
+        raise
+    except ipfs_rpc.RpcError as e:
+        # case root is not local, nothing below it can be walked offline
+        logging.info(f'Refs {cid} {e}')
+    return list(dict.fromkeys(cids))
+
+
+def still_local(rpc, cids, workers=VERIFY_WORKERS, timeout=90):
+    """
+    :return: the cids still in the local blockstore
+    """
+
+    def is_local(cid):
+        try:
+            rpc.block_stat(cid, offline=True, timeout=timeout)
+            return True
+        except ipfs_rpc.RpcTimeout:
+            return True
+        except ipfs_rpc.RpcError:
+            return False
+
+    if not cids:
+        return []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(workers, len(cids))) as pool:
+        return [cid for cid, local in zip(cids, pool.map(is_local, cids)) if local]
+
+
+def evict_dag(cid, rpc=None, batch_size=BATCH_SIZE, timeout=90):
+    """
+    remove every local block of the dag of cid, root included, and check they are gone
+    :param cid: root cid
+    :param rpc: IpfsRpc, the shared client by default
+    :param batch_size: cids per block rm call
+    :param timeout: seconds per rpc call
+    :return: dic {"blocks", "removed", "remaining", "errors", "seconds"}
+    """
+    rpc = rpc or ipfs_rpc.default_client()
+    start = time.monotonic()
+    cids = local_dag(rpc, cid, timeout)
+    blocks = len(cids)
+    removed = 0
+    errors = []
+    remaining = cids
+    # a block fetched again meanwhile gets one more try
+    for _ in range(2):
+        for index in range(0, len(remaining), batch_size):
+            for result in rpc.block_rm(remaining[index:index + batch_size], force=True, timeout=timeout):
+                if result.get('Error'):
+                    errors.append(f'{result.get("Hash")} {result["Error"]}')
+                else:
+                    removed += 1
+        remaining = still_local(rpc, remaining, timeout=timeout)
+        if not remaining:
+            break
+    return {'blocks': blocks, 'removed': removed, 'remaining': remaining, 'errors': errors,
+            'seconds': time.monotonic() - start}
+
+
+if __name__ == '__main__':
+    # e.g. python3 evict.py <cid>
+    parser = argparse.ArgumentParser()
+    parser.add_argument('cid', type=str, help="root cid to evict")
+    parser.add_argument('--api', type=str, default=ipfs_rpc.API_URL, help="ipfs rpc api url")
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s', level=logging.INFO,
+                        datefmt='%Y-%m-%d %H:%M:%S')
+    print(json.dumps(evict_dag(args.cid, ipfs_rpc.IpfsRpc(args.api)), indent=2))
@@ -0,0 +1,352 @@
+import argparse
+import http.server
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+from datetime import datetime, timezone
+
+import ipfs_rpc
+import synthetic_logs
+
+CHUNK = 64 * 1024
+
+
+class FakeIpfs:
+    """
+    scripted daemon state answered by the fake rpc server and gateway
+
+    dht: stats dht result, traces: {cid : [query event]} where an event may carry a
+    "_delay" in seconds before it is sent, dags: {cid : {"Size", "Links": [child cid]}},
+    peers: {peerID : [multiaddr]}, blocks: cids in the local blockstore.
+    The gateway serves the Size of every block of a dag, blocks not local yet after
+    latency seconds at bandwidth bytes/s, and logs them as received from the providers
+    of the cid in daemon_log, where findprovs also logs the providers it finds.
+    """
+
+    def __init__(self, dht=None, traces=None, dags=None, peers=None, blocks=None, daemon_log=None, bandwidth=0,
+                 latency=0.0):
+        self.dht = dht or []
+        self.traces = traces or {}
+        self.dags = dags or {}
+        self.peers = peers or {}
+        self.blocks = set(blocks or ())
+        self.daemon_log = daemon_log
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.calls = []
+        # (command, first arg, start time, seconds) of every answered call
+        self.timings = []
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as fin:
+            return cls(**json.load(fin))
+
+    def walk(self, cid, local=False):
+        """
+        :param local: only follow the links of blocks in the local blockstore
+        :return: all cids of the dag under cid, root first
+        """
+        seen = []
+        stack = [cid]
+        while stack:
+            current = stack.pop()
+            if current in seen:
+                continue
+            seen.append(current)
+            if local and current not in self.blocks:
+                continue
+            stack.extend(reversed(self.dags.get(current, {}).get('Links', [])))
+        return seen
+
+    def log(self, lines):
+        """
+        append whole lines to the daemon log, a reader never sees half of them
+        """
+        if self.daemon_log and lines:
+            with self.lock:
+                with open(self.daemon_log, 'a') as fout:
+                    fout.write(''.join(lines))
+
+    def providers(self, cid):
+        """
+        :return: provider peerIDs of the trace of cid
+        """
+        return [event['Responses'][0]['ID'] for event in self.traces.get(cid, [])
+                if event.get('Type') == ipfs_rpc.PROVIDER and event.get('Responses')]
+
+
+def now():
+    return synthetic_logs.log_timestamp(datetime.now(timezone.utc))
+
+
+def synthetic_scenario(num_cids=10, size=16 * 2 ** 20, num_blocks=64, num_queries=200, providers=5,
+                       lookup_time=1.0, addrs=('/dns4/localhost/tcp/4001',), seed=0):
+    """
+    FakeIpfs fields of num_cids cids, none of them local yet
+    :param size: bytes of each cid, split over num_blocks blocks under the root
+    :param num_queries: queried peers of each findprovs trace
+    :param providers: providers in each trace
+    :param lookup_time: seconds each findprovs lookup takes, spread over its events
+    :param addrs: multiaddrs of every peer, localhost is probed without leaving the host
+    :return: dic of the FakeIpfs fields, json serializable
+    """
+    rng = random.Random(seed)
+    traces = {}
+    dags = {}
+    peers = {}
+    for index, cid in enumerate(synthetic_logs.cids_of(seed, num_cids)):
+        events, result_host_dic = synthetic_logs.query_events(num_queries, providers, addrs, seed + index)
+        for event in events:
+            event['_delay'] = lookup_time / len(events)
+        traces[cid] = events
+        for provider in result_host_dic:
+            peers[provider] = list(addrs)
+        links = [synthetic_logs.block_cid(rng) for _ in range(num_blocks)]
+        dags[cid] = {'Size': 0, 'Links': links}
+        for position, link in enumerate(links):
+            # the first blocks take the remainder
+            dags[link] = {'Size': size // num_blocks + (1 if position < size % num_blocks else 0), 'Links': []}
+    return {'dht': synthetic_logs.dht_table(seed=seed), 'traces': traces, 'dags': dags, 'peers': peers}
+
+
+class FakeRpcError(Exception):
+    pass
+
+
+class FakeRpcHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        cmd = url.path[len('/api/v0/'):]
+        args = query.pop('arg', [])
+        options = {key: values[-1] for key, values in query.items()}
+        ipfs = self.server.ipfs
+        with ipfs.lock:
+            ipfs.calls.append((cmd, args))
+        handler = getattr(self, 'rpc_' + cmd.replace('/', '_'), None)
+        if handler is None:
+            self.send_error_json(404, f'unknown command "{cmd}"')
+            return
+        start = time.time()
+        try:
+            self.answer(handler, ipfs, args, options)
+        finally:
+            with ipfs.lock:
+                ipfs.timings.append((cmd, args[0] if args else None, start, time.time() - start))
+
+    def answer(self, handler, ipfs, args, options):
+        try:
+            results = handler(ipfs, args, options)
+            # validate before the 200 header goes out, errors of streams raise on first item
+            results = iter(results)
+            first = next(results, None)
+        except FakeRpcError as e:
+            self.send_error_json(500, str(e))
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        try:
+            if first is not None:
+                self.write_item(first)
+            for item in results:
+                self.write_item(item)
+            self.wfile.write(b'0\r\n\r\n')
+        except (BrokenPipeError, ConnectionResetError):
+            # case client cancelled the call
+            self.close_connection = True
+
+    def write_item(self, item):
+        delay = item.pop('_delay', 0) if isinstance(item, dict) else 0
+        if delay:
+            time.sleep(delay)
+        data = (json.dumps(item) + '\n').encode('utf-8')
+        self.wfile.write(f'{len(data):x}\r\n'.encode('ascii') + data + b'\r\n')
+        self.wfile.flush()
+
+    def send_error_json(self, code, message):
+        body = json.dumps({'Message': message, 'Code': 0, 'Type': 'error'}).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        ipfs = self.server.ipfs
+        match = re.fullmatch(r'/ipfs/([^/?]+)', urllib.parse.urlparse(self.path).path)
+        if match is None or match.group(1) not in ipfs.dags:
+            self.send_error_json(404, 'not found')
+            return
+        cid = match.group(1)
+        start = time.time()
+        try:
+            self.serve_content(ipfs, cid)
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+        finally:
+            with ipfs.lock:
+                ipfs.timings.append(('gateway', cid, start, time.time() - start))
+
+    def serve_content(self, ipfs, cid):
+        cids = ipfs.walk(cid)
+        size = sum(ipfs.dags.get(block, {}).get('Size', 0) for block in cids)
+        with ipfs.lock:
+            missing = [block for block in cids if block not in ipfs.blocks]
+            ipfs.blocks.update(cids)
+        cold = bool(missing)
+        if cold:
+            providers = ipfs.providers(cid) or ['12D3KooWFakeProvider']
+            ipfs.log([synthetic_logs.block_line(now(), block, providers[index % len(providers)])
+                      for index, block in enumerate(missing)])
+            time.sleep(ipfs.latency)
+        first, last = 0, size - 1
+        match = re.fullmatch(r'bytes=(\d*)-(\d*)', self.headers.get('Range', ''))
+        if match and size:
+            if match.group(1):
+                first = int(match.group(1))
+                last = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            else:
+                first = max(0, size - int(match.group(2)))
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {first}-{last}/{size}')
+        else:
+            self.send_response(200)
+        length = max(0, last - first + 1)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(length))
+        self.end_headers()
+        start = time.monotonic()
+        sent = 0
+        while sent < length:
+            count = min(CHUNK, length - sent)
+            self.wfile.write(b'\0' * count)
+            sent += count
+            if cold and ipfs.bandwidth:
+                # paced to the bandwidth, the cached fetch goes at full speed
+                ahead = sent / ipfs.bandwidth - (time.monotonic() - start)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+    def rpc_stats_dht(self, ipfs, args, options):
+        return [dict(dht) for dht in ipfs.dht]
+
+    def rpc_dht_findprovs(self, ipfs, args, options):
+        num_providers = int(options.get('num-providers', 20))
+        events = [dict(event) for event in ipfs.traces.get(args[0], [])]
+
+        def generate():
+            found = 0
+            for event in events:
+                yield event
+                if event.get('Type') == ipfs_rpc.PROVIDER:
+                    # as the patched routing.go logs every provider it finds
+                    for response in event.get('Responses') or []:
+                        ipfs.log([synthetic_logs.routing_line(now(), args[0], event.get('ID'), response['ID'])])
+                    found += 1
+                    if num_providers and found >= num_providers:
+                        return
+        return generate()
+
+    def rpc_dag_stat(self, ipfs, args, options):
+        if args[0] not in ipfs.dags:
+            raise FakeRpcError(f'block {args[0]} not found')
+        cids = ipfs.walk(args[0])
+        size = sum(ipfs.dags.get(cid, {}).get('Size', 0) for cid in cids)
+        return [{'Size': size, 'NumBlocks': len(cids)}]
+
+    def rpc_ls(self, ipfs, args, options):
+        if args[0] not in ipfs.dags:
+            raise FakeRpcError(f'block {args[0]} not found')
+        links = [{'Name': '', 'Hash': cid, 'Size': 0, 'Type': 2, 'Target': ''}
+                 for cid in ipfs.dags[args[0]].get('Links', [])]
+        return [{'Objects': [{'Hash': args[0], 'Links': links}]}]
+
+    def rpc_refs(self, ipfs, args, options):
+        offline = options.get('offline') == 'true'
+        if offline and args[0] not in ipfs.blocks:
+            raise FakeRpcError('block was not found locally (offline): ipld: could not find ' + args[0])
+        results = []
+        for cid in ipfs.walk(args[0], local=offline)[1:]:
+            error = '' if cid in ipfs.blocks or not offline else f'block was not found locally (offline): {cid}'
+            results.append({'Ref': cid, 'Err': error})
+        return results
+
+    def rpc_block_stat(self, ipfs, args, options):
+        if args[0] not in ipfs.blocks:
+            raise FakeRpcError('block was not found locally (offline): ipld: could not find ' + args[0])
+        return [{'Key': args[0], 'Size': ipfs.dags.get(args[0], {}).get('Size', 0)}]
+
+    def rpc_dht_findpeer(self, ipfs, args, options):
+        if args[0] not in ipfs.peers:
+            raise FakeRpcError('routing: not found')
+        return [{'Type': ipfs_rpc.FINAL_PEER, 'ID': '', 'Extra': '',
+                 'Responses': [{'ID': args[0], 'Addrs': ipfs.peers[args[0]]}]}]
+
+    def rpc_block_rm(self, ipfs, args, options):
+        results = []
+        with ipfs.lock:
+            for cid in args:
+                if cid in ipfs.blocks:
+                    ipfs.blocks.discard(cid)
+                    results.append({'Hash': cid, 'Error': ''})
+                elif options.get('force') != 'true':
+                    results.append({'Hash': cid, 'Error': 'blockstore: block not found'})
+        return results
+
+    def rpc_repo_gc(self, ipfs, args, options):
+        with ipfs.lock:
+            removed = sorted(ipfs.blocks)
+            ipfs.blocks.clear()
+        return [{'Key': {'/': cid}} for cid in removed]
+
+
+class FakeIpfsServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, ipfs):
+        super().__init__(address, FakeRpcHandler)
+        self.ipfs = ipfs
+
+
+def start_fake_ipfs(ipfs, host='127.0.0.1', port=0):
+    """
+    serve a FakeIpfs in a background thread
+    :return: server, rpc api url
+    """
+    server = FakeIpfsServer((host, port), ipfs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://{host}:{server.server_port}'
+
+
+if __name__ == '__main__':
+    # e.g. python3 fake_ipfs.py scenario.json -p 5001, then IPFS_API_URL=IPFS_GATEWAY_URL=http://127.0.0.1:5001
+    parser = argparse.ArgumentParser()
+    parser.add_argument('scenario', type=str, help="json file with the FakeIpfs fields")
+    parser.add_argument('-p', '--port', type=int, default=5001, help="rpc api and gateway port")
+    parser.add_argument('--generate', type=int, metavar='CIDS',
+                        help="write a synthetic scenario of CIDS cids to the scenario file first")
+    parser.add_argument('--daemon-log', type=str, help="fake daemon log the bitswap and routing lines go to")
+    args = parser.parse_args()
+    if args.generate:
+        with open(args.scenario, 'w') as fout:
+            json.dump(synthetic_scenario(args.generate), fout)
+    ipfs = FakeIpfs.load(args.scenario)
+    ipfs.daemon_log = args.daemon_log or ipfs.daemon_log
+    server, url = start_fake_ipfs(ipfs, port=args.port)
+    print(f'fake ipfs rpc api and gateway at {url}, cids {", ".join(ipfs.traces)}')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,178 @@
+import hashlib
+import logging
+import os
+import time
+
+import pycurl
+
+GATEWAY_URL = os.environ.get('IPFS_GATEWAY_URL', 'http://127.0.0.1:8080')
+# a transfer below STALL_SPEED bytes/s for STALL_TIME seconds is dead, as the former 5 min no-growth check
+STALL_SPEED = 1
+STALL_TIME = 300
+# curl reports connect timeouts and the low speed abort with the same error code, only this message tells them apart
+LOW_SPEED_MESSAGE = 'Operation too slow'
+CONNECT_TIMEOUT = 300
+PROGRESS_LOG_INTERVAL = 60
+MAX_CONNECTIONS = 8
+# width of the throughput timeline buckets in seconds
+BUCKET = 0.1
+
+
+class Sink:
+    """
+    body consumer counting bytes per time bucket, optionally hashing the body or passing it to a file
+    """
+
+    def __init__(self, out=None, digest=False, bucket=BUCKET):
+        """
+        :param out: binary file object to also write the body to, None to keep nothing
+        :param digest: compute the sha256 of the body
+        :param bucket: timeline bucket width in seconds
+        """
+        self.out = out
+        self.hash = hashlib.sha256() if digest else None
+        self.bucket = bucket
+        self.start = time.monotonic()
+        self.received = 0
+        # [[bucket index, bytes]] of the buckets that received data
+        self.timeline = []
+
+    def write(self, data):
+        index = int((time.monotonic() - self.start) / self.bucket)
+        if self.timeline and self.timeline[-1][0] == index:
+            self.timeline[-1][1] += len(data)
+        else:
+            self.timeline.append([index, len(data)])
+        self.received += len(data)
+        if self.hash is not None:
+            self.hash.update(data)
+        if self.out is not None:
+            self.out.write(data)
+
+    def summary(self):
+        summary = {"received": self.received, "timeline": {"bucket": self.bucket, "bytes": self.timeline}}
+        if self.hash is not None:
+            summary["sha256"] = self.hash.hexdigest()
+        return summary
+
+
+def gateway_url(cid, gateway=GATEWAY_URL):
+    return f'{gateway}/ipfs/{cid}'
+
+
+class GatewayFetch:
+    """
+    one gateway download, run by run() with other fetches on a shared CurlMulti
+
+    After run() returns, metrics holds the curl timings or error holds the curl
+    error message; stalled tells the transfer was aborted by the low speed limit.
+    """
+
+    def __init__(self, url, out=None, stall_time=STALL_TIME, connect_timeout=CONNECT_TIMEOUT, digest=False,
+                 byte_range=None):
+        """
+        :param url: url to download
+        :param out: binary file object the body is written to, None to only measure it
+        :param stall_time: seconds below STALL_SPEED before the transfer is aborted
+        :param connect_timeout: seconds to connect
+        :param digest: add the sha256 of the body to the metrics
+        :param byte_range: only fetch this range, e.g. 0-1048575
+        """
+        self.url = url
+        self.sink = Sink(out, digest)
+        self.metrics = None
+        self.error = None
+        self.stalled = False
+        self.downloaded = 0
+        self.last_log = time.monotonic()
+        self.curl = pycurl.Curl()
+        self.curl.setopt(pycurl.URL, url)
+        self.curl.setopt(pycurl.VERBOSE, False)
+        self.curl.setopt(pycurl.WRITEFUNCTION, self.sink.write)
+        if byte_range:
+            self.curl.setopt(pycurl.RANGE, byte_range)
+        self.curl.setopt(pycurl.FOLLOWLOCATION, 1)
+        self.curl.setopt(pycurl.CONNECTTIMEOUT, connect_timeout)
+        self.curl.setopt(pycurl.LOW_SPEED_LIMIT, STALL_SPEED)
+        self.curl.setopt(pycurl.LOW_SPEED_TIME, stall_time)
+        self.curl.setopt(pycurl.NOPROGRESS, False)
+        self.curl.setopt(pycurl.XFERINFOFUNCTION, self.progress)
+
+    def progress(self, download_total, downloaded, upload_total, uploaded):
+        self.downloaded = downloaded
+        now = time.monotonic()
+        if now - self.last_log >= PROGRESS_LOG_INTERVAL:
+            self.last_log = now
+            logging.info(f"Current_size {downloaded} {self.url}")
+        return 0
+
+    def finish(self, errno=0, message=''):
+        """
+        collect the result once the transfer is over and release the handle
+        """
+        if errno:
+            self.error = message
+            self.stalled = errno == pycurl.E_OPERATION_TIMEDOUT and message.startswith(LOW_SPEED_MESSAGE)
+        else:
+            c = self.curl
+            """
+            curl_easy_perform()
+            |
+            |--NAMELOOKUP
+            |--|--CONNECT
+            |--|--|--APPCONNECT
+            |--|--|--|--PRETRANSFER
+            |--|--|--|--|--STARTTRANSFER
+            |--|--|--|--|--|--TOTAL
+            |--|--|--|--|--|--REDIRECT
+            """
+            self.metrics = {"total_time": c.getinfo(pycurl.TOTAL_TIME),
+                            "namelookup_time": c.getinfo(pycurl.NAMELOOKUP_TIME),
+                            "connect_time": c.getinfo(pycurl.CONNECT_TIME),
+                            "pretransfer_time": c.getinfo(pycurl.PRETRANSFER_TIME),
+                            "redirect_time": c.getinfo(pycurl.REDIRECT_TIME),
+                            "starttransfer_time": c.getinfo(pycurl.STARTTRANSFER_TIME),
+                            "length": c.getinfo(pycurl.CONTENT_LENGTH_DOWNLOAD)}
+            # in bytes
+            self.metrics.update(self.sink.summary())
+        self.curl.close()
+
+
+def run(fetches, max_connections=MAX_CONNECTIONS):
+    """
+    run fetches concurrently on one CurlMulti, returns as soon as the last one is over
+    :param fetches: GatewayFetch list
+    :param max_connections: transfers at once, the others wait for a free connection
+    :return: fetches
+    """
+    multi = pycurl.CurlMulti()
+    multi.setopt(pycurl.M_MAX_TOTAL_CONNECTIONS, max_connections)
+    running = {}
+    for fetch in fetches:
+        fetch.sink.start = time.monotonic()
+        multi.add_handle(fetch.curl)
+        running[fetch.curl] = fetch
+    try:
+        while running:
+            while True:
+                ret, _ = multi.perform()
+                if ret != pycurl.E_CALL_MULTI_PERFORM:
+                    break
+            while True:
+                queued, done, failed = multi.info_read()
+                for curl in done:
+                    multi.remove_handle(curl)
+                    running.pop(curl).finish()
+                for curl, errno, message in failed:
+                    multi.remove_handle(curl)
+                    running.pop(curl).finish(errno, message)
+                if queued == 0:
+                    break
+            if running:
+                multi.select(1.0)
+    finally:
+        for curl, fetch in running.items():
+            multi.remove_handle(curl)
+            fetch.finish(pycurl.E_ABORTED_BY_CALLBACK, 'aborted')
+        multi.close()
+    return fetches
@@ -2,5 +2,17 @@
 ./ipfs daemon --enable-gc > /log_output/daemon.txt 2>&1 &
 sleep 10
 ./ipfs log level metric warn
+# one stage metrics database for the worker /metrics and the record.py runs server.go starts
+export STAGE_METRICS=/log-output/stage_metrics.sqlite
+# long-lived record.py worker, record.py -c ... hands its measurement over to it
+# 29998 is the extractServer listener, the stage metrics go on 29996
+python3 -u record.py --serve 127.0.0.1:29997 --metrics 0.0.0.0:29996 \
+    -f /log-output/daemon.txt > /log_output/record_worker.txt 2>&1 &
+# wait for the worker before the first cid comes in, record.py measures in process while it is not listening
+for i in $(seq 60); do
+    (exec 3<>/dev/tcp/127.0.0.1/29997) 2>/dev/null && break
+    sleep 1
+done
+export RECORD_WORKER=127.0.0.1:29997
 #readelf -d ./extractServer | grep 'NEEDED'
 ./extractServer
\ No newline at end of file
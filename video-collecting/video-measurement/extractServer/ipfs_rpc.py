@@ -0,0 +1,249 @@
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+API_URL = os.environ.get('IPFS_API_URL', 'http://127.0.0.1:5001')
+
+# routing.QueryEventType values streamed by dht findprovs and findpeer
+SENDING_QUERY = 0
+PEER_RESPONSE = 1
+FINAL_PEER = 2
+QUERY_ERROR = 3
+PROVIDER = 4
+VALUE = 5
+ADDING_PEER = 6
+DIALING_PEER = 7
+
+
+class RpcError(Exception):
+    pass
+
+
+class RpcTimeout(RpcError):
+    pass
+
+
+class IpfsRpc:
+    """
+    client of the ipfs daemon http rpc api (port 5001) over pooled keep-alive connections
+
+    Every call takes a timeout in seconds for the whole call; streaming calls also
+    take a threading.Event that cancels the call when set.
+    """
+
+    def __init__(self, url=API_URL, pool_size=32):
+        """
+        :param url: rpc api base url
+        :param pool_size: max number of pooled connections
+        """
+        self.url = url.rstrip('/')
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def post(self, cmd, args=(), timeout=300, **options):
+        """
+        start a rpc call
+        :param cmd: command path, e.g. dht/findprovs
+        :param args: positional arguments
+        :param timeout: seconds, also sent to the daemon so it stops working on the call
+        :param options: command options
+        :return: streaming response
+        """
+        params = [('arg', arg) for arg in args]
+        for key, value in options.items():
+            if isinstance(value, bool):
+                value = 'true' if value else 'false'
+            params.append((key.replace('_', '-'), value))
+        params.append(('timeout', f'{int(timeout * 1000)}ms'))
+        try:
+            response = self.session.post(f'{self.url}/api/v0/{cmd}', params=params, stream=True,
+                                         timeout=(10, timeout))
+        except requests.Timeout as e:
+            raise RpcTimeout(f'{cmd} {" ".join(args)} timeout') from e
+        except requests.RequestException as e:
+            raise RpcError(f'{cmd} {" ".join(args)} {e}') from e
+        if response.status_code != 200:
+            try:
+                message = response.json().get('Message', response.text)
+            except ValueError:
+                message = response.text
+            response.close()
+            raise RpcError(f'{cmd} {" ".join(args)}: {message}')
+        return response
+
+    def stream(self, cmd, args=(), timeout=300, cancel=None, **options):
+        """
+        call a command answering a stream of json objects, yielded as they arrive
+        :param cancel: threading.Event, stop reading once set
+        :return: generator of dict
+        """
+        deadline = time.monotonic() + timeout
+        response = self.post(cmd, args, timeout, **options)
+        try:
+            for line in response.iter_lines():
+                if cancel is not None and cancel.is_set():
+                    return
+                if time.monotonic() > deadline:
+                    raise RpcTimeout(f'{cmd} {" ".join(args)} timeout')
+                if line:
+                    yield json.loads(line)
+        except requests.exceptions.ConnectionError as e:
+            # a read timeout surfaces as a connection error while streaming
+            if time.monotonic() > deadline - 1:
+                raise RpcTimeout(f'{cmd} {" ".join(args)} timeout') from e
+            raise RpcError(f'{cmd} {" ".join(args)} {e}') from e
+        finally:
+            response.close()
+
+    def call(self, cmd, args=(), timeout=300, **options):
+        """
+        call a command answering a single json object, the last one if it streams progress
+        :return: dict
+        """
+        result = None
+        for result in self.stream(cmd, args, timeout, **options):
+            pass
+        return result
+
+    def stats_dht(self, timeout=300):
+        """
+        :return: list of {"Name", "Buckets": [{"LastRefresh", "Peers": [{"ID", "Connected", ...}]}]}
+        """
+        return list(self.stream('stats/dht', timeout=timeout))
+
+    def findprovs(self, cid, num_providers=20, timeout=300, cancel=None):
+        """
+        :return: generator of query events {"Type", "ID", "Responses", "Extra"} as the lookup runs
+        """
+        return self.stream('dht/findprovs', [cid], timeout, cancel, verbose=True, num_providers=num_providers)
+
+    def dag_stat(self, cid, timeout=300):
+        """
+        :return: (size, number of blocks)
+        """
+        result = self.call('dag/stat', [cid], timeout, progress=False) or {}
+        if 'DagStats' in result:
+            # newer daemons answer one entry per root
+            result = result['DagStats'][0]
+        return result.get('Size', 0), result.get('NumBlocks', -1)
+
+    def ls(self, cid, timeout=300):
+        """
+        :return: list of the cid of the direct children
+        """
+        links = []
+        for result in self.stream('ls', [cid], timeout, size=False, resolve_type=False):
+            for obj in result.get('Objects', []):
+                links.extend(link['Hash'] for link in obj.get('Links', []))
+        return links
+
+    def findpeer(self, peer, timeout=300):
+        """
+        :return: list of multiaddr strings of the peer, raise RpcError if not found
+        """
+        for event in self.stream('dht/findpeer', [peer], timeout):
+            if event.get('Type') == FINAL_PEER and event.get('Responses'):
+                return event['Responses'][0].get('Addrs') or []
+            if event.get('Type') == QUERY_ERROR:
+                raise RpcError(f'findpeer {peer}: {event.get("Extra")}')
+        raise RpcError(f'findpeer {peer}: routing: not found')
+
+    def refs(self, cid, recursive=True, unique=True, offline=True, timeout=300):
+        """
+        :param offline: only walk blocks in the local blockstore, never fetch the missing ones
+        :return: generator of {"Ref", "Err"}, one per block under cid, the root excluded
+        """
+        return self.stream('refs', [cid], timeout, recursive=recursive, unique=unique, offline=offline)
+
+    def block_stat(self, cid, offline=True, timeout=300):
+        """
+        :return: {"Key", "Size"}, raise RpcError if the block is not available
+        """
+        return self.call('block/stat', [cid], timeout, offline=offline)
+
+    def block_rm(self, cids, force=True, timeout=300):
+        """
+        :return: list of {"Hash", "Error"}, one per block
+        """
+        if not cids:
+            return []
+        return list(self.stream('block/rm', cids, timeout, force=force))
+
+    def repo_gc(self, timeout=300):
+        """
+        :return: generator of {"Key": {"/": cid}} or {"Error"} per removed block
+        """
+        return self.stream('repo/gc', timeout=timeout)
+
+
+def format_stats_dht(dhts):
+    """
+    render stats dht results like the ipfs cli, the format analyse_ipfs_hops reads
+    :param dhts: result of IpfsRpc.stats_dht
+    :return: text
+    """
+    lines = []
+    for dht in dhts:
+        buckets = dht.get('Buckets') or []
+        lines.append(f'DHT {dht.get("Name")} ({sum(len(b.get("Peers") or []) for b in buckets)} peers):')
+        for index, bucket in enumerate(buckets):
+            peers = bucket.get('Peers') or []
+            lines.append(f'  Bucket {index:2d} ({len(peers)} peers) - refreshed {bucket.get("LastRefresh") or "never"}:')
+            lines.append('    Peer  last useful  last queried  Agent Version')
+            for peer in peers:
+                state = '@' if peer.get('Connected') else ' '
+                lines.append(f'  {state} {peer.get("ID")}  {peer.get("LastUsefulAt") or "never"}  '
+                             f'{peer.get("LastQueriedAt") or "never"}  {peer.get("AgentVersion") or ""}')
+    return ''.join(line + '\n' for line in lines)
+
+
+def format_query_event(event, ts=None):
+    """
+    render a query event like ipfs dht findprovs -v, the format analyse_ipfs_hops reads
+    :param event: query event dict
+    :param ts: timestamp prefix, defaults to now
+    :return: text, empty for events the cli does not print
+    """
+    ts = ts or datetime.now().strftime('%H:%M:%S.%f')[:-3]
+    kind = event.get('Type')
+    responses = event.get('Responses') or []
+    if kind == SENDING_QUERY:
+        return f'{ts}: * querying {event.get("ID")}\n'
+    if kind == PEER_RESPONSE:
+        return f'{ts}: * {event.get("ID")} says use {"".join(r["ID"] + " " for r in responses)}\n'
+    if kind == PROVIDER and responses:
+        text = f'{ts}: provider: {responses[0]["ID"]}\n'
+        return text + ''.join(f'\t{addr}\n' for addr in responses[0].get('Addrs') or [])
+    if kind == QUERY_ERROR:
+        return f'{ts}: error: {event.get("Extra")}\n'
+    if kind == DIALING_PEER:
+        return f'{ts}: dialing peer: {event.get("ID")}\n'
+    if kind == ADDING_PEER:
+        return f'{ts}: adding peer to query: {event.get("ID")}\n'
+    if kind == VALUE:
+        return f"{ts}: got value: '{event.get('Extra')}'\n"
+    return ''
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def default_client(url=API_URL):
+    """
+    client shared by the threads of this process, a forked worker gets its own connections
+    :param url: rpc api base url
+    :return: IpfsRpc
+    """
+    key = (os.getpid(), url)
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = IpfsRpc(url)
+        return _clients[key]
@@ -0,0 +1,165 @@
+import argparse
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# shared by every record.py run of the container, next to the daemon log by default
+PATH = os.environ.get('PEER_CACHE', '')
+# multiaddrs of a peer change rarely, rtt and routes drift during the day
+PEER_TTL = int(os.environ.get('PEER_CACHE_PEER_TTL', 6 * 3600))
+PROBE_TTL = int(os.environ.get('PEER_CACHE_PROBE_TTL', 3600))
+MAX_ENTRIES = int(os.environ.get('PEER_CACHE_SIZE', 100000))
+KEYS = {'peer': 'peer', 'probe': 'ip'}
+
+
+class PeerCache:
+    """
+    findpeer multiaddrs keyed by peerID and ping/traceroute results keyed by ip, backed by sqlite
+
+    Entries older than their ttl are misses, each table keeps at most max_entries
+    rows and drops the least recently used ones beyond that. Hits, misses and
+    evictions are counted in the database so they add up over concurrent runs.
+    """
+
+    def __init__(self, path, peer_ttl=PEER_TTL, probe_ttl=PROBE_TTL, max_entries=MAX_ENTRIES):
+        """
+        :param path: sqlite database file
+        :param peer_ttl: seconds a multiaddr list stays valid
+        :param probe_ttl: seconds a rtt and ip hop result stays valid
+        :param max_entries: max rows per table
+        """
+        self.path = path
+        self.peer_ttl = peer_ttl
+        self.probe_ttl = probe_ttl
+        self.max_entries = max_entries
+        # the stages of a measurement share the cache from their threads
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(path, timeout=300, isolation_level=None, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS peer (peer TEXT PRIMARY KEY, addrs TEXT, updated REAL, used REAL) '
+                        'WITHOUT ROWID')
+        self.db.execute('CREATE INDEX IF NOT EXISTS peer_used_index ON peer (used)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS probe (ip TEXT PRIMARY KEY, rtt REAL, ip_hop TEXT, updated REAL, '
+                        'used REAL) WITHOUT ROWID')
+        self.db.execute('CREATE INDEX IF NOT EXISTS probe_used_index ON probe (used)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS counter (name TEXT PRIMARY KEY, value INTEGER) WITHOUT ROWID')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    def count(self, name, value=1):
+        if value:
+            self.db.execute('INSERT INTO counter VALUES (?, ?) ON CONFLICT (name) DO UPDATE SET value = value + ?',
+                            (name, value, value))
+
+    def lookup(self, table, key, columns, ttl):
+        key_column = KEYS[table]
+        now = time.time()
+        with self.lock:
+            row = self.db.execute(f'SELECT {", ".join(columns)} FROM {table} WHERE {key_column} = ? AND updated >= ?',
+                                  (key, now - ttl)).fetchone()
+            if row is None:
+                self.count(f'{table}_miss')
+                return None
+            self.db.execute(f'UPDATE {table} SET used = ? WHERE {key_column} = ?', (now, key))
+            self.count(f'{table}_hit')
+        return row
+
+    def store(self, table, rows):
+        """
+        :param rows: tuples of the table columns without updated and used
+        """
+        if not rows:
+            return
+        now = time.time()
+        placeholders = ', '.join('?' * (len(rows[0]) + 2))
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                self.db.executemany(f'INSERT OR REPLACE INTO {table} VALUES ({placeholders})',
+                                    [tuple(row) + (now, now) for row in rows])
+                excess = self.db.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0] - self.max_entries
+                if excess > 0:
+                    # least recently used first
+                    key_column = KEYS[table]
+                    self.db.execute(f'DELETE FROM {table} WHERE {key_column} IN '
+                                    f'(SELECT {key_column} FROM {table} ORDER BY used LIMIT ?)', (excess,))
+                    self.count(f'{table}_evict', excess)
+                self.db.execute('COMMIT')
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+
+    def get_addrs(self, peer):
+        """
+        :return: multiaddr list of the peer, None on miss
+        """
+        row = self.lookup('peer', peer, ['addrs'], self.peer_ttl)
+        return None if row is None else json.loads(row[0])
+
+    def put_addrs(self, peer, addrs):
+        self.store('peer', [(peer, json.dumps(addrs))])
+
+    def get_probe(self, ip):
+        """
+        :return: (rtt, ip_hop) of the ip, None on miss
+        """
+        return self.lookup('probe', ip, ['rtt', 'ip_hop'], self.probe_ttl)
+
+    def put_probes(self, results):
+        """
+        :param results: dic {ip : (rtt, ip_hop)}
+        """
+        self.store('probe', [(ip, rtt, ip_hop) for ip, (rtt, ip_hop) in results.items()])
+
+    def stats(self):
+        """
+        :return: dic of the counters and the number of entries, read in one transaction
+        """
+        with self.lock:
+            self.db.execute('BEGIN')
+            try:
+                stats = dict(self.db.execute('SELECT name, value FROM counter ORDER BY name'))
+                stats['peer_entries'] = self.db.execute('SELECT COUNT(*) FROM peer').fetchone()[0]
+                stats['probe_entries'] = self.db.execute('SELECT COUNT(*) FROM probe').fetchone()[0]
+            finally:
+                self.db.execute('COMMIT')
+        return stats
+
+
+def open_cache(daemon_file=None):
+    """
+    open the shared cache, $PEER_CACHE or peer_cache.sqlite next to the daemon log
+    :param daemon_file: ipfs daemon log file
+    :return: PeerCache, None when caching is disabled with PEER_CACHE=off
+    """
+    path = PATH
+    if path == 'off':
+        return None
+    if not path:
+        path = os.path.join(os.path.dirname(os.path.abspath(daemon_file or '.')), 'peer_cache.sqlite')
+    return PeerCache(path)
+
+
+if __name__ == '__main__':
+    # e.g. python3 peer_cache.py /log_output/peer_cache.sqlite
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', type=str, help="cache database")
+    parser.add_argument('-p', '--peer', type=str, help="print the cached multiaddrs of a peer")
+    parser.add_argument('--ip', type=str, help="print the cached rtt and ip hop of an ip")
+    args = parser.parse_args()
+    with PeerCache(args.path) as cache:
+        if args.peer:
+            print(cache.get_addrs(args.peer))
+        if args.ip:
+            print(cache.get_probe(args.ip))
+        print(json.dumps(cache.stats(), indent=2))
@@ -0,0 +1,153 @@
+import concurrent.futures
+import ipaddress
+import logging
+import subprocess
+
+import icmplib
+
+import stages
+
+PING_COUNT = 5
+PING_INTERVAL = 0.2
+# traceroute -m
+MAX_HOPS = 20
+TRACE_TIMEOUT = 300
+TRACE_WORKERS = 16
+
+
+def pingable(address):
+    return address.ip_type != 'ip6'
+
+
+def traceable(address):
+    if address.ip_type == 'ip6' or address.protocol == 'dns':
+        return False
+    # error checking in case of domain
+    try:
+        ipaddress.ip_address(address.ip)
+    except ValueError as e:
+        logging.info(e)
+        return False
+    return True
+
+
+def probe_rtts(addresses, count=PING_COUNT, interval=PING_INTERVAL):
+    """
+    ping every ip once, all at the same time, and set Address.rtt
+    :param addresses: Address list
+    :param count: pings per ip
+    :param interval: seconds between the pings of an ip
+    :return: None
+    """
+    targets = {}  # {ping target : [address.ip]}
+    for ip in dict.fromkeys(address.ip for address in addresses if pingable(address)):
+        try:
+            ipaddress.ip_address(ip)
+            targets.setdefault(ip, []).append(ip)
+        except ValueError:
+            # case of dns address, one unresolvable name must not fail the others
+            try:
+                targets.setdefault(icmplib.resolve(ip)[0], []).append(ip)
+            except Exception as e:
+                logging.info(f'RTT Error {e}')
+    if not targets:
+        return
+    logging.info(f'Start RTT {list(targets)}')
+    with stages.span('ping') as span:
+        try:
+            hosts = icmplib.multiping(list(targets), count=count, interval=interval, concurrent_tasks=len(targets),
+                                      privileged=True)
+        except Exception as e:
+            span.outcome = 'error'
+            logging.info(f'RTT Error {e}')
+            return
+    rtt = {}
+    for host in hosts:
+        logging.info(f'RTT {host.address} {host.rtts}')
+        if host.is_alive:
+            for ip in targets[host.address]:
+                rtt[ip] = host.avg_rtt
+    for address in addresses:
+        if address.ip in rtt:
+            address.rtt = rtt[address.ip]
+
+
+def trace_hops(address, max_hops=MAX_HOPS, timeout=TRACE_TIMEOUT):
+    """
+    sudo traceroute with tcp or udp probes to the port of the address, as each address was always traced
+    :param address: Address
+    :param max_hops: hop limit
+    :param timeout: seconds before the traceroute is killed
+    :return: hop number of the last traceroute line as a string, None on timeout or error
+    """
+    protocol = '-T' if address.protocol == 'tcp' else '-U'
+    logging.info(f'Start Traceroute {address.ip}')
+    with stages.span('traceroute') as span:
+        try:
+            output = subprocess.run(['sudo', 'traceroute', address.ip, protocol, '-p', str(address.port),
+                                     '-m', str(max_hops)], stdout=subprocess.PIPE, timeout=timeout).stdout
+        except subprocess.TimeoutExpired:
+            span.outcome = 'timeout'
+            logging.info(f'Traceroute timeout {address.ip}')
+            return None
+        except OSError as e:
+            span.outcome = 'error'
+            logging.error(f'Traceroute Error {e}')
+            return None
+    lines = output.decode('utf-8').splitlines()
+    if not lines:
+        logging.error(f'Traceroute Error no output for {address.ip}')
+        return None
+    line = lines[-1].strip()
+    logging.info(line)
+    return line.split(' ')[0]
+
+
+def probe_ip_hops(addresses, workers=TRACE_WORKERS, max_hops=MAX_HOPS):
+    """
+    trace every ip, transport and port once with a bounded pool and set Address.ip_hop
+    :param addresses: Address list
+    :param workers: traceroutes running at once
+    :param max_hops: hop limit
+    :return: None
+    """
+    targets = {}  # {(ip, protocol, port) : Address traced for them}
+    for address in addresses:
+        if traceable(address):
+            targets.setdefault((address.ip, address.protocol, address.port), address)
+    if not targets:
+        return
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(workers, len(targets))) as pool:
+        ip_hop = dict(zip(targets, pool.map(trace_hops, targets.values(), [max_hops] * len(targets))))
+    for address in addresses:
+        if ip_hop.get((address.ip, address.protocol, address.port)) is not None:
+            address.ip_hop = ip_hop[(address.ip, address.protocol, address.port)]
+
+
+def probe_addresses(addresses, workers=TRACE_WORKERS, cache=None):
+    """
+    fill rtt and ip_hop of every address, the pings run while the traceroutes do
+    :param addresses: Address list
+    :param workers: traceroutes running at once
+    :param cache: PeerCache of earlier results by ip, None to probe every address
+    :return: None
+    """
+    missed = addresses
+    if cache is not None:
+        missed = []
+        cached = {}
+        for ip in dict.fromkeys(address.ip for address in addresses if pingable(address)):
+            cached[ip] = cache.get_probe(ip)
+        for address in addresses:
+            if cached.get(address.ip) is not None:
+                address.rtt, address.ip_hop = cached[address.ip]
+            elif pingable(address):
+                missed.append(address)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as pool:
+        pings = pool.submit(probe_rtts, missed)
+        probe_ip_hops(missed, workers)
+        pings.result()
+    if cache is not None:
+        cache.put_probes({address.ip: (address.rtt, address.ip_hop) for address in missed})
+    for address in addresses:
+        logging.info(f'Address {address.to_dict()}')
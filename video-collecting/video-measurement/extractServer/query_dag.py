@@ -0,0 +1,213 @@
+import argparse
+from collections import Counter
+
+import ipfs_rpc
+
+
+class Query:
+    __slots__ = ('id', 'answer', 'create_time', 'child', 'uid', 'parent', 'depth')
+
+    def __init__(self, id, ts, uid):
+        self.id = id
+        self.answer = []
+        self.create_time = ts
+        self.child = []
+        self.uid = uid
+        self.parent = None
+        # hops from the dht bucket, 1 for a root query
+        self.depth = 1
+
+
+class Response:
+    __slots__ = ('id', 'uid', 'create_time', 'parent')
+
+    def __init__(self, id, ts, uid):
+        self.id = id
+        self.uid = uid
+        self.create_time = ts
+        self.parent = []
+
+
+class Provider:
+    __slots__ = ('id', 'uid', 'create_time', 'parent')
+
+    def __init__(self, id, ts, uid):
+        self.id = id
+        self.uid = uid
+        self.create_time = ts
+        self.parent = None
+
+
+def parse_provid_line(line):
+    """
+    parse a line of ipfs dht findprovs -v output
+    :param line: line of cid_provid.txt
+    :return: (kind, ts, peerID, [answered peerIDs]) with kind querying, says or provider, or None
+    """
+    if not line or line[0] == '\t':
+        # provider address
+        return None
+    line = line.replace("\n", "")
+    index = line.find(": ")
+    ts = line[:index]
+    line = line[index + 1:]
+    line = line.split(" ")
+    if "querying" in line:
+        return 'querying', ts, line[-1], []
+    elif "says" in line:
+        # case answer, ids are followed by a trailing space
+        answer_start_index = line.index("use") + 1
+        return 'says', ts, line[line.index("says") - 1], [peer for peer in line[answer_start_index:] if peer]
+    elif "provider:" in line:
+        return 'provider', ts, line[-1], []
+    return None
+
+
+class QueryDag:
+    """
+    findprovs query graph, a query is a child of every earlier query whose answer named its peer
+
+    Queries and responses are indexed by peerID, so every line is added in time
+    proportional to the peers it names, and the depth of a query is fixed when it is
+    added since all its parents already exist.
+    """
+
+    def __init__(self):
+        self.root_query = []
+        self.all_query = []
+        self.all_provider = []
+        self.queries = {}  # {peerID : first Query of the peer}
+        self.responses = {}  # {peerID : Response}
+        self.uid = 0
+
+    def next_uid(self):
+        uid = self.uid
+        self.uid += 1
+        return uid
+
+    def add_query(self, peer, ts):
+        q = Query(peer, ts, self.next_uid())
+        response = self.responses.get(peer)
+        if response is not None:
+            q.parent = list(response.parent)
+            for parent in q.parent:
+                parent.child.append(q)
+            q.depth = 1 + min(parent.depth for parent in q.parent)
+        else:
+            # no parent = root query
+            self.root_query.append(q)
+        self.queries.setdefault(peer, q)
+        self.all_query.append(q)
+        return q
+
+    def add_response(self, peer, answers, ts):
+        q = self.queries.get(peer)
+        if q is None:
+            # answer from a peer never queried
+            return None
+        for answer in answers:
+            response = self.responses.get(answer)
+            if response is None:
+                response = Response(answer, ts, self.next_uid())
+                self.responses[answer] = response
+            if q not in response.parent:
+                response.parent.append(q)
+                q.answer.append(response)
+        return q
+
+    def add_provider(self, peer, ts):
+        provider = Provider(peer, ts, self.next_uid())
+        self.all_provider.append(provider)
+        return provider
+
+    def feed(self, line):
+        """
+        add a line of findprovs -v output
+        :return: parsed entry or None
+        """
+        entry = parse_provid_line(line)
+        if entry is None:
+            return None
+        kind, ts, peer, answers = entry
+        if kind == 'querying':
+            self.add_query(peer, ts)
+        elif kind == 'says':
+            self.add_response(peer, answers, ts)
+        else:
+            self.add_provider(peer, ts)
+        return entry
+
+    def feed_event(self, event, ts):
+        """
+        add a findprovs query event as streamed by the rpc api
+        :param event: query event dict
+        :param ts: timestamp of the event
+        :return: None
+        """
+        kind = event.get('Type')
+        responses = event.get('Responses') or []
+        if kind == ipfs_rpc.SENDING_QUERY:
+            self.add_query(event.get('ID'), ts)
+        elif kind == ipfs_rpc.PEER_RESPONSE:
+            self.add_response(event.get('ID'), [r['ID'] for r in responses], ts)
+        elif kind == ipfs_rpc.PROVIDER and responses:
+            self.add_provider(responses[0]['ID'], ts)
+
+    @classmethod
+    def load(cls, path):
+        dag = cls()
+        with open(path, 'r') as stdin:
+            for line in stdin:
+                dag.feed(line)
+        return dag
+
+    def levels(self):
+        """
+        breadth first walk from the root queries
+        :return: list of levels, level i holds the queries i + 1 hops away from the dht bucket
+        """
+        levels = []
+        seen = set()
+        level = self.root_query
+        while level:
+            levels.append(level)
+            seen.update(q.uid for q in level)
+            next_level = []
+            for q in level:
+                for child in q.child:
+                    if child.uid not in seen:
+                        seen.add(child.uid)
+                        next_level.append(child)
+            level = next_level
+        return levels
+
+    def hops(self, hosts):
+        """
+        ipfs hops of the queries sent to the peers that answered with a provider
+        :param hosts: peerIDs that returned a provider
+        :return: Counter {hop : number of queries}
+        """
+        hosts = set(hosts)
+        return Counter(q.depth for q in self.all_query if q.id in hosts)
+
+
+def hop_summary(distribution):
+    """
+    :param distribution: Counter {hop : number of queries}
+    :return: (min hop, max hop), -1 for both when empty
+    """
+    if not distribution:
+        return -1, -1
+    return min(distribution), max(distribution)
+
+
+if __name__ == '__main__':
+    # e.g. python3 query_dag.py <cid>_provid.txt
+    parser = argparse.ArgumentParser()
+    parser.add_argument('file', type=str, help="findprovs -v output")
+    args = parser.parse_args()
+    dag = QueryDag.load(args.file)
+    levels = dag.levels()
+    print(f'{len(dag.all_query)} queries, {len(dag.responses)} peers answered, {len(dag.all_provider)} providers')
+    for depth, level in enumerate(levels, 1):
+        print(f'hop {depth:3d}: {len(level)} queries')
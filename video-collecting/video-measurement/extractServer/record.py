@@ -1,60 +1,53 @@
 import argparse
 import concurrent.futures
-import copy
 import ipaddress
-import multiprocessing
 import os
-import shutil
-import signal
-import subprocess
 import sys
-import time
 from datetime import datetime
 import json
-from json import JSONEncoder
 import logging
-import traceback
-import pycurl
 
-import icmplib
-import requests
+import dag_export
+import evict
+import gateway_fetch
+import ipfs_rpc
+import peer_cache
+import probe
+import record_worker
+import result_store
+import stages
+import summary_json
+from daemon_index import DaemonLogIndex
+from query_dag import QueryDag, hop_summary
+from stage_graph import StageGraph
 
 SAVE_DIR = ""
+# findprovs stops once this many providers are found, as ipfs dht findprovs -n
+NUM_PROVIDERS = 20
+# findpeer calls running at once
+PEER_WORKERS = 16
+# measurement stages running at once, the gateway downloads always run alone
+STAGE_WORKERS = int(os.environ.get('STAGE_WORKERS', 4))
+# gateway download body: file, hash or discard
+GATEWAY_SINK = os.environ.get('GATEWAY_SINK', 'file')
+# byte range of the cached gateway fetch, e.g. 0-1048575, empty for the whole content
+GATEWAY_CACHED_RANGE = os.environ.get('GATEWAY_CACHED_RANGE', '')
+# ip4 ranges never measured
+PRIVATE_NETWORKS = tuple(ipaddress.IPv4Network(network) for network in
+                         ('10.0.0.0/8', '172.16.0.0/12', '127.0.0.0/8', '192.168.0.0/16'))
+# queries per hop level kept in the visualization of a lookup, 0 for all of them
+VISUAL_TOP_K = int(os.environ.get('VISUAL_TOP_K', '0'))
 
 
-class Bucket:
-    def __init__(self, id):
-        self.id = id
-        self.peers = []
-
-
-class Query:
-    def __init__(self, id, ts, uid):
-        self.id = id
-        self.answer = []
-        self.create_time = ts
-        self.child = []
-        self.uid = uid
-        self.parent = None
-
-
-class Response:
-    def __init__(self, id, ts, uid):
-        self.id = id
-        self.uid = uid
-        self.create_time = ts
-        self.parent = []
-
-
-class Provider:
-    def __init__(self, id, ts, uid):
-        self.id = id
-        self.uid = uid
-        self.create_time = ts
-        self.parent = None
+class MeasurementAborted(Exception):
+    """
+    raised by a stage when the cid cannot be measured, run exits with -1 and no summary is saved
+    """
 
 
 class Address:
+    __slots__ = ('ip', 'ip_type', 'port', 'protocol', 'rtt', 'ip_hop')
+
     def __init__(self, ip, ip_type, port, protocol):
         self.ip = ip
         self.ip_type = ip_type
@@ -63,265 +56,70 @@ class Address:
         self.rtt = None
         self.ip_hop = None
 
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
 
 class Stats:
+    # in the key order of cid_summary.json
+    __slots__ = ('cid', 'ipfs_hop', 'ipfs_hop_min', 'ipfs_hop_distribution', 'providers', 'num_blocks',
+                 'content_size', 'resolve_time', 'download_time', 'actual_provider', 'mime_type')
+
     def __init__(self, cid, ipfs_hop, providers, num_blocks, content_size,
-                 resolve_time, download_time, actual_provider):
+                 resolve_time, download_time, actual_provider, ipfs_hop_min=-1, ipfs_hop_distribution=None,
+                 mime_type=None):
         self.cid = cid
         self.ipfs_hop = ipfs_hop
+        self.ipfs_hop_min = ipfs_hop_min
+        # {hop : number of queries to peers that returned a provider}
+        self.ipfs_hop_distribution = ipfs_hop_distribution or {}
         self.providers = providers
         self.num_blocks = num_blocks
         self.content_size = content_size
         self.resolve_time = resolve_time
         self.download_time = download_time
         self.actual_provider = actual_provider
+        # file type server.go got with the cid, e.g. video/mp4
+        self.mime_type = mime_type
 
+    def to_dict(self):
+        """
+        :return: the summary as plain dicts and lists, the Stats is left untouched
+        """
+        summary = {name: getattr(self, name) for name in self.__slots__}
+        for key in ('providers', 'actual_provider'):
+            if summary[key] is not None:
+                summary[key] = {peer: [address.to_dict() for address in addresses]
+                                for peer, addresses in summary[key].items()}
+        return summary
 
-class StatsEncoder(JSONEncoder):
-    def default(self, o: Stats):
-        json_string = o.__dict__
-        providers = json_string['providers']
-        actual_providers = json_string['actual_provider']
-        if providers is not None and actual_providers is not None:
-            providers_new = copy.deepcopy(providers)
-            actual_providers_new = copy.deepcopy(actual_providers)
-            for key in providers.keys():
-                # logging.info(f'{key} => {type(providers[key])} => {providers[key]}')
-                providers_new[key] = [ob.__dict__ for ob in providers[key]]
-
-            for key in actual_providers.keys():
-                actual_providers_new[key] = [ob.__dict__ for ob in actual_providers[key]]
-            json_string['providers'] = providers_new
-            json_string['actual_provider'] = actual_providers_new
-        return json_string
 
-
-def add_parent(query_target: Query, q: Query):
-    """
-    add parents for q if exist
-    :param query_target: query to check
-    :param q: new query q
-    :return: True if added to at least one node
-    """
-    for response in query_target.answer:
-        if q.id == response.id:
-            try:
-                # case child exist
-                index = query_target.child.index(q)
-            except Exception:
-                # case new child
-                query_target.child.append(q)
-            if q.parent is None:
-                q.parent = [query_target]
-            else:
-                q.parent.append(query_target)
-    if len(query_target.child) > 0:
-        for i in query_target.child:
-            add_parent(i, q)
-
-
-def find_query(query_target: Query, id):
-    if query_target.id == id:
-        return query_target
-    else:
-        if len(query_target.child) > 0:
-            for i in query_target.child:
-                answer = find_query(i, id)
-                if answer is not None:
-                    return answer
-        else:
-            return None
-    return None
-
-
-def find_depth(node: Query):
-    """
-    find the depth of the current node
-    :param node: current node
-    :return: the depth of the node
-    """
-    node = node.parent
-    if node is not None and len(node) > 0:
-        for parent in node:
-            return 1 + find_depth(parent)
-    return 1
-
-
-def analyse_ipfs_hops(cid, result_host_dic, visual=False):
+def analyse_ipfs_hops(cid, result_host_dic, visual=False, dag=None):
     """
     analyze how many ipfs hop takes
     :param cid: cid of the object
     :param result_host_dic: a dict contains [provider : which peer responded this provider]
-    :param visual: bool for visualization out put
-    :return: cid and max hop the ipfs query traveled
+    :param visual: bool for visualization output, <cid>_visual.json with VISUAL_TOP_K queries per level
+    :param dag: QueryDag of the lookup, None to read it back from cid_provid.txt
+    :return: cid, max hop the ipfs query traveled and the hop distribution {hop : number of queries}
     """
     logging.info(f'CID {cid} = {result_host_dic}')
-    root_query = []
-    all_query = []
-    all_provider = []
-    all_response = []
-    dht_bucket = []
-    uid = 0
-    with open(os.path.join(SAVE_DIR, f'{cid}_dht.txt'), 'r') as stdin:
-        bucket_id = 0
-        current_bucket = None
-        for line in stdin.readlines():
-            if "Bucket" in line:
-                line = line.replace(" ", "")
-                index = line.find("Bucket")
-                try:
-                    # deal with 2 digit id
-                    bucket_id = int(line[index + 6:index + 8])
-                except Exception:
-                    # case of 1 digit id
-                    bucket_id = int(line[index + 6:index + 7])
-                current_bucket = Bucket(bucket_id)
-                dht_bucket.append(current_bucket)
-                continue
-            elif "Peer" in line or "DHT" in line:
-                continue
-            else:
-                # bucket reading
-                line = line.split(" ")
-                # case we have @ at the output
-                if line[2] == "@":
-                    # print(line[3])
-                    current_bucket.peers.append(line[3])
-                else:
-                    # print(line[4])
-                    if line[4] != "":
-                        current_bucket.peers.append(line[4])
-
-    with open(os.path.join(SAVE_DIR, f'{cid}_provid.txt'), 'r') as stdin:
-        for line in stdin.readlines():
-            if line[0] == '\t':
-                continue
-            line = line.replace("\n", "")
-            index = line.find(": ")
-            ts = line[:index]
-            line = line[index + 1:]
-            line = line.split(" ")
-            if "querying" in line:
-                cid = line[-1]
-                q = Query(cid, ts, uid)
-                uid += 1
-                # find if parent exit or not
-                for i in root_query:
-                    add_parent(i, q)
-                # no parent = root query
-                if q.parent is None:
-                    root_query.append(q)
-                all_query.append(q)
-            elif "says" in line:
-                # case answer
-                res_id = line[line.index("says") - 1]
-                answer_start_index = line.index("use") + 1
-                # find original query
-                q = None
-                for query in root_query:
-                    q = find_query(query, res_id)
-                    if q is not None:
-                        break
-                for index in range(answer_start_index, len(line)):
-                    response = None
-                    for r in all_response:
-                        if r.id == line[index]:
-                            response = r
-                            break
-                    if response is None:
-                        response = Response(line[index], ts, uid)
-                        all_response.append(response)
-                        uid += 1
-                    response.parent.append(q)
-                    q.answer.append(response)
-            elif "provider:" in line:
-                provider = Provider(line[-1], ts, uid)
-                uid += 1
-                all_provider.append(provider)
+    if dag is None:
+        dag = QueryDag.load(os.path.join(SAVE_DIR, f'{cid}_provid.txt'))
     # case of no exist
-    # if len(all_provider) == 0:
+    # if len(dag.all_provider) == 0:
     #     return 0, -1
     # map provider and result record, and analyse hop info
     host_result_dic = dict(zip(result_host_dic.values(), result_host_dic.keys()))
-    max_hop = -1
-    for query in all_query:
-        if query.id in host_result_dic.keys():
-            temp_hop = find_depth(query)
-            if temp_hop > max_hop:
-                max_hop = temp_hop
+    distribution = dag.hops(host_result_dic.keys())
+    _, max_hop = hop_summary(distribution)
     # case of visualization file output
     if visual:
-        output_list = []
-        level_list = root_query.copy()
-        # map root to dht bucket:
-        for query in root_query:
-            for bucket in dht_bucket:
-                if query.id in bucket.peers:
-                    query.parent = [f'Bucket {bucket.id}']
-                    break
-        # start to analysis hop information
-        root_level = True
-        while len(level_list) > 0:
-            temp_list = []
-            temp_level_list = []
-            for i in level_list:
-                # update for existing node
-                added = False
-                for j in temp_list:
-                    if j['id'] == i.id:
-                        # if i.parent.id not in j['parents']:
-                        j['parents'] += [x.id for x in i.parent]
-                        added = True
-                        break
-                if added:
-                    continue
-                # case for new node
-                peer = {'id': i.id}
-                if root_level is True:
-                    if i.parent is not None:
-                        peer['parents'] = i.parent
-                else:
-                    if i.parent is not None:
-                        peer['parents'] = [x.id for x in i.parent]
-                temp_list.append(peer)
-                if type(i) == Query:
-                    if len(i.child) > 0:
-                        temp_level_list += i.child
-            output_list.append(temp_list)
-            level_list = temp_level_list
-            root_level = False
-
-        # # read actual peer who provided answer from daemon
-        # with open('daemon.txt', 'r') as stdin:
-        #     result_host_dic = {}
-        #     for line in stdin.readlines():
-        #         if "cid" not in line:
-        #             continue
-        #         index = line.find("cid")
-        #         line = line.replace("\n", "")
-        #         line = line[index:]
-        #         line = line.split(" ")
-        #         result_host_dic[line[5]] = line[3]
-
-        # map final provider to each peer
-        temp_list = []
-        for index in range(len(all_provider)):
-            provider = all_provider[index]
-            peer = {'id': f'Provider {index}',
-                    # 'parents': []}
-                    'parents': [result_host_dic[provider.id]]}
-            temp_list.append(peer)
-        output_list.append(temp_list)
-        # adding bucket into output
-        temp_list = []
-        for bucket in dht_bucket:
-            peer = {'id': f'Bucket {bucket.id}'}
-            temp_list.append(peer)
-        output_list.insert(0, temp_list)
-
-        with open('visualization/node_modules/@nitaku/tangled-tree-visualization-ii/data.json', 'w') as fout:
-            json.dump(output_list, fout)
-    return cid, max_hop
+        dht_bucket = dag_export.read_dht_buckets(os.path.join(SAVE_DIR, f'{cid}_dht.txt'))
+        written, dropped = dag_export.write_tangled_tree(os.path.join(SAVE_DIR, f'{cid}_visual.json'), dag,
+                                                         result_host_dic, dht_bucket, VISUAL_TOP_K)
+        logging.info(f'CID {cid} visualization of {written} nodes, {dropped} queries sampled out')
+    return cid, max_hop, dict(sorted(distribution.items()))
 
 
 def analyse_storage(cid):
@@ -408,20 +206,15 @@ def analyse_content_provider(all_block_provider_dic, cid):
         actual_provider = []
         return actual_provider
     # read sub blocks provider
-    process = subprocess.Popen(
-        ['./ipfs', 'ls', cid],
-        stdout=subprocess.PIPE)
     try:
-        r_code = process.wait(timeout=300)
-        if r_code != 0:
-            logging.info(f"Error on IPFS LS with CID {cid} and exit code {r_code}")
-    except subprocess.TimeoutExpired:
+        block_cids = ipfs_rpc.default_client().ls(cid, timeout=300)
+    except ipfs_rpc.RpcTimeout:
         logging.info(f'IPFS ls Timeout with CID {cid}')
-    for line in process.stdout.readlines():
-        line = line.decode('utf-8')
-        line = line.split(" ")
-        # get block cid
-        block_cid = line[0]
+        block_cids = []
+    except ipfs_rpc.RpcError as e:
+        logging.info(f"Error on IPFS LS with CID {cid} {e}")
+        block_cids = []
+    for block_cid in block_cids:
         provider = all_block_provider_dic[block_cid]
         # add provider if not in list
         if provider not in actual_provider:
@@ -431,415 +224,414 @@ def analyse_content_provider(all_block_provider_dic, cid):
     return actual_provider
 
 
-def get_ip_hop(address: Address):
+def parse_multiaddr(multiaddr):
     """
-    find ip hop value from given Address
-    :param address: Address object
-    :return: None
+    parse a multiaddr as printed by findpeer, e.g. /ip4/1.2.3.4/udp/4001/quic-v1 or /dns4/host/tcp/443/wss
+    :param multiaddr: multiaddr string
+    :return: Address, None for private, loopback or transport-less addresses
     """
-    if address.ip_type == 'ip6' or address.protocol == 'dns':
-        return
-        # try to use traceroute to get rtt
-    if address.protocol == 'tcp':
-        protocol = "-T"
-    else:
-        protocol = '-U'
-    # error checking in case of domain:
-    try:
-        ipaddress.ip_address(address.ip)
-    except Exception as e:
-        logging.info(e)
-        return
-    # try traceroute
-    logging.info(f'Start Traceroute {address.ip}')
-    process = subprocess.Popen(
-        ['sudo', 'traceroute', address.ip, protocol, '-p', address.port, '-m', '20'],
-        stdout=subprocess.PIPE)
+    parts = multiaddr.strip().split("/")
+    if len(parts) < 3 or parts[0] != '':
+        return None
+    ip_type = parts[1]
+    ip_value = parts[2]
+    protocol = None
+    port = None
+    if len(parts) >= 5 and parts[3] in ('tcp', 'udp'):
+        protocol = parts[3]
+        port = parts[4]
+    if ip_type == 'ip6':
+        try:
+            if ipaddress.IPv6Address(ip_value).is_loopback:
+                # local v6 ignore
+                return None
+        except ValueError:
+            return None
+    elif ip_type == 'ip4':
+        # exclude private ip address
+        try:
+            ip = ipaddress.IPv4Address(ip_value)
+        except ValueError:
+            return None
+        if any(ip in network for network in PRIVATE_NETWORKS):
+            return None
+    elif not ip_type.startswith('dns'):
+        return None
+    if protocol is None:
+        # case of /dnsaddr/... or a relay address without transport
+        return None
+    return Address(ip_value, ip_type, port, protocol)
+
+
+def find_peers(peers, cache=None, workers=PEER_WORKERS):
+    """
+    findpeer every peer at once, a failing peer does not affect the others
+    :param peers: peerIDs
+    :param cache: PeerCache in front of findpeer, None to always ask the dht
+    :param workers: findpeer calls running at once
+    :return: dic {peerID : multiaddr[]} with None for peers not found, timed out peers are left out
+    """
+    found = {}
+    missed = []
+    for peer in dict.fromkeys(peers):
+        addrs = cache.get_addrs(peer) if cache is not None else None
+        if addrs is not None:
+            logging.info(f'Peer {peer} multiaddrs from cache')
+            found[peer] = addrs
+        else:
+            missed.append(peer)
 
-    try:
-        process.wait(300)
-        line = process.stdout.readlines()[-1]
-        line = line.decode('utf-8')
-        line = line.replace("\n", "")
-        line = line.lstrip()
-        logging.info(line)
-        address.ip_hop = line.split(" ")[0]
-    except subprocess.TimeoutExpired as e:
-        logging.info(f'Traceroute timeout {address.ip}')
-        process.kill()
-    except Exception as e:
-        logging.error(f'Traceroute Error {e}')
-
-
-def get_rtt(address: Address):
-    """
-    find rtt value from given Address
-    :param address: Address object
-    :return: None
-    """
-    if address.ip_type == 'ip6':
-        return
-    try:
-        logging.info(f'Start RTT {address.__dict__}')
-        host = icmplib.ping(address.ip, count=5, interval=0.2, privileged=True)
-    except Exception as e:
-        print(e)
-        return
-    if host.is_alive:
-        address.rtt = host.avg_rtt
-        logging.info(host.rtts)
-    else:
-        return
-        # try to use traceroute to get rtt
-        # logging.info(f'Start RTT by traceroute {address.ip}')
-        # process = subprocess.Popen(
-        #     ['sudo', 'traceroute', address.ip, '-T', '-p', address.port, '-m', '100'],
-        #     stdout=subprocess.PIPE)
-        # line = process.stdout.readlines()[-1]
-        # try:
-        #     line = line.decode('utf-8')
-        #     line = line.replace("\n", "")
-        #     line = line.split(" ")
-        #     rtt = float(line[line.index("ms") - 1])
-        #     address.rtt = str(rtt)
-        #     logging.info(f'RTT {address.ip} {rtt}')
-        # except Exception:
-        #     logging.error(line)
-
-
-def get_peer_ip(result_host_dic: dict):
+    def find_peer(peer):
+        with stages.span('findpeer') as span:
+            try:
+                return ipfs_rpc.default_client().findpeer(peer, timeout=300)
+            except ipfs_rpc.RpcTimeout:
+                span.outcome = 'timeout'
+                logging.info(f"Timeout for {peer}")
+                return False
+            except ipfs_rpc.RpcError as e:
+                # case of no route find, the lookup itself worked
+                logging.info(f"Error on IPFS findpeer with Peer {peer} output {e}")
+                return None
+
+    if missed:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(workers, len(missed))) as pool:
+            for peer, addrs in zip(missed, pool.map(find_peer, missed)):
+                if addrs is False:
+                    continue
+                found[peer] = addrs
+                if addrs is not None and cache is not None:
+                    cache.put_addrs(peer, addrs)
+    return found
+
+
+def get_peer_ip(result_host_dic, cache=None):
     """
     find peer multi address based on peerID
-    :param result_host_dic: [provider_peerID : who provides (peerID)]
+    :param result_host_dic: [provider_peerID : who provides (peerID)], or any iterable of peerIDs
+    :param cache: PeerCache in front of findpeer, None to always ask the dht
     :return: dic {provider_peerID : Address[]}
     """
     provider_ip = {}
-    for peer in result_host_dic.keys():
-        process = subprocess.Popen(['./ipfs', 'dht', 'findpeer', peer], stdout=subprocess.PIPE,
-                                   stderr=subprocess.PIPE)
-        try:
-            r_code = process.wait(timeout=300)
-            if r_code != 0:
-                logging.info(f"Error on IPFS findpeer with Peer {peer} and exit code {r_code}")
-                for line in process.stderr.readlines():
-                    logging.info(line)
-                for line in process.stdout.readlines():
-                    logging.info(line)
-                provider_ip[peer] = []
-                return provider_ip
-            # case of no route find
-            for line in process.stderr.readlines():
-                if 'Error' in str(line):
-                    logging.info(f"Error on IPFS findpeer with Peer {peer} output {str(line)}")
-                    provider_ip[peer] = []
-                    return provider_ip
-            provider_ip[peer] = []
-            with open(os.path.join(SAVE_DIR, f'{peer}_ip.txt'), 'w+') as stdout:
-                for line in process.stdout.readlines():
-                    line = line.decode('utf-8')
-                    # store all peer ip
-                    stdout.write(line)
-                    line = line.replace("\n", "")
-                    line = line.split("/")
-                    ip_type = line[1]
-                    ip_value = line[2]
-                    protocol = line[3]
-                    port = line[4]
-                    if ip_type == 'ip6' and ip_value == '::1':
-                        # local v6 ignore
-                        continue
-                    elif ip_type == 'ip4':
-                        # exclude private ip address
-                        if ipaddress.ip_address(ip_value) in ipaddress.IPv4Network('10.0.0.0/8') or \
-                                ipaddress.ip_address(ip_value) in ipaddress.IPv4Network('172.16.0.0/12') or \
-                                ipaddress.ip_address(ip_value) in ipaddress.IPv4Network('127.0.0.0/8') or \
-                                ipaddress.ip_address(ip_value) in ipaddress.IPv4Network('192.168.0.0/16'):
-                            continue
-                    # add valid ip address info
-                    logging.info(f'Peer {peer} has external IP {ip_value}:{port}, {ip_type}, {protocol}')
-                    if peer not in provider_ip.keys():
-                        provider_ip[peer] = []
-                    address = Address(ip_value, ip_type, port, protocol)
-                    provider_ip[peer].append(address)
-        except subprocess.TimeoutExpired as e:
-            logging.info(f"Timeout for {peer}")
+    for peer, addrs in find_peers(result_host_dic, cache).items():
+        provider_ip[peer] = []
+        if addrs is None:
+            continue
+        with open(os.path.join(SAVE_DIR, f'{peer}_ip.txt'), 'w+') as stdout:
+            for line in addrs:
+                # store all peer ip
+                stdout.write(line + '\n')
+                address = parse_multiaddr(line)
+                if address is None:
+                    continue
+                # add valid ip address info
+                logging.info(f'Peer {peer} has external IP {address.ip}:{address.port}, {address.ip_type}, '
+                             f'{address.protocol}')
+                provider_ip[peer].append(address)
     return provider_ip
 
 
-def ips_find_provider(cid):
+def dump_dht(cid):
     """
-    call ipfs to find provider for cid specified, and do a DHT dump before finding
+    DHT dump into cid_dht.txt, the routing table the findprovs lookup starts from
     :param cid: cid to find
     :return: None
     """
-
-    with open(os.path.join(SAVE_DIR, f'{cid}_dht.txt'), 'w') as stdout:
-        stdout.flush()
+    with open(os.path.join(SAVE_DIR, f'{cid}_dht.txt'), 'w') as stdout, stages.span('dht_dump') as span:
         try:
-            process = subprocess.Popen(['./ipfs', 'stats', 'dht'], stdout=stdout)
-            r_code = process.wait(timeout=300)
-            if r_code != 0:
-                logging.info(f"Error on IPFS stats dht with CID {cid} and exit code {r_code}")
-        except subprocess.TimeoutExpired:
-            process.kill()
-
-    with open(os.path.join(SAVE_DIR, f'{cid}_provid.txt'), 'w') as stdout:
-        stdout.flush()
-        try:
-            process = subprocess.Popen(['./ipfs', 'dht', 'findprovs', '-v', cid], stdout=stdout)
-            r_code = process.wait(timeout=300)
-            if r_code != 0:
-                logging.info(f"Error on IPFS dht findprovs with CID {cid} and exit code {r_code}")
-        except subprocess.TimeoutExpired:
-            process.kill()
-            logging.info(f'CID {cid} findprov timeout')
+            stdout.write(ipfs_rpc.format_stats_dht(ipfs_rpc.default_client().stats_dht(timeout=300)))
+        except ipfs_rpc.RpcError as e:
+            span.outcome = 'timeout' if isinstance(e, ipfs_rpc.RpcTimeout) else 'error'
+            logging.info(f"Error on IPFS stats dht with CID {cid} {e}")
 
 
-def get_storage_info(cid):
+def ips_find_provider(cid, num_providers=NUM_PROVIDERS):
     """
-    Get the number of blocks and the size of the conten given the CID
+    call ipfs to find provider for cid specified, after dump_dht
+    the query graph is built while the lookup runs, the raw trace is still written to cid_provid.txt
     :param cid: cid to find
-    :return: None
+    :param num_providers: stop the lookup once this many providers are found
+    :return: QueryDag of the lookup
     """
 
-    with open(os.path.join(SAVE_DIR, f'{cid}_storage.txt'), 'w') as stdout:
-        stdout.flush()
+    rpc = ipfs_rpc.default_client()
+    dag = QueryDag()
+    with open(os.path.join(SAVE_DIR, f'{cid}_provid.txt'), 'w') as stdout, stages.span('findprovs') as span:
+        events = rpc.findprovs(cid, num_providers=num_providers, timeout=300)
         try:
-            process = subprocess.Popen(['./ipfs', 'dag', 'stat', cid], stdout=stdout)
-            r_code = process.wait(timeout=300)
-            if r_code != 0:
-                logging.info(f"Error on IPFS dag stat with CID {cid} and exit code {r_code}")
-        except subprocess.TimeoutExpired:
-            logging.info(f'CID {cid} storage timeout')
-            process.kill()
+            for event in events:
+                ts = datetime.now().strftime('%H:%M:%S.%f')[:-3]
+                stdout.write(ipfs_rpc.format_query_event(event, ts))
+                dag.feed_event(event, ts)
+                if num_providers and len(dag.all_provider) >= num_providers:
+                    logging.info(f'CID {cid} found {len(dag.all_provider)} providers, stopping findprovs')
+                    break
+        except ipfs_rpc.RpcTimeout:
+            span.outcome = 'timeout'
+            logging.info(f'CID {cid} findprov timeout')
+        except ipfs_rpc.RpcError as e:
+            span.outcome = 'error'
+            logging.info(f"Error on IPFS dht findprovs with CID {cid} {e}")
+        finally:
+            # closes the rpc call, the daemon cancels the lookup
+            events.close()
+    logging.info(f'CID {cid} findprovs {len(dag.all_query)} queries, {len(dag.all_provider)} providers')
+    return dag
 
 
-def get_latency_info(cid):
+def get_storage_info(cid):
     """
-    Get resolve time and download time
+    Get the number of blocks and the size of the conten given the CID
     :param cid: cid to find
     :return: None
     """
 
-    with open(os.path.join(SAVE_DIR, f'{cid}_latency.txt'), 'w') as stdout:
-        stdout.flush()
+    with open(os.path.join(SAVE_DIR, f'{cid}_storage.txt'), 'w') as stdout, stages.span('dag_stat') as span:
         try:
-            process = subprocess.Popen(['./ipfs', 'get', cid, "-o", SAVE_DIR], stdout=stdout)
-            r_code = process.wait(timeout=600)
-            if r_code != 0:
-                logging.info(f"Error on IPFS get with CID {cid} and exit code {r_code}")
-        except subprocess.TimeoutExpired:
-            process.kill()
-            logging.info(f'CID {cid} download timeout')
+            size, num_blocks = ipfs_rpc.default_client().dag_stat(cid, timeout=300)
+            # same line as ipfs dag stat <cid>
+            stdout.write(f'Size: {size}, NumBlocks: {num_blocks}\n')
+        except ipfs_rpc.RpcTimeout:
+            span.outcome = 'timeout'
+            logging.info(f'CID {cid} storage timeout')
+        except ipfs_rpc.RpcError as e:
+            span.outcome = 'error'
+            logging.info(f"Error on IPFS dag stat with CID {cid} {e}")
 
 
-def get_latency_info_gateway(cid):
+def evict_cid(cid):
     """
-    Get resolve and download time via ipfs getway
+    cold cache: every local block of the dag goes, root included, before timing starts
     :param cid: cid to find
     :return: None
     """
     # remove possible cache
     # os.system(f"ipfs block rm $(ipfs ls --size=false {cid})")
     # time.sleep(5)
-    logging.info(f"Staring gc {cid}")
-    cmd = f"./ipfs block rm $(./ipfs ls --size=false {cid})"
-    process = subprocess.Popen(cmd,
-                               shell=True,
-                               preexec_fn=os.setsid,
-                               stdout=subprocess.PIPE,
-                               stderr=subprocess.PIPE)
-    logging.info(process.args)
-    # for line in process.stdout.readlines():
-    #     logging.info(f'Repo GCed {line.decode("utf-8")}')
-    # for line in process.stderr.readlines():
-    #     logging.info(f'Error {line.decode("utf-8")}')
-    try:
-        outs, errs = process.communicate(timeout=90)
-        logging.info(f'Done {outs.decode("utf-8")})')
-        logging.info(f'Error {errs.decode("utf-8")}')
-        # if rcode != 0:
-        #     logging.info(f'Error exit code {rcode}')
-    except subprocess.TimeoutExpired:
-        logging.info(f'Repo GC {cid} Timeout')
-        os.killpg(os.getpgid(process.pid), signal.SIGTERM)
-        # process.kill()
-        # outs, errs = process.communicate()
+    logging.info(f"Evicting {cid}")
+    with stages.span('evict') as span:
+        try:
+            report = evict.evict_dag(cid)
+            logging.info(f'Evicted {report["removed"]} of {report["blocks"]} blocks of {cid} in '
+                         f'{report["seconds"]:.2f}s, {len(report["remaining"])} remaining')
+            if report['errors']:
+                span.outcome = 'error'
+                logging.info(f'Error {report["errors"]}')
+            with open(os.path.join(SAVE_DIR, f'{cid}_evict.txt'), 'w') as stdout:
+                json.dump(report, stdout)
+        except ipfs_rpc.RpcTimeout:
+            span.outcome = 'timeout'
+            logging.info(f'Evict {cid} Timeout')
+        except ipfs_rpc.RpcError as e:
+            span.outcome = 'error'
+            logging.info(f'Error {e}')
+
+
+def get_latency_info_gateway(cid, cached=False):
+    """
+    Get resolve and download time via ipfs getway, the first download after evict_cid, then the cached one
+    :param cid: cid to find
+    :param cached: bool, the cached download into cid_latency_cached.txt, never written to disk
+    :return: None
+    """
+    stage, latency_file, byte_range = ('gateway_cached', f'{cid}_latency_cached.txt', GATEWAY_CACHED_RANGE) \
+        if cached else ('gateway_first', f'{cid}_latency.txt', None)
+    # file keeps the first download in SAVE_DIR/cid, hash and discard only measure it
+    vid_out = open(os.path.join(SAVE_DIR, f'{cid}'), 'wb') if GATEWAY_SINK == 'file' and not cached else None
     try:
-        file_size = 0
-        t = multiprocessing.Process(target=get_video, args=(cid,))
-        t.start()
-        prv_time = time.time()
-        while t.is_alive():
-            time.sleep(5)
-            current_size = os.path.getsize(os.path.join(SAVE_DIR, cid))
-            logging.info(f"Current_size {current_size}")
-            current_time = time.time()
-            if current_size != file_size:
-                file_size = current_size
-                prv_time = current_time
-            elif (current_time - prv_time) > 300:
-                # case we have no progress over 5 min we consider dead
-                logging.info(f"Collect Video Timeout {cid}")
-                t.terminate()
-                t.join()
-                exit(-1)
-            else:
-                # check every minute
-                time.sleep(60)
-        t.terminate()
-        t.join()
-    except Exception as e:
-        logging.info(f"Join error {e}")
-
-def get_video(cid):
-    with open(os.path.join(SAVE_DIR, f'{cid}'), 'wb') as vid_out:
+        fetch = gateway_fetch.GatewayFetch(gateway_fetch.gateway_url(cid), vid_out, digest=GATEWAY_SINK == 'hash',
+                                           byte_range=byte_range)
+        logging.info("Accessing URL %s", fetch.url)
+        with stages.span(stage) as span:
+            gateway_fetch.run([fetch])
+            if fetch.error:
+                span.outcome = 'timeout' if fetch.stalled else 'error'
+    finally:
+        if vid_out is not None:
+            vid_out.close()
+    if fetch.stalled and not cached:
+        # case we have no progress over 5 min we consider dead, a stalled cached fetch only has no metrics
+        raise MeasurementAborted(f"Collect Video Timeout {cid} {fetch.error}")
+    with open(os.path.join(SAVE_DIR, latency_file), 'w') as stdout:
+        if fetch.metrics is None:
+            logging.info(fetch.error)
+            return
+        logging.info(f"Got metric for CID {cid}, {dict(fetch.metrics, timeline=len(fetch.sink.timeline))}")
+        json.dump(fetch.metrics, stdout)
+
+
+def scan_providers(cid, daemon_file):
+    """
+    look up the findprovs results of cid in the shared index of the daemon log, only the new part of the log is parsed
+    :param cid: cid of the file
+    :param daemon_file: ipfs daemon log file
+    :return: dic {provider : which peer responded this provider}
+    """
+    with stages.span('log_scan'):
+        index = DaemonLogIndex(daemon_file)
         try:
-            url = f"http://127.0.0.1:8080/ipfs/{cid}"
-            #    url = "http://gateway.ipfs.io/ipfs/" + cid
-            logging.info("Accessing URL %s", url)
-            c = pycurl.Curl()
-            c.setopt(c.URL, url)
-            c.setopt(c.VERBOSE, False)
-            c.setopt(c.WRITEDATA, vid_out)
-            c.setopt(c.FOLLOWLOCATION, 1)
-            c.setopt(c.CONNECTTIMEOUT, 300)
-            c.perform()
+            logging.info(f'Indexed {index.update()} new daemon log entries')
+            result_host_dic = index.find_providers(cid)
+        finally:
+            index.close()
+    for provider, host in result_host_dic.items():
+        logging.info(f'CID {cid} has providerID {provider}; NodeID {host}')
+    return result_host_dic
 
-            """
-            curl_easy_perform()
-            |
-            |--NAMELOOKUP
-            |--|--CONNECT
-            |--|--|--APPCONNECT
-            |--|--|--|--PRETRANSFER
-            |--|--|--|--|--STARTTRANSFER
-            |--|--|--|--|--|--TOTAL
-            |--|--|--|--|--|--REDIRECT
-            """
-            m = {"total_time": c.getinfo(pycurl.TOTAL_TIME), "namelookup_time": c.getinfo(pycurl.NAMELOOKUP_TIME),
-                 "connect_time": c.getinfo(pycurl.CONNECT_TIME), "pretransfer_time": c.getinfo(pycurl.PRETRANSFER_TIME),
-                 "redirect_time": c.getinfo(pycurl.REDIRECT_TIME),
-                 "starttransfer_time": c.getinfo(pycurl.STARTTRANSFER_TIME),
-                 "length": c.getinfo(pycurl.CONTENT_LENGTH_DOWNLOAD)}
-            # in bytes
-
-            logging.info(f"Got metric for CID {cid}, {m}")
-            with open(os.path.join(SAVE_DIR, f'{cid}_latency.txt'), 'w') as stdout:
-                json.dump(m, stdout)
-        except Exception as e:
-            logging.info(e)
-            with open(os.path.join(SAVE_DIR, f'{cid}_latency.txt'), 'w') as stdout:
-                pass
-
-        # get cached performance
-        try:
-            url = f"http://127.0.0.1:8080/ipfs/{cid}"
-            #    url = "http://gateway.ipfs.io/ipfs/" + cid
-            logging.info("Accessing URL %s", url)
-            c = pycurl.Curl()
-            c.setopt(c.URL, url)
-            c.setopt(c.VERBOSE, False)
-            c.setopt(c.WRITEDATA, vid_out)
-            c.setopt(c.FOLLOWLOCATION, 1)
-            c.setopt(c.CONNECTTIMEOUT, 300)
-            c.perform()
 
-            """
-            curl_easy_perform()
-            |
-            |--NAMELOOKUP
-            |--|--CONNECT
-            |--|--|--APPCONNECT
-            |--|--|--|--PRETRANSFER
-            |--|--|--|--|--STARTTRANSFER
-            |--|--|--|--|--|--TOTAL
-            |--|--|--|--|--|--REDIRECT
-            """
-            m = {"total_time": c.getinfo(pycurl.TOTAL_TIME), "namelookup_time": c.getinfo(pycurl.NAMELOOKUP_TIME),
-                 "connect_time": c.getinfo(pycurl.CONNECT_TIME), "pretransfer_time": c.getinfo(pycurl.PRETRANSFER_TIME),
-                 "redirect_time": c.getinfo(pycurl.REDIRECT_TIME),
-                 "starttransfer_time": c.getinfo(pycurl.STARTTRANSFER_TIME),
-                 "length": c.getinfo(pycurl.CONTENT_LENGTH_DOWNLOAD)}
-            # in bytes
-            logging.info(f"Got metric for CID {cid}, {m}")
-            with open(os.path.join(SAVE_DIR, f'{cid}_latency_cached.txt'), 'w') as stdout:
-                json.dump(m, stdout)
-        except Exception as e:
-            logging.info(e)
-            with open(os.path.join(SAVE_DIR, f'{cid}_latency_cached.txt'), 'w') as stdout:
-                pass
-def preprocess_file(cid):
-    """
-    preprocess cid files,i.e. get the file, providers, etc
+def scan_content_provider(cid, daemon_file):
+    """
+    the providers bitswap got the blocks of cid from, after the first download
     :param cid: cid of the file
-    :return:
+    :param daemon_file: ipfs daemon log file
+    :return: list of provider for the cid
+    """
+    # the index connection stays in the thread of this stage
+    index = DaemonLogIndex(daemon_file)
+    try:
+        with stages.span('log_scan'):
+            logging.info(f'Indexed {index.update()} new daemon log entries')
+            all_block_provider_dic = index.block_providers(cid)  # {block_cid, provider_ID}
+        logging.info(f'all_block_provider_dic from daemon log offset {all_block_provider_dic.start_offset}')
+        actual_provider = analyse_content_provider(all_block_provider_dic, cid)
+    finally:
+        index.close()
+    logging.info(f'CID {cid} actual provider {actual_provider}')
+    return actual_provider
+
+
+def resolve_peers(peers, cache=None):
+    """
+    findpeer the peers, then ping and traceroute their addresses
+    :param peers: peerIDs
+    :param cache: PeerCache shared with the other runs, None to probe everything
+    :return: dic {peerID : Address[]}
+    """
+    peer_ips = get_peer_ip(peers, cache)
+    logging.info(f'Getting RTT and IP hop info of {len(peer_ips)} peers')
+    probe.probe_addresses([address for addresses in peer_ips.values() for address in addresses], cache=cache)
+    return peer_ips
+
+
+def preprocess_file(cid, daemon_file, cache=None):
+    """
+    the measurement of a cid as a stage graph, i.e. get the file, providers, etc
+
+    The DHT dump, findprovs and the eviction run at once. The gateway downloads are isolated,
+    only the light DHT stages run with them, so the DHT providers are resolved and probed
+    while the content is downloaded.
+    :param cid: cid of the file
+    :param daemon_file: ipfs daemon log file
+    :param cache: PeerCache shared with the other runs, None to probe everything
+    :return: StageGraph, its results go to postprocess_file
     """
     logging.info(f'Loading CID {cid}')
-    if os.path.exists(os.path.join(SAVE_DIR, f'{cid}_summary.json')):
-        exit(0)
-    ips_find_provider(cid)
-    get_latency_info_gateway(cid)
-    get_storage_info(cid)
+    graph = StageGraph()
+    graph.add('dht_dump', lambda results: dump_dht(cid))
+    graph.add('evict', lambda results: evict_cid(cid))
+    # the lookup starts from the dumped routing table
+    graph.add('findprovs', lambda results: ips_find_provider(cid), after=['dht_dump'])
+    # dht side, a log scan, dht queries and pings never touch the blocks or the link the downloads time
+    graph.add('providers', lambda results: scan_providers(cid, daemon_file), after=['findprovs'], light=True)
+
+    def hop_analysis(results):
+        with stages.span('hop_analysis'):
+            return analyse_ipfs_hops(cid, results['providers'], dag=results['findprovs'])
+
+    graph.add('hop_analysis', hop_analysis, after=['findprovs', 'providers'], light=True)
+    graph.add('provider_peers', lambda results: resolve_peers(list(results['providers']), cache),
+              after=['providers'], light=True)
+    graph.add('gateway_first', lambda results: get_latency_info_gateway(cid), after=['evict', 'findprovs'],
+              isolated=True)
+    graph.add('gateway_cached', lambda results: get_latency_info_gateway(cid, cached=True), after=['gateway_first'],
+              isolated=True)
+    # dag stat and ls read the blocks the first download brought back, they never fetch any
+    graph.add('dag_stat', lambda results: get_storage_info(cid), after=['gateway_first'])
+
+    def content_provider(results):
+        num_blocks, content_size = analyse_storage(cid)
+        if num_blocks != -1 and content_size != 0 and results['hop_analysis'][1] != -1:
+            return scan_content_provider(cid, daemon_file)
+        return []
+
+    graph.add('content_provider', content_provider, after=['dag_stat', 'hop_analysis'])
+    # the peers both lists share are resolved once
+    graph.add('actual_peers', lambda results: resolve_peers([peer for peer in results['content_provider']
+                                                             if peer not in results['provider_peers']], cache),
+              after=['provider_peers', 'content_provider'], light=True)
+    return graph
+
+
+def load_latency(cid):
+    """
+    :param cid: cid of the file
+    :return: dic {first, cached : gateway metrics} of the latency files written
+    """
+    latency = {}
+    for kind, name in (('first', f'{cid}_latency.txt'), ('cached', f'{cid}_latency_cached.txt')):
+        try:
+            with open(os.path.join(SAVE_DIR, name), 'r') as stdin:
+                latency[kind] = json.load(stdin)
+        except (OSError, ValueError):
+            # case fetch failed, the file is empty or missing
+            continue
+    return latency
 
 
-def postprocess_file(cid, all_provider_dic, all_block_provider_dic):
+def load_eviction(cid):
+    """
+    :param cid: cid of the file
+    :return: evict_dag report, None if eviction did not finish
+    """
+    try:
+        with open(os.path.join(SAVE_DIR, f'{cid}_evict.txt'), 'r') as stdin:
+            return json.load(stdin)
+    except (OSError, ValueError):
+        return None
+
+
+def postprocess_file(cid, results, store=None, mime_type=None):
     """
     postprocess cid files, i.e ipfs hop, ip hop, rtt, ip etc
-    :param all_block_provider_dic: dic contains block -> provider
-    :param all_provider_dic: dic contains cid -> {hosts : provider}
     :param cid: cid of the file
+    :param results: dic {stage : result} of the preprocess_file graph
+    :param store: ResultStore the results also go to, None for cid_progress.txt only
+    :param mime_type: file type of the cid
     :return: Stats
     """
     logging.info(f'Analyzing CID {cid}')
-    _, ipfs_hop = analyse_ipfs_hops(cid, all_provider_dic[cid])
-    logging.info(f'CID {cid} ipfs hop {ipfs_hop}')
+    result_host_dic = results['providers']
+    if not result_host_dic:
+        # case no findprovs result in the daemon log, no summary as before
+        raise MeasurementAborted(f'NO PROVIDER LOGGED CID {cid}')
+    _, ipfs_hop, hop_distribution = results['hop_analysis']
+    ipfs_hop_min, _ = hop_summary(hop_distribution)
+    logging.info(f'CID {cid} ipfs hop {ipfs_hop} min {ipfs_hop_min} distribution {hop_distribution}')
+    if ipfs_hop == -1:
+        # case of no result find
+        logging.info(f'NO IPFS INFO FOUND CID {cid}')
     num_blocks, content_size = analyse_storage(cid)
     logging.info(f'CID {cid} #blocks {num_blocks}, size {content_size}')
     resolve_time, download_time = analyse_latency_gateway(cid)
     logging.info(f'CID {cid} #r_time {resolve_time}, d_time {download_time}')
-    if num_blocks != -1 and content_size != 0 and ipfs_hop != -1:
-        actual_provider = analyse_content_provider(all_block_provider_dic, cid)
-    else:
-        actual_provider = []
-    logging.info(f'CID {cid} actual provider {actual_provider}')
-    if ipfs_hop == -1:
-        # case of no result find
-        logging.info(f'NO IPFS INFO FOUND CID {cid}')
-        # stats = Stats(cid, ipfs_hop, {}, None, None, None, None, None)
-        # all_stats.append(stats)
-        # continue
     # add actual provider if not in the providers list
     # for p in actual_provider:
     #     if p not in all_provider_dic[cid].keys():
     #         logging.info(f'Adding actual provider {p} to dic')
     #         all_provider_dic[cid][p] = ""
-    logging.info(f'CID {cid} getting peer IP values')
-    providers_ips = get_peer_ip(all_provider_dic[cid])
-    logging.info(f'CID {cid} getting actual peer IP values')
-    actual_provider_dic = {provider: "None" for provider in actual_provider}
-    logging.info(f'CID {cid} actual provider dic {actual_provider_dic}')
-    actual_provider_ips = get_peer_ip(actual_provider_dic)
+    peer_ips = {**results['provider_peers'], **results['actual_peers']}
+    providers_ips = {peer: peer_ips[peer] for peer in result_host_dic if peer in peer_ips}
+    actual_provider_ips = {peer: peer_ips[peer] for peer in results['content_provider'] if peer in peer_ips}
     stats = Stats(cid, ipfs_hop, providers_ips, num_blocks, content_size,
-                  resolve_time, download_time, actual_provider_ips)
-    logging.info(f'CID {cid} getting peer RTT and IP hop info')
-    for peer in providers_ips.keys():
-        for address in providers_ips[peer]:
-            get_rtt(address)
-            get_ip_hop(address)
-            logging.info(f'Address {address.__dict__}')
-
-    logging.info(f'CID {cid} getting actual peer RTT and IP hop info')
-    for peer in actual_provider_ips.keys():
-        for address in actual_provider_ips[peer]:
-            get_rtt(address)
-            get_ip_hop(address)
-            logging.info(f'Address {address.__dict__}')
+                  resolve_time, download_time, actual_provider_ips, ipfs_hop_min, hop_distribution, mime_type)
     # save progress
     logging.info(f'Saving Progress CID {cid}')
+    summary = stats.to_dict()
+    if store is not None:
+        store.add(summary, load_latency(cid), load_eviction(cid), stages.records())
+    # the summary files stay until their readers moved to the store
     with open(os.path.join(SAVE_DIR, f'{cid}_progress.txt'), 'a') as fout:
-        json.dump(copy.copy(stats), fout, cls=StatsEncoder)
-        fout.write('\n')
+        fout.write(summary_json.dumps(summary) + '\n')
 
     return stats
 
@@ -850,97 +642,106 @@ def clear_ipfs_repo():
     :return:
     """
     logging.info("Staring repo gc")
-    process = subprocess.Popen(['./ipfs', 'repo', 'gc'], stdout=subprocess.PIPE)
-    for line in process.stdout.readlines():
-        logging.info(f'Repo GCed {line}')
     try:
-        rcode = process.wait(timeout=300)
-        if rcode != 0:
-            logging.info(f'Error exit code {rcode}')
-    except subprocess.TimeoutExpired:
+        for line in ipfs_rpc.default_client().repo_gc(timeout=300):
+            logging.info(f'Repo GCed {line}')
+    except ipfs_rpc.RpcTimeout:
         logging.info(f'Repo GC Timeout')
-        process.kill()
+    except ipfs_rpc.RpcError as e:
+        logging.info(f'Error {e}')
 
 
-def main(cid, dir_name, daemon_file):
+def main(cid, dir_name, daemon_file, mime_type=None):
     # repo gc
     # clear_ipfs_repo()
     # start preprocess with multi threading
 
-    preprocess_file(cid)
-    # read daemon log file
-    all_provider_dic = {}  # {cid : result_host_dic={}}
-    all_block_provider_dic = {}  # {block_cid, provider_ID}
-    target_block_found = False
-    # shutil.copyfile(daemon_file, os.path.join(SAVE_DIR, "daemon.txt"))
-    with open(daemon_file, 'r') as stdin:
-        for line in stdin:
-            # read block provider information
-            if "bitswap.go" in line and "Block" in line and "from" in line:
-                index = line.find("Block")
-                line = line.replace("\n", "")
-                line = line[index:]
-                line = line.split(' ')
-                # Block bafkreicp3z76wlf2bx3zmwbjzgqpsdvkb4coxuruj4fyq5w7gpvo2tfiuq
-                # recived from 12D3KooWGBWx9gyUFTVQcKMTenQMSyE2ad9m7c9fpjS4NMjoDien
-                current_cid = line[1].split('\n')[0]
-                provider_id = line[-1]
-                # logging.info(f'Block {current_cid} provider {provider_id}')
-                if current_cid == cid:
-                    target_block_found = True
-                if target_block_found:
-                    all_block_provider_dic[current_cid] = provider_id
-                continue
-            # read findprovs output info
-            if "routing.go" not in line or "":
-                continue
-            index = line.find("cid")
-            line = line.replace("\n", "")
-            line = line[index:]
-            line = line.split(" ")
-            c = line[1]
-
-            # case where cid is not root cid we asked for
-            # TODO maybe this caused by block cid finding ?
-            if c != cid:
-                # logging.info(f'CID {cid} not in sample files')
-                continue
-            logging.info(f'CID {c} has providerID {line[5]}; NodeID {line[3]}')
-            # add valid cid in to dic
-            # "cid %s provider %s provides %s",oriKey, p, prov.ID
-            if c not in all_provider_dic.keys():
-                result_host_dic = {}
-                all_provider_dic[cid] = result_host_dic
-            else:
-                result_host_dic = all_provider_dic[cid]
-            result_host_dic[line[5]] = line[3]
-    logging.info(f'all_provider_dic = {all_provider_dic}')
-    logging.info(f'all_block_provider_dic = {all_block_provider_dic}')
-
-    # star multi-threading for post process
-    stat = postprocess_file(cid, all_provider_dic, all_block_provider_dic)
+    store = result_store.open_store(dir_name)
+    if os.path.exists(os.path.join(dir_name, f'{cid}_summary.json')) or (store is not None and store.has(cid)):
+        exit(0)
+    cache = peer_cache.open_cache(daemon_file)
+    results = preprocess_file(cid, daemon_file, cache).run(STAGE_WORKERS)
+    stat = postprocess_file(cid, results, store, mime_type)
+    if cache is not None:
+        logging.info(f'Peer cache {cache.path} {cache.stats()}')
+        cache.close()
+    if store is not None:
+        logging.info(f'Saved CID {cid} to {store.path}')
+        store.close()
     save_path = os.path.join(dir_name, f'{cid}_summary.json')
     # write to file
     with open(save_path, 'w') as fout:
-        json.dump(stat, fout, cls=StatsEncoder)
+        fout.write(summary_json.dumps(stat))
 
 
-if __name__ == '__main__':
-    # setup parser
-    parser = argparse.ArgumentParser()
-    parser.add_argument('-f', '--file', type=str, help="daemon file log name", required=True)
-    parser.add_argument('-d', '--directory', type=str, help="input directory name", required=True)
-    parser.add_argument('-c', '--cid', type=str, help="cid", required=True)
-    args = parser.parse_args()
-    # setup logger
+def run(cid, dir_name, daemon_file, mime_type=None):
+    """
+    measure one cid, logging into <dir_name>/record.log
+    :param cid: cid to measure
+    :param dir_name: output directory of the cid
+    :param daemon_file: ipfs daemon log file
+    :param mime_type: file type of the cid
+    :return: None, exits with -1 when a stage aborts the measurement
+    """
+    global SAVE_DIR
+    # setup logger, force replaces the handlers a worker service process inherited
     logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s',
                         level=logging.INFO,
                         datefmt='%Y-%m-%d %H:%M:%S',
-                        filename=os.path.join(args.directory, 'record.log'))  # stream=sys.stdout
-    SAVE_DIR = args.directory
+                        filename=os.path.join(dir_name, 'record.log'),  # stream=sys.stdout
+                        force=True)
+    SAVE_DIR = dir_name
     logging.info(f'dir_name = {SAVE_DIR}\n'
-                 f'cid = {args.cid}\n'
-                 f'daemon_file = {args.file}')
+                 f'cid = {cid}\n'
+                 f'daemon_file = {daemon_file}\n'
+                 f'mime_type = {mime_type}')
 
     # prefix = "/out/videos"
-    main(args.cid, args.directory, args.file)
+    stages.start(cid, dir_name, daemon_file)
+    try:
+        main(cid, dir_name, daemon_file, mime_type)
+    except MeasurementAborted as e:
+        # stage threads only raise, the process of the measurement picks the exit status here
+        logging.info(str(e))
+        sys.exit(-1)
+    finally:
+        stages.finish()
+
+
+if __name__ == '__main__':
+    # setup parser
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-f', '--file', type=str, help="daemon file log name")
+    parser.add_argument('-d', '--directory', type=str, help="input directory name")
+    parser.add_argument('-c', '--cid', type=str, help="cid")
+    parser.add_argument('-t', '--type', type=str, help="file type of the cid, e.g. video/mp4")
+    parser.add_argument('-w', '--worker', type=str, default=os.environ.get('RECORD_WORKER'),
+                        help="HOST:PORT of a record worker service to hand the measurement to "
+                             "(default $RECORD_WORKER)")
+    parser.add_argument('--serve', type=str, nargs='?', const=f'{record_worker.HOST}:{record_worker.PORT}',
+                        help="run as worker service listening on HOST:PORT")
+    parser.add_argument('--workers', type=int, default=12, help="measurements a worker service runs at once")
+    parser.add_argument('--deadline', type=int, default=record_worker.DEADLINE, help="seconds per measurement")
+    parser.add_argument('--metrics', type=str, help="HOST:PORT a worker service serves its stage metrics on")
+    args = parser.parse_args()
+    if args.serve:
+        logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s',
+                            level=logging.INFO,
+                            datefmt='%Y-%m-%d %H:%M:%S',
+                            stream=sys.stdout)
+        record_worker.serve(record_worker.parse_address(args.serve), args.workers, args.deadline,
+                            record_worker.parse_address(args.metrics) if args.metrics else None, args.file)
+        sys.exit(0)
+    if not args.file or not args.directory or not args.cid:
+        parser.error('the following arguments are required: -f/--file, -d/--directory, -c/--cid')
+    if args.worker:
+        # thin client, the worker service runs the measurement
+        try:
+            status = record_worker.measure_remote(record_worker.parse_address(args.worker), args.cid,
+                                                  args.directory, args.file, args.deadline, args.type)
+        except ConnectionRefusedError as e:
+            # case worker service not listening, nothing was handed over so measure in this process
+            print(f'Record worker {args.worker} unreachable {e}, measuring in process', flush=True)
+        else:
+            sys.exit(0 if status['status'] == 'done' else 1)
+    run(args.cid, args.directory, args.file, args.type or None)
@@ -0,0 +1,263 @@
+import json
+import logging
+import multiprocessing
+import socket
+import socketserver
+import threading
+import time
+
+HOST = '127.0.0.1'
+PORT = 29997
+# same budget server.go gives a record.py run
+DEADLINE = 120 * 60
+FINAL_STATUS = ('done', 'failed', 'timeout')
+
+
+def parse_address(address):
+    """
+    :param address: HOST:PORT string
+    :return: (host, port)
+    """
+    host, port = address.rsplit(':', 1)
+    return host or HOST, int(port)
+
+
+class Job:
+    def __init__(self, cid, directory, daemon_file, deadline, mime_type=None):
+        self.cid = cid
+        self.directory = directory
+        self.daemon_file = daemon_file
+        self.mime_type = mime_type
+        self.deadline = deadline
+        self.status = 'queued'
+        self.exitcode = None
+        self.submit_time = time.time()
+        self.start_time = None
+        self.end_time = None
+        self.listeners = []
+
+    def to_dict(self):
+        return {'cid': self.cid, 'status': self.status, 'exitcode': self.exitcode, 'directory': self.directory,
+                'submit_time': self.submit_time, 'start_time': self.start_time, 'end_time': self.end_time}
+
+
+class WorkerService:
+    """
+    runs record.py measurements for CIDs sent over a local socket
+
+    The service imports record.py once; every measurement is a forked child, so it
+    starts warm, keeps its own SAVE_DIR and log file, and can be killed at its deadline.
+    """
+
+    def __init__(self, measure, workers=12, deadline=DEADLINE):
+        """
+        :param measure: callable(cid, directory, daemon_file, mime_type) run in the child process
+        :param workers: measurements running at once
+        :param deadline: default seconds before a measurement is killed
+        """
+        self.measure = measure
+        self.slots = threading.Semaphore(workers)
+        self.deadline = deadline
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.context = multiprocessing.get_context('fork')
+
+    def submit(self, cid, directory, daemon_file, deadline=None, listener=None, mime_type=None):
+        """
+        queue a measurement, a cid already queued or running is not started twice
+        :param listener: callable(job) called on every status change
+        :return: Job
+        """
+        with self.lock:
+            job = self.jobs.get(cid)
+            if job is None or job.status in FINAL_STATUS:
+                job = Job(cid, directory, daemon_file, deadline or self.deadline, mime_type)
+                self.jobs[cid] = job
+                threading.Thread(target=self.run, args=(job,), daemon=True).start()
+            if listener is not None:
+                job.listeners.append(listener)
+                listener(job)
+        return job
+
+    def notify(self, job, status):
+        with self.lock:
+            job.status = status
+            listeners = list(job.listeners)
+        for listener in listeners:
+            try:
+                listener(job)
+            except OSError:
+                # case client went away, the measurement goes on
+                with self.lock:
+                    job.listeners.remove(listener)
+
+    def run(self, job):
+        with self.slots:
+            job.start_time = time.time()
+            self.notify(job, 'running')
+            logging.info(f'Start CID {job.cid} deadline {job.deadline}s')
+            process = self.context.Process(target=self.measure,
+                                           args=(job.cid, job.directory, job.daemon_file, job.mime_type))
+            process.start()
+            process.join(job.deadline)
+            if process.is_alive():
+                logging.info(f'CID {job.cid} deadline exceeded')
+                process.terminate()
+                process.join(10)
+                if process.is_alive():
+                    process.kill()
+                    process.join()
+                status = 'timeout'
+            else:
+                status = 'done' if process.exitcode == 0 else 'failed'
+            job.exitcode = process.exitcode
+            job.end_time = time.time()
+        logging.info(f'CID {job.cid} {status} exit code {job.exitcode} in {job.end_time - job.start_time:.1f}s')
+        if status != 'done':
+            self.abandon(job, status)
+        self.notify(job, status)
+
+    def abandon(self, job, status):
+        """
+        a killed or crashed child never ends its stages, count those as timed out or failed
+        """
+        import stages
+        try:
+            metrics = stages.open_metrics(job.daemon_file)
+            if metrics is None:
+                return
+            with metrics:
+                running = metrics.abandon(job.cid, 'timeout' if status == 'timeout' else 'error')
+            if running:
+                logging.info(f'CID {job.cid} {status} in stages {running}')
+        except Exception as e:
+            logging.info(f'Stage metrics of CID {job.cid} not updated {e}')
+
+    def status(self):
+        with self.lock:
+            return [job.to_dict() for job in self.jobs.values()]
+
+    def prometheus(self):
+        """
+        :return: job counts by status in the prometheus text exposition format
+        """
+        counts = dict.fromkeys(('queued', 'running') + FINAL_STATUS, 0)
+        with self.lock:
+            for job in self.jobs.values():
+                counts[job.status] += 1
+        return ('# HELP record_worker_jobs Measurements of the worker service by status.\n'
+                '# TYPE record_worker_jobs gauge\n' +
+                ''.join(f'record_worker_jobs{{status="{status}"}} {count}\n' for status, count in counts.items()))
+
+
+class WorkerHandler(socketserver.StreamRequestHandler):
+    """
+    one json request per connection:
+    {"cid", "directory", "file", "deadline", "type"} streams the job status until it is final,
+    {"op": "status"} answers the status of every job
+    """
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            # case readiness probe, connected and closed without a request
+            return
+        try:
+            request = json.loads(line)
+        except ValueError:
+            self.write({'error': f'invalid request {line!r}'})
+            return
+        service = self.server.service
+        if request.get('op') == 'status':
+            self.write({'jobs': service.status()})
+            return
+        if not request.get('cid') or not request.get('directory') or not request.get('file'):
+            self.write({'error': 'cid, directory and file are required'})
+            return
+        done = threading.Event()
+
+        def listener(job):
+            try:
+                self.write(job.to_dict())
+            except OSError:
+                # case client went away, notify drops the listener and this handler ends
+                done.set()
+                raise
+            if job.status in FINAL_STATUS:
+                done.set()
+
+        service.submit(request['cid'], request['directory'], request['file'], request.get('deadline'), listener,
+                       request.get('type'))
+        done.wait()
+
+    def write(self, message):
+        self.wfile.write((json.dumps(message) + '\n').encode('utf-8'))
+        self.wfile.flush()
+
+
+class WorkerServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, service):
+        super().__init__(address, WorkerHandler)
+        self.service = service
+
+
+def serve(address, workers=12, deadline=DEADLINE, metrics_address=None, daemon_file=None):
+    """
+    run the worker service until interrupted
+    :param address: (host, port) to listen on
+    :param workers: measurements running at once
+    :param deadline: default seconds before a measurement is killed
+    :param metrics_address: (host, port) serving GET /metrics, None for none
+    :param daemon_file: ipfs daemon log file, the stage metrics are found next to it
+    :return: None
+    """
+    # imported here so clients never pay for pycurl, icmplib and requests
+    import record
+    import stages
+    service = WorkerService(record.run, workers=workers, deadline=deadline)
+    if metrics_address is not None:
+        def render():
+            text = service.prometheus()
+            metrics = stages.open_metrics(daemon_file)
+            if metrics is not None:
+                with metrics:
+                    text += metrics.prometheus()
+            return text
+
+        stages.serve_metrics(metrics_address, render)
+        logging.info(f'Metrics on http://{metrics_address[0]}:{metrics_address[1]}/metrics')
+    with WorkerServer(address, service) as server:
+        logging.info(f'Record worker listening on {address[0]}:{address[1]} with {workers} workers')
+        server.serve_forever()
+
+
+def request(address, message, timeout=None):
+    """
+    send one request to the worker service
+    :param address: (host, port) of the service
+    :param message: request dict
+    :param timeout: socket timeout, None to wait for the final status
+    :return: generator of response dicts
+    """
+    with socket.create_connection(address, timeout=timeout) as sock:
+        sock.sendall((json.dumps(message) + '\n').encode('utf-8'))
+        with sock.makefile('r') as fin:
+            for line in fin:
+                yield json.loads(line)
+
+
+def measure_remote(address, cid, directory, daemon_file, deadline=None, mime_type=None):
+    """
+    thin client, hand a measurement to the worker service and wait for it
+    :return: final job status dict
+    """
+    status = {'cid': cid, 'status': 'failed'}
+    for status in request(address, {'cid': cid, 'directory': directory, 'file': daemon_file,
+                                    'deadline': deadline, 'type': mime_type}):
+        print(json.dumps(status), flush=True)
+        if 'error' in status:
+            break
+    return status
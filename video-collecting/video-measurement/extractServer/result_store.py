@@ -0,0 +1,182 @@
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import time
+
+# shared by every record.py run, off unless set: a database path, or on for results.sqlite in the output root
+# (parent of the cid directories)
+PATH = os.environ.get('RESULT_STORE', '')
+LATENCY_KEYS = ('total_time', 'namelookup_time', 'connect_time', 'pretransfer_time', 'redirect_time',
+                'starttransfer_time', 'length', 'received', 'sha256')
+ADDRESS_KEYS = ('ip', 'ip_type', 'port', 'protocol', 'rtt', 'ip_hop')
+ROLES = {'providers': 'provider', 'actual_provider': 'actual'}
+
+# columns without a declared type keep the python type they were written with (str, int or float),
+# so an exported summary is identical to the json record.py used to write
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS stats (cid TEXT PRIMARY KEY, ipfs_hop, ipfs_hop_min, ipfs_hop_distribution TEXT, '
+    'num_blocks, content_size, resolve_time, download_time, recorded REAL, mime_type TEXT)',
+    'CREATE TABLE IF NOT EXISTS peer (cid TEXT, role TEXT, position INTEGER, peer TEXT, '
+    'PRIMARY KEY (cid, role, position))',
+    'CREATE TABLE IF NOT EXISTS address (cid TEXT, role TEXT, peer TEXT, position INTEGER, '
+    f'{", ".join(ADDRESS_KEYS)}, PRIMARY KEY (cid, role, peer, position))',
+    'CREATE INDEX IF NOT EXISTS address_ip_index ON address (ip)',
+    f'CREATE TABLE IF NOT EXISTS latency (cid TEXT, kind TEXT, {", ".join(LATENCY_KEYS)}, timeline TEXT, '
+    'PRIMARY KEY (cid, kind))',
+    'CREATE TABLE IF NOT EXISTS eviction (cid TEXT PRIMARY KEY, blocks INTEGER, removed INTEGER, '
+    'remaining INTEGER, seconds REAL)',
+    'CREATE TABLE IF NOT EXISTS stage (cid TEXT, position INTEGER, stage TEXT, start REAL, seconds REAL, '
+    'outcome TEXT, PRIMARY KEY (cid, position))',
+]
+
+
+class ResultStore:
+    """
+    measurement results of every cid in one sqlite database
+
+    Each cid is written in a single transaction, concurrent record.py runs wait for
+    each other on the write lock instead of failing.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: sqlite database file
+        """
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=300, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('PRAGMA busy_timeout=300000')
+        for statement in SCHEMA:
+            self.db.execute(statement)
+        # case store written before the file type was recorded
+        if 'mime_type' not in [row[1] for row in self.db.execute('PRAGMA table_info(stats)')]:
+            self.db.execute('ALTER TABLE stats ADD COLUMN mime_type TEXT')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    def has(self, cid):
+        return self.db.execute('SELECT 1 FROM stats WHERE cid = ?', (cid,)).fetchone() is not None
+
+    def cids(self):
+        return [row[0] for row in self.db.execute('SELECT cid FROM stats ORDER BY recorded')]
+
+    def add(self, summary, latency=None, eviction=None, stages=None):
+        """
+        store the results of one cid, replacing earlier ones
+        :param summary: Stats.to_dict()
+        :param latency: dic {kind : gateway metrics}, e.g. first and cached
+        :param eviction: evict_dag report
+        :param stages: span records of the measurement, as stages.StageTimer keeps them
+        :return: None
+        """
+        cid = summary['cid']
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            for table in ('stats', 'peer', 'address', 'latency', 'eviction', 'stage'):
+                self.db.execute(f'DELETE FROM {table} WHERE cid = ?', (cid,))
+            self.db.execute('INSERT INTO stats VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                            (cid, summary['ipfs_hop'], summary.get('ipfs_hop_min'),
+                             json.dumps(summary.get('ipfs_hop_distribution') or {}), summary['num_blocks'],
+                             summary['content_size'], summary['resolve_time'], summary['download_time'],
+                             time.time(), summary.get('mime_type')))
+            for key, role in ROLES.items():
+                for position, (peer, addresses) in enumerate((summary.get(key) or {}).items()):
+                    self.db.execute('INSERT INTO peer VALUES (?, ?, ?, ?)', (cid, role, position, peer))
+                    self.db.executemany(f'INSERT INTO address VALUES (?, ?, ?, ?, {", ".join("?" * len(ADDRESS_KEYS))})',
+                                        [(cid, role, peer, index) + tuple(address.get(k) for k in ADDRESS_KEYS)
+                                         for index, address in enumerate(addresses)])
+            for kind, metrics in (latency or {}).items():
+                self.db.execute(f'INSERT INTO latency VALUES (?, ?, {", ".join("?" * len(LATENCY_KEYS))}, ?)',
+                                (cid, kind) + tuple(metrics.get(k) for k in LATENCY_KEYS) +
+                                (json.dumps(metrics.get('timeline')),))
+            if eviction is not None:
+                self.db.execute('INSERT INTO eviction VALUES (?, ?, ?, ?, ?)',
+                                (cid, eviction['blocks'], eviction['removed'], len(eviction['remaining']),
+                                 eviction['seconds']))
+            self.db.executemany('INSERT INTO stage VALUES (?, ?, ?, ?, ?, ?)',
+                                [(cid, position, span['stage'], span['start'], span['seconds'], span['outcome'])
+                                 for position, span in enumerate(stages or [])])
+            self.db.execute('COMMIT')
+        except BaseException:
+            self.db.execute('ROLLBACK')
+            raise
+
+    def summary(self, cid):
+        """
+        :return: the cid_summary.json content of a cid, None if unknown
+        """
+        row = self.db.execute('SELECT ipfs_hop, ipfs_hop_min, ipfs_hop_distribution, num_blocks, content_size, '
+                              'resolve_time, download_time, mime_type FROM stats WHERE cid = ?', (cid,)).fetchone()
+        if row is None:
+            return None
+        peers = {role: {} for role in ROLES.values()}
+        for role, peer in self.db.execute('SELECT role, peer FROM peer WHERE cid = ? ORDER BY role, position',
+                                          (cid,)):
+            peers[role][peer] = []
+        for row_address in self.db.execute(f'SELECT role, peer, {", ".join(ADDRESS_KEYS)} FROM address '
+                                           'WHERE cid = ? ORDER BY role, peer, position', (cid,)):
+            peers[row_address[0]][row_address[1]].append(dict(zip(ADDRESS_KEYS, row_address[2:])))
+        ipfs_hop, ipfs_hop_min, distribution, num_blocks, content_size, resolve_time, download_time, mime_type = row
+        # same key order as Stats
+        return {'cid': cid, 'ipfs_hop': ipfs_hop, 'ipfs_hop_min': ipfs_hop_min,
+                'ipfs_hop_distribution': json.loads(distribution), 'providers': peers['provider'],
+                'num_blocks': num_blocks, 'content_size': content_size, 'resolve_time': resolve_time,
+                'download_time': download_time, 'actual_provider': peers['actual'], 'mime_type': mime_type}
+
+    def latency(self, cid):
+        """
+        :return: dic {kind : gateway metrics} of a cid
+        """
+        result = {}
+        for row in self.db.execute(f'SELECT kind, {", ".join(LATENCY_KEYS)}, timeline FROM latency WHERE cid = ?',
+                                   (cid,)):
+            metrics = {k: v for k, v in zip(LATENCY_KEYS, row[1:-1]) if v is not None}
+            metrics['timeline'] = json.loads(row[-1])
+            result[row[0]] = metrics
+        return result
+
+
+def open_store(save_dir):
+    """
+    open the shared store, $RESULT_STORE or results.sqlite in the parent of save_dir with RESULT_STORE=on
+    :param save_dir: output directory of a cid
+    :return: ResultStore, None when RESULT_STORE is unset or off
+    """
+    path = PATH
+    if path in ('', 'off'):
+        return None
+    if path == 'on':
+        path = os.path.join(os.path.dirname(os.path.abspath(save_dir)), 'results.sqlite')
+    return ResultStore(path)
+
+
+if __name__ == '__main__':
+    # e.g. python3 result_store.py /out/videos/results.sqlite -d /out/videos to write back the cid_summary.json files
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', type=str, help="result database")
+    parser.add_argument('-c', '--cid', type=str, nargs='*', help="cids to export, all by default")
+    parser.add_argument('-d', '--directory', type=str,
+                        help="write <directory>/<cid>/<cid>_summary.json instead of json lines to stdout")
+    args = parser.parse_args()
+    with ResultStore(args.path) as store:
+        for cid in args.cid or store.cids():
+            summary = store.summary(cid)
+            if summary is None:
+                print(f'unknown cid {cid}', file=sys.stderr)
+                continue
+            if args.directory:
+                os.makedirs(os.path.join(args.directory, cid), exist_ok=True)
+                with open(os.path.join(args.directory, cid, f'{cid}_summary.json'), 'w') as fout:
+                    json.dump(summary, fout)
+            else:
+                print(json.dumps(summary))
@@ -52,9 +52,9 @@ type VideoQueue struct {
 	videos []*VideoTask
 }
 
-func (q *VideoQueue) pushVideo(cid cid.Cid, saveDir string) {
+func (q *VideoQueue) pushVideo(cid cid.Cid, saveDir string, fileType string) {
 	q.mu.Lock()
-	q.videos = append(q.videos, &VideoTask{cid, saveDir})
+	q.videos = append(q.videos, &VideoTask{cid, saveDir, fileType})
 	q.mu.Unlock()
 }
 func (q *VideoQueue) popVideo() *VideoTask {
@@ -66,8 +66,9 @@ func (q *VideoQueue) popVideo() *VideoTask {
 }
 
 type VideoTask struct {
-	cidStr  cid.Cid
-	saveDir string
+	cidStr   cid.Cid
+	saveDir  string
+	fileType string
 }
 
 type WantedCID struct {
@@ -95,7 +96,7 @@ func dequeueVideo() {
 						log.Printf("Failed create dir %s", err)
 						return
 					}
-					go collectMetric(videoTask.cidStr, videoSaveDir)
+					go collectMetric(videoTask.cidStr, videoSaveDir, videoTask.fileType)
 					break
 				} else {
 					log.Printf("Running Video Queue is full %d/16 sleep for 1min", runningQueue.count)
@@ -107,7 +108,7 @@ func dequeueVideo() {
 		}
 	}
 }
-func collectMetric(cid cid.Cid, saveDir string) {
+func collectMetric(cid cid.Cid, saveDir string, fileType string) {
 	ctx, cancel := context.WithTimeout(context.Background(), 120*time.Minute)
 	defer cancel()
 	if ctx.Err() == context.DeadlineExceeded {
@@ -118,7 +119,8 @@ func collectMetric(cid cid.Cid, saveDir string) {
 	if err := exec.CommandContext(ctx, "python3", "-u", "record.py",
 		"-c", cid.String(),
 		"-f", "/log-output/daemon.txt",
-		"-d", saveDir).Run(); err != nil {
+		"-d", saveDir,
+		"-t", fileType).Run(); err != nil {
 		log.Printf("Failed excute collect metric cid %s err %s", cid, err)
 		if err != nil {
 			log.Printf("%s", err)
@@ -145,10 +147,10 @@ func collectMetric(cid cid.Cid, saveDir string) {
 	//}
 
 }
-func downloadFile(cid cid.Cid, saveDir string, gatewayUrl string) {
+func downloadFile(cid cid.Cid, saveDir string, gatewayUrl string, fileType string) {
 	log.Printf("Processing cid %s", cid)
 	// enqueue
-	videoQueue.pushVideo(cid, saveDir)
+	videoQueue.pushVideo(cid, saveDir, fileType)
 	// TODO start collecting metric about provider
 	//for {
 	//	if runningQueue.addRunningVideo() {
@@ -239,7 +241,7 @@ func handleIncomingRequest(c net.Conn, gatewayUrl string) {
 			continue
 		}
 		// download cid
-		downloadFile(newCid, SaveDir, gatewayUrl)
+		downloadFile(newCid, SaveDir, gatewayUrl, msgRecvd.FileType)
 	}
 	c.Close()
 }
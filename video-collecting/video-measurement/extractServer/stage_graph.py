@@ -0,0 +1,85 @@
+import concurrent.futures
+import logging
+
+
+class Stage:
+    __slots__ = ('name', 'func', 'after', 'isolated', 'light')
+
+    def __init__(self, name, func, after=(), isolated=False, light=False):
+        self.name = name
+        self.func = func
+        self.after = tuple(after)
+        self.isolated = isolated
+        self.light = light
+
+
+class StageGraph:
+    """
+    steps of a measurement with the steps each one needs first, ready steps run at once
+
+    Stages start in the order they were added as soon as the stages they come after are
+    done. An isolated stage, e.g. a timed download, waits for the running stages and then
+    runs with light stages only, those putting no load on what it measures such as dht
+    queries and pings. Light stages start whenever they are ready.
+    """
+
+    def __init__(self):
+        self.stages = {}
+
+    def add(self, name, func, after=(), isolated=False, light=False):
+        """
+        :param name: stage name, its result is found under it
+        :param func: callable(results) with dic {stage : result} of the stages done so far
+        :param after: names of the stages that must be done first, added before this one
+        :param isolated: bool, run with light stages only
+        :param light: bool, may run alongside an isolated stage
+        :return: None
+        """
+        missing = [stage for stage in after if stage not in self.stages]
+        if name in self.stages or missing:
+            raise ValueError(f'stage {name} already added or after unknown stages {missing}')
+        if isolated and light:
+            raise ValueError(f'stage {name} cannot be isolated and light')
+        self.stages[name] = Stage(name, func, after, isolated, light)
+
+    def run(self, workers=4):
+        """
+        run every stage, an exception of a stage is raised once the stages running with it are done
+        :param workers: stages running at once
+        :return: dic {stage : result}
+        """
+        results = {}
+        pending = dict(self.stages)
+        running = {}  # {future : Stage}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            while pending or running:
+                alone = any(stage.isolated for stage in running.values())
+                heavy = any(not stage.light for stage in running.values())
+                # an isolated stage waiting for the heavy ones holds back the heavy stages added after it
+                held = False
+                for stage in list(pending.values()):
+                    if len(running) >= workers:
+                        break
+                    if any(name not in results for name in stage.after):
+                        continue
+                    if not stage.light:
+                        if alone or held:
+                            continue
+                        if stage.isolated and heavy:
+                            held = True
+                            continue
+                    del pending[stage.name]
+                    logging.info(f'Stage {stage.name} started with {sorted(s.name for s in running.values())}')
+                    running[pool.submit(stage.func, dict(results))] = stage
+                    alone = alone or stage.isolated
+                    heavy = heavy or not stage.light
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    stage = running.pop(future)
+                    if future.exception() is not None:
+                        # the pool waits for the running stages, nothing new starts
+                        pending.clear()
+                        concurrent.futures.wait(running)
+                        raise future.exception()
+                    results[stage.name] = future.result()
+        return results
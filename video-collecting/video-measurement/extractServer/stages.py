@@ -0,0 +1,389 @@
+import argparse
+import bisect
+import contextlib
+import http.server
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import ipfs_rpc
+
+# shared by every record.py run of the container, next to the daemon log by default
+PATH = os.environ.get('STAGE_METRICS', '')
+# prometheus textfile rewritten after every measurement, e.g. for the node exporter textfile collector
+TEXTFILE = os.environ.get('STAGE_METRICS_TEXTFILE', '')
+# histogram upper bounds in seconds, from a findpeer answer to a gateway fetch of a long video
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+OUTCOMES = ('ok', 'timeout', 'error')
+
+
+class Span:
+    """
+    one timed stage, outcome may be set to timeout or error when the stage handles its failure itself
+    """
+
+    __slots__ = ('stage', 'start', 'seconds', 'outcome')
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.start = time.time()
+        self.seconds = None
+        self.outcome = 'ok'
+
+
+class StageMetrics:
+    """
+    stage histograms, timeouts, errors and in-flight cids of all record.py runs, backed by sqlite
+
+    Histograms keep a count per bucket, so concurrent runs add up their observations
+    and prometheus() renders them as cumulative buckets.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: sqlite database file
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        # spans end on the ping thread and the findpeer and traceroute pools
+        self.db = sqlite3.connect(path, timeout=300, isolation_level=None, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS bucket (stage TEXT, position INTEGER, count INTEGER, '
+                        'PRIMARY KEY (stage, position)) WITHOUT ROWID')
+        self.db.execute('CREATE TABLE IF NOT EXISTS total (stage TEXT PRIMARY KEY, count INTEGER, seconds REAL, '
+                        'timeouts INTEGER, errors INTEGER) WITHOUT ROWID')
+        self.db.execute('CREATE TABLE IF NOT EXISTS inflight (cid TEXT PRIMARY KEY, pid INTEGER, started REAL) '
+                        'WITHOUT ROWID')
+        # stages of a run go on at once, count the spans of each stage still open
+        self.db.execute('CREATE TABLE IF NOT EXISTS running (cid TEXT, stage TEXT, count INTEGER, started REAL, '
+                        'PRIMARY KEY (cid, stage)) WITHOUT ROWID')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    def transaction(self, statements):
+        """
+        :param statements: (sql, parameters) run in one write transaction
+        """
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                for sql, parameters in statements:
+                    self.db.execute(sql, parameters)
+                self.db.execute('COMMIT')
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+
+    def observe(self, stage, seconds, outcome='ok', cid=None):
+        """
+        :param cid: run leaving the stage, None for an observation only
+        """
+        position = bisect.bisect_left(BUCKETS, seconds)
+        self.transaction(self.leave_statements(cid, stage) + [
+            ('INSERT INTO bucket VALUES (?, ?, 1) ON CONFLICT (stage, position) DO UPDATE SET count = count + 1',
+             (stage, position)),
+            ('INSERT INTO total VALUES (?, 1, ?, ?, ?) ON CONFLICT (stage) DO UPDATE SET count = count + 1, '
+             'seconds = seconds + excluded.seconds, timeouts = timeouts + excluded.timeouts, '
+             'errors = errors + excluded.errors',
+             (stage, seconds, int(outcome == 'timeout'), int(outcome == 'error')))])
+
+    def begin(self, cid, pid=None):
+        self.transaction([('DELETE FROM running WHERE cid = ?', (cid,)),
+                          ('INSERT OR REPLACE INTO inflight (cid, pid, started) VALUES (?, ?, ?)',
+                           (cid, pid or os.getpid(), time.time()))])
+
+    def enter(self, cid, stage):
+        """
+        mark stage as one of those cid is in now
+        """
+        self.transaction([('INSERT INTO running VALUES (?, ?, 1, ?) ON CONFLICT (cid, stage) DO UPDATE SET '
+                           'count = count + 1', (cid, stage, time.time()))])
+
+    @staticmethod
+    def leave_statements(cid, stage):
+        if cid is None:
+            return []
+        return [('UPDATE running SET count = count - 1 WHERE cid = ? AND stage = ?', (cid, stage)),
+                ('DELETE FROM running WHERE cid = ? AND stage = ? AND count <= 0', (cid, stage))]
+
+    def end(self, cid):
+        self.transaction([('DELETE FROM inflight WHERE cid = ?', (cid,)),
+                          ('DELETE FROM running WHERE cid = ?', (cid,))])
+
+    def abandon(self, cid, outcome='timeout'):
+        """
+        count every stage a killed run was in as timed out and forget the run
+        :return: those stages, None if the run was not in flight
+        """
+        with self.lock:
+            if self.db.execute('SELECT 1 FROM inflight WHERE cid = ?', (cid,)).fetchone() is None:
+                return None
+            running = self.db.execute('SELECT stage, count FROM running WHERE cid = ? ORDER BY started',
+                                      (cid,)).fetchall()
+        statements = [('DELETE FROM inflight WHERE cid = ?', (cid,)), ('DELETE FROM running WHERE cid = ?', (cid,))]
+        for stage, count in running:
+            statements.append(('INSERT INTO total VALUES (?, 0, 0, ?, ?) ON CONFLICT (stage) DO UPDATE SET '
+                               'timeouts = timeouts + excluded.timeouts, errors = errors + excluded.errors',
+                               (stage, count * (outcome == 'timeout'), count * (outcome == 'error'))))
+        self.transaction(statements)
+        return [stage for stage, _ in running]
+
+    def inflight(self):
+        """
+        :return: [(cid, started, {stage : started})] of the runs still alive, rows of dead processes are dropped
+        """
+        with self.lock:
+            rows = self.db.execute('SELECT cid, pid, started FROM inflight ORDER BY started').fetchall()
+            running = {}
+            for cid, stage, started in self.db.execute('SELECT cid, stage, started FROM running ORDER BY started'):
+                running.setdefault(cid, {})[stage] = started
+        alive = []
+        for cid, pid, started in rows:
+            try:
+                os.kill(pid, 0)
+                alive.append((cid, started, running.get(cid, {})))
+            except ProcessLookupError:
+                self.end(cid)
+            except PermissionError:
+                alive.append((cid, started, running.get(cid, {})))
+        return alive
+
+    def prometheus(self):
+        """
+        :return: the metrics in the prometheus text exposition format
+        """
+        with self.lock:
+            buckets = {}
+            for stage, position, count in self.db.execute('SELECT stage, position, count FROM bucket'):
+                buckets.setdefault(stage, [0] * (len(BUCKETS) + 1))[position] = count
+            totals = self.db.execute('SELECT stage, count, seconds, timeouts, errors FROM total ORDER BY stage').fetchall()
+        lines = ['# HELP record_stage_seconds Duration of the record.py measurement stages.',
+                 '# TYPE record_stage_seconds histogram']
+        for stage, count, seconds, _, _ in totals:
+            cumulative = 0
+            for bound, bucket in zip(BUCKETS + ('+Inf',), buckets.get(stage, [0] * (len(BUCKETS) + 1))):
+                cumulative += bucket
+                lines.append(f'record_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'record_stage_seconds_sum{{stage="{stage}"}} {seconds}')
+            lines.append(f'record_stage_seconds_count{{stage="{stage}"}} {count}')
+        lines += ['# HELP record_stage_timeouts_total Stages that timed out, killed runs count for their stage.',
+                  '# TYPE record_stage_timeouts_total counter']
+        lines += [f'record_stage_timeouts_total{{stage="{stage}"}} {timeouts}' for stage, _, _, timeouts, _ in totals]
+        lines += ['# HELP record_stage_errors_total Stages that failed.', '# TYPE record_stage_errors_total counter']
+        lines += [f'record_stage_errors_total{{stage="{stage}"}} {errors}' for stage, _, _, _, errors in totals]
+        inflight = self.inflight()
+        lines += ['# HELP record_inflight_cids Measurements running now.', '# TYPE record_inflight_cids gauge',
+                  f'record_inflight_cids {len(inflight)}',
+                  '# HELP record_inflight_stages Stages running now, a measurement runs several at once.',
+                  '# TYPE record_inflight_stages gauge']
+        stage_counts = {}
+        for _, _, running in inflight:
+            for stage in running:
+                stage_counts[stage] = stage_counts.get(stage, 0) + 1
+        lines += [f'record_inflight_stages{{stage="{stage}"}} {count}' for stage, count in sorted(stage_counts.items())]
+        lines += ['# HELP record_inflight_seconds Running time of each stage in flight, of the measurement as start '
+                  'before its first stage.',
+                  '# TYPE record_inflight_seconds gauge']
+        now = time.time()
+        for cid, started, running in inflight:
+            for stage, stage_started in (running or {'start': started}).items():
+                lines.append(f'record_inflight_seconds{{cid="{cid}",stage="{stage}"}} {now - stage_started:.3f}')
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path):
+        """
+        replace path with the current metrics, the textfile collector never reads half a file
+        """
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as fout:
+            fout.write(self.prometheus())
+        os.replace(tmp, path)
+
+
+class StageTimer:
+    """
+    spans of the stages of one measurement
+
+    Every span ends as a json line {"cid", "stage", "start", "seconds", "outcome"} in
+    records_path and, with metrics, as an observation of its stage.
+    """
+
+    def __init__(self, cid, records_path=None, metrics=None):
+        """
+        :param cid: measured cid
+        :param records_path: json lines file of the spans, None to keep them in records only
+        :param metrics: StageMetrics shared with the other runs, None for no aggregate
+        """
+        self.cid = cid
+        self.records_path = records_path
+        self.metrics = metrics
+        self.records = []
+        self.lock = threading.Lock()
+        if metrics is not None:
+            metrics.begin(cid)
+
+    @contextlib.contextmanager
+    def span(self, stage):
+        """
+        time the block as stage, an RpcTimeout or TimeoutError leaving it is a timeout, any other exception an error
+        :return: context manager of the Span
+        """
+        span = Span(stage)
+        if self.metrics is not None:
+            self.metrics.enter(self.cid, stage)
+        start = time.monotonic()
+        try:
+            yield span
+        except (ipfs_rpc.RpcTimeout, TimeoutError):
+            span.outcome = 'timeout'
+            raise
+        except SystemExit as e:
+            if e.code and span.outcome == 'ok':
+                span.outcome = 'error'
+            raise
+        except BaseException:
+            span.outcome = 'error'
+            raise
+        finally:
+            span.seconds = time.monotonic() - start
+            self.record(span)
+
+    def record(self, span):
+        record = {'cid': self.cid, 'stage': span.stage, 'start': span.start, 'seconds': span.seconds,
+                  'outcome': span.outcome}
+        with self.lock:
+            self.records.append(record)
+            if self.records_path:
+                with open(self.records_path, 'a') as fout:
+                    fout.write(json.dumps(record) + '\n')
+        if self.metrics is not None:
+            self.metrics.observe(span.stage, span.seconds, span.outcome, self.cid)
+
+    def close(self, textfile=TEXTFILE):
+        """
+        end the measurement, rewriting the prometheus textfile when one is configured
+        """
+        if self.metrics is None:
+            return
+        self.metrics.end(self.cid)
+        if textfile:
+            self.metrics.write_textfile(textfile)
+        self.metrics.close()
+        self.metrics = None
+
+
+def open_metrics(daemon_file=None):
+    """
+    open the shared metrics, $STAGE_METRICS or stage_metrics.sqlite next to the daemon log
+    :param daemon_file: ipfs daemon log file
+    :return: StageMetrics, None when disabled with STAGE_METRICS=off
+    """
+    path = PATH
+    if path == 'off':
+        return None
+    if not path:
+        path = os.path.join(os.path.dirname(os.path.abspath(daemon_file or '.')), 'stage_metrics.sqlite')
+    return StageMetrics(path)
+
+
+# timer of the measurement this process runs, record.py runs one cid per process
+_timer = None
+
+
+def start(cid, save_dir, daemon_file=None):
+    """
+    time the stages of cid into <save_dir>/<cid>_stages.jsonl and the shared metrics
+    :return: StageTimer
+    """
+    global _timer
+    _timer = StageTimer(cid, os.path.join(save_dir, f'{cid}_stages.jsonl'), open_metrics(daemon_file))
+    return _timer
+
+
+def finish():
+    """
+    :return: span records of the measurement
+    """
+    global _timer
+    if _timer is None:
+        return []
+    _timer.close()
+    records, _timer = _timer.records, None
+    return records
+
+
+def records():
+    return [] if _timer is None else list(_timer.records)
+
+
+@contextlib.contextmanager
+def span(stage):
+    """
+    time stage in the current measurement, only yields a Span when none was started
+    """
+    if _timer is None:
+        yield Span(stage)
+        return
+    with _timer.span(stage) as current:
+        yield current
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, render):
+        """
+        :param render: callable returning the exposition text
+        """
+        super().__init__(address, MetricsHandler)
+        self.render = render
+
+
+def serve_metrics(address, render):
+    """
+    serve GET /metrics in a background thread
+    :param address: (host, port) to listen on
+    :return: MetricsServer
+    """
+    server = MetricsServer(address, render)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    # e.g. python3 stages.py /log-output/stage_metrics.sqlite --textfile /var/lib/node_exporter/record.prom
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', type=str, help="metrics database")
+    parser.add_argument('--textfile', type=str, help="write the metrics to a prometheus textfile instead of stdout")
+    args = parser.parse_args()
+    with StageMetrics(args.path) as metrics:
+        if args.textfile:
+            metrics.write_textfile(args.textfile)
+        else:
+            print(metrics.prometheus(), end='')
@@ -0,0 +1,43 @@
+import json
+import os
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# orjson when installed, JSON_BACKEND=json forces the standard library
+BACKEND = os.environ.get('JSON_BACKEND', 'orjson' if orjson is not None else 'json')
+
+
+def to_dict(o):
+    """
+    default hook of both backends, records such as Stats and Address serialize themselves
+    """
+    if hasattr(o, 'to_dict'):
+        return o.to_dict()
+    raise TypeError(f'Object of type {type(o).__name__} is not JSON serializable')
+
+
+def use_orjson(backend):
+    return (backend or BACKEND) == 'orjson' and orjson is not None
+
+
+def dumps(obj, backend=None):
+    """
+    :param obj: summary dict or record with to_dict, int keys like the ipfs_hop_distribution hops become strings
+    :param backend: orjson or json, BACKEND by default
+    :return: json string, compact with orjson
+    """
+    if use_orjson(backend):
+        return orjson.dumps(obj, default=to_dict, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+    return json.dumps(obj, default=to_dict)
+
+
+def loads(data, backend=None):
+    """
+    :param data: json str or bytes
+    """
+    if use_orjson(backend):
+        return orjson.loads(data)
+    return json.loads(data)
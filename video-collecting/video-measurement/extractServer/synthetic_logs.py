@@ -0,0 +1,206 @@
+import argparse
+import json
+import os
+import random
+from datetime import datetime, timedelta
+
+import ipfs_rpc
+from benchmark_query_dag import synthetic_trace
+from query_dag import parse_provid_line
+
+# other debug lines of the daemon log, most of the log
+NOISE = ('dht\tdht.go:672\tpeer found\t{"peer": "%s"}',
+         'swarm2\tswarm.go:412\tdial failed\t{"peer": "%s", "error": "context deadline exceeded"}',
+         'bitswap\tpeermanager.go:209\tsent want-have\t{"peer": "%s"}',
+         'net/identify\tid.go:376\tidentify done\t{"peer": "%s"}')
+START = datetime(2022, 2, 19, 1, 51, 16)
+
+
+def peer_id(rng):
+    return '12D3KooW' + ''.join(rng.choice('123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz')
+                                for _ in range(44))
+
+
+def block_cid(rng):
+    return 'bafkrei' + ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz234567') for _ in range(52))
+
+
+def log_timestamp(moment):
+    return moment.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+
+def log_time(ms):
+    return log_timestamp(START + timedelta(milliseconds=ms))
+
+
+def block_line(ts, block, provider):
+    """
+    :return: bitswap.go block receive line as parse_block_line reads it
+    """
+    return f'{ts}\tDEBUG\tbitswap\tbitswap.go:498\tBlock {block} recived from {provider}\n'
+
+
+def routing_line(ts, cid, host, provider):
+    """
+    :return: routing.go findprovs result line as parse_routing_line reads it
+    """
+    return f'{ts}\tDEBUG\tdht\trouting.go:541\tcid {cid} provider {host} provides {provider}\n'
+
+
+def daemon_lines(num_lines, num_cids=100, blocks_per_cid=50, providers_per_cid=5, noise=0.8, seed=0):
+    """
+    daemon log of measurements of num_cids cids, one after the other
+    :param num_lines: lines in the log
+    :param num_cids: cids measured, see cids_of(seed, num_cids)
+    :param blocks_per_cid: distinct blocks received for each cid, the first is the root
+    :param providers_per_cid: findprovs results logged for each cid
+    :param noise: share of lines neither bitswap.go nor routing.go
+    :param seed: random seed
+    :return: generator of log lines
+    """
+    rng = random.Random(seed)
+    cids = cids_of(seed, num_cids)
+    peers = [peer_id(rng) for _ in range(max(16, num_cids))]
+    entries = int(num_lines * (1 - noise))
+    per_cid = max(1, entries // num_cids)
+    written = 0
+    blocks = []
+    for line in range(num_lines):
+        ts = log_time(line)
+        if written >= entries or rng.random() < noise:
+            yield f'{ts}\tDEBUG\t{rng.choice(NOISE) % rng.choice(peers)}\n'
+            continue
+        cid = cids[min(written // per_cid, num_cids - 1)]
+        step = written % per_cid
+        written += 1
+        if step == 0:
+            blocks = [cid] + [block_cid(rng) for _ in range(blocks_per_cid - 1)]
+        if step < providers_per_cid:
+            yield routing_line(ts, cid, rng.choice(peers), rng.choice(peers))
+        else:
+            # root block first, then the others, again when a block is fetched twice
+            yield block_line(ts, blocks[(step - providers_per_cid) % len(blocks)], rng.choice(peers))
+
+
+def cids_of(seed, num_cids):
+    rng = random.Random(f'cids {seed}')
+    return ['Qm' + ''.join(rng.choice('123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz') for _ in range(44))
+            for _ in range(num_cids)]
+
+
+def dht_table(num_buckets=16, peers_per_bucket=20, seed=0):
+    """
+    :return: stats dht rpc result with the given routing table
+    """
+    rng = random.Random(seed)
+    buckets = [{'LastRefresh': '1m2s', 'Peers': [{'ID': peer_id(rng), 'Connected': rng.random() < 0.5,
+                                                    'AgentVersion': 'kubo/0.18.1/'}
+                                                   for _ in range(peers_per_bucket)]}
+               for _ in range(num_buckets)]
+    return [{'Name': 'wan', 'Buckets': buckets}, {'Name': 'lan', 'Buckets': []}]
+
+
+def dht_text(num_buckets=16, peers_per_bucket=20, seed=0):
+    """
+    :return: cid_dht.txt content, stats dht output with the given table
+    """
+    return ipfs_rpc.format_stats_dht(dht_table(num_buckets, peers_per_bucket, seed))
+
+
+def provid_lines(num_queries, providers=20, seed=0):
+    """
+    :return: cid_provid.txt lines of a lookup with num_queries queried peers, result_host_dic of its providers
+    """
+    return synthetic_trace(num_queries, providers=providers, seed=seed)
+
+
+def query_events(num_queries, providers=20, addrs=(), seed=0):
+    """
+    the trace of provid_lines as findprovs rpc events
+    :param addrs: multiaddrs announced with every provider
+    :return: query event list, result_host_dic of its providers
+    """
+    lines, result_host_dic = provid_lines(num_queries, providers, seed)
+    events = []
+    for line in lines:
+        entry = parse_provid_line(line)
+        if entry is None:
+            continue
+        kind, _, peer, answers = entry
+        if kind == 'querying':
+            events.append({'Type': ipfs_rpc.SENDING_QUERY, 'ID': peer})
+        elif kind == 'says':
+            events.append({'Type': ipfs_rpc.PEER_RESPONSE, 'ID': peer,
+                           'Responses': [{'ID': answer, 'Addrs': []} for answer in answers]})
+        else:
+            events.append({'Type': ipfs_rpc.PROVIDER, 'ID': result_host_dic[peer],
+                           'Responses': [{'ID': peer, 'Addrs': list(addrs)}]})
+    return events, result_host_dic
+
+
+def storage_text(size=268435456, num_blocks=1025):
+    return f'Size: {size}, NumBlocks: {num_blocks}\n'
+
+
+def latency_text(size=268435456, seconds=40.0, bucket=0.1, seed=0):
+    """
+    :return: cid_latency.txt content, gateway metrics with a throughput timeline
+    """
+    rng = random.Random(seed)
+    buckets = max(1, int(seconds / bucket))
+    timeline = [[index, size // buckets] for index in range(buckets) if rng.random() < 0.9]
+    return json.dumps({'total_time': seconds, 'namelookup_time': 0.0001, 'connect_time': 0.0003,
+                       'pretransfer_time': 0.0004, 'redirect_time': 0.0, 'starttransfer_time': seconds * 0.05,
+                       'length': float(size), 'received': size, 'timeline': {'bucket': bucket, 'bytes': timeline}})
+
+
+def multiaddrs(num, seed=0):
+    """
+    :return: findpeer multiaddrs, public and private ip4, ip6, dns and relay addresses
+    """
+    rng = random.Random(seed)
+    addrs = []
+    for _ in range(num):
+        ip4 = f'{rng.randint(1, 223)}.{rng.randint(0, 255)}.{rng.randint(0, 255)}.{rng.randint(1, 254)}'
+        addrs.append(rng.choice((f'/ip4/{ip4}/tcp/4001', f'/ip4/{ip4}/udp/4001/quic-v1',
+                                 f'/ip4/192.168.{rng.randint(0, 255)}.{rng.randint(1, 254)}/tcp/4001',
+                                 f'/ip6/2001:db8::{rng.randint(1, 65535):x}/tcp/4001', '/ip6/::1/tcp/4001',
+                                 f'/dns4/node{rng.randint(0, 999)}.example.org/tcp/443/wss',
+                                 f'/ip4/{ip4}/tcp/4001/p2p/{peer_id(rng)}/p2p-circuit',
+                                 '/dnsaddr/bootstrap.libp2p.io')))
+    return addrs
+
+
+def write_fixtures(directory, cid, daemon_file=None, num_lines=1000, num_queries=1000, seed=0):
+    """
+    write the files record.py reads for cid into directory, and a daemon log when daemon_file is given
+    :return: result_host_dic of the findprovs trace
+    """
+    os.makedirs(directory, exist_ok=True)
+    lines, result_host_dic = provid_lines(num_queries, seed=seed)
+    with open(os.path.join(directory, f'{cid}_provid.txt'), 'w') as fout:
+        fout.writelines(lines)
+    with open(os.path.join(directory, f'{cid}_dht.txt'), 'w') as fout:
+        fout.write(dht_text(seed=seed))
+    with open(os.path.join(directory, f'{cid}_storage.txt'), 'w') as fout:
+        fout.write(storage_text())
+    with open(os.path.join(directory, f'{cid}_latency.txt'), 'w') as fout:
+        fout.write(latency_text(seed=seed))
+    if daemon_file:
+        with open(daemon_file, 'w') as fout:
+            fout.writelines(daemon_lines(num_lines, seed=seed))
+    return result_host_dic
+
+
+if __name__ == '__main__':
+    # e.g. python3 synthetic_logs.py -o /tmp/fixtures --lines 1000000 --queries 5000
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-o', '--output', type=str, required=True, help="directory of the fixtures")
+    parser.add_argument('-c', '--cid', type=str, default='QmSynthetic', help="cid the files are named after")
+    parser.add_argument('--lines', type=int, default=1000, help="daemon log lines")
+    parser.add_argument('--queries', type=int, default=1000, help="queried peers of the findprovs trace")
+    parser.add_argument('--seed', type=int, default=0, help="random seed")
+    args = parser.parse_args()
+    write_fixtures(args.output, args.cid, os.path.join(args.output, 'daemon.txt'), args.lines, args.queries,
+                   args.seed)
+    print(f'Wrote fixtures of {args.cid} to {args.output}')
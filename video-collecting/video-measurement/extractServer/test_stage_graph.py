@@ -0,0 +1,107 @@
+import threading
+import time
+import unittest
+from unittest import mock
+
+import record
+from stage_graph import StageGraph
+
+
+class Spans:
+    """
+    [(start, end)] of the runs of every stage, by stage name
+    """
+
+    def __init__(self):
+        self.spans = {}
+        self.lock = threading.Lock()
+
+    def stage(self, name, seconds=0.05, result=None):
+        def func(*args, **kwargs):
+            start = time.monotonic()
+            time.sleep(seconds)
+            with self.lock:
+                self.spans.setdefault(name, []).append((start, time.monotonic()))
+            return result
+        return func
+
+    def overlap(self, a, b):
+        """
+        :return: bool, the first runs of stages a and b overlap
+        """
+        (start_a, end_a), (start_b, end_b) = self.spans[a][0], self.spans[b][0]
+        return start_a < end_b and start_b < end_a
+
+
+class StageGraphTest(unittest.TestCase):
+    def test_after(self):
+        spans = Spans()
+        graph = StageGraph()
+        graph.add('a', spans.stage('a'))
+        graph.add('b', spans.stage('b'), after=['a'])
+        graph.run()
+        self.assertLessEqual(spans.spans['a'][0][1], spans.spans['b'][0][0])
+
+    def test_isolated_runs_with_light_stages_only(self):
+        spans = Spans()
+        graph = StageGraph()
+        graph.add('heavy', spans.stage('heavy'))
+        graph.add('download', spans.stage('download', 0.2), isolated=True)
+        graph.add('late_heavy', spans.stage('late_heavy'))
+        graph.add('ping', spans.stage('ping', 0.1), light=True)
+        graph.run(workers=4)
+        self.assertFalse(spans.overlap('download', 'heavy'))
+        self.assertFalse(spans.overlap('download', 'late_heavy'))
+        self.assertTrue(spans.overlap('download', 'ping'))
+
+    def test_exception(self):
+        graph = StageGraph()
+        graph.add('a', mock.Mock(side_effect=RuntimeError('stalled')))
+        graph.add('b', mock.Mock(), after=['a'])
+        with self.assertRaises(RuntimeError):
+            graph.run()
+        graph.stages['b'].func.assert_not_called()
+
+    def test_unknown_after(self):
+        with self.assertRaises(ValueError):
+            StageGraph().add('a', mock.Mock(), after=['b'])
+
+
+class MeasurementGraphTest(unittest.TestCase):
+    def test_provider_peers_overlaps_downloads(self):
+        spans = Spans()
+
+        def download(cid, cached=False):
+            spans.stage('gateway_cached' if cached else 'gateway_first', 0.3)()
+
+        with mock.patch.multiple(record, dump_dht=spans.stage('dht_dump'), evict_cid=spans.stage('evict'),
+                                 ips_find_provider=spans.stage('findprovs'), get_latency_info_gateway=download,
+                                 get_storage_info=spans.stage('dag_stat'),
+                                 scan_providers=spans.stage('providers', result={'provider': 'host'}),
+                                 analyse_ipfs_hops=spans.stage('hop_analysis', 0.01, ('cid', 2, {2: 1})),
+                                 analyse_storage=mock.Mock(return_value=('10', '1024')),
+                                 scan_content_provider=spans.stage('content_provider', result=['provider']),
+                                 resolve_peers=spans.stage('resolve_peers', 0.2, {})):
+            results = record.preprocess_file('cid', 'daemon.txt').run(record.STAGE_WORKERS)
+
+        # the first resolve_peers call is provider_peers, actual_peers waits for the content providers
+        self.assertTrue(spans.overlap('resolve_peers', 'gateway_first'))
+        for heavy in ('evict', 'findprovs', 'dag_stat', 'gateway_cached'):
+            self.assertFalse(spans.overlap('gateway_first', heavy), heavy)
+        self.assertFalse(spans.overlap('gateway_cached', 'dag_stat'))
+        self.assertEqual(results['content_provider'], ['provider'])
+
+    def test_aborted_stage(self):
+        stalled = mock.Mock(side_effect=record.MeasurementAborted('Collect Video Timeout'))
+        with mock.patch.multiple(record, dump_dht=mock.Mock(), evict_cid=mock.Mock(), get_storage_info=mock.Mock(),
+                                 ips_find_provider=mock.Mock(), get_latency_info_gateway=stalled,
+                                 scan_providers=mock.Mock(return_value={}), analyse_ipfs_hops=mock.Mock(),
+                                 resolve_peers=mock.Mock(return_value={})):
+            # raised in the main thread, not a SystemExit of a stage thread
+            with self.assertRaises(record.MeasurementAborted):
+                record.preprocess_file('cid', 'daemon.txt').run(record.STAGE_WORKERS)
+        stalled.assert_called_once_with('cid')
+
+
+if __name__ == '__main__':
+    unittest.main()